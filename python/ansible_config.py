@@ -0,0 +1,88 @@
+"""
+Per-cluster ansible.cfg, generated on every run: forks sized for the cluster and the local CPUs, persistent ssh
+connections, pipelining and the fact cache (see fact_cache). Ansible reads it from the cluster directory, settings
+not managed here come from the user's own configuration.
+"""
+
+import os
+import subprocess
+import multiprocessing
+import ConfigParser
+import fact_cache
+
+ANSIBLE_CONFIG_FILE = 'ansible.cfg'
+BASE_CONFIG_FILES = [os.path.expanduser('~/.ansible.cfg'), '/etc/ansible/ansible.cfg']
+
+# ansible forks mostly wait for ssh, so run several per local CPU
+FORKS_PER_CPU = 8
+MAX_FORKS = 100
+
+# ssh connection timeout, and keepalives to notice connections to hosts that went away (in seconds)
+SSH_TIMEOUT = 10
+SSH_ALIVE_INTERVAL = 15
+SSH_ALIVE_COUNT_MAX = 4
+
+# how long an idle master connection is kept open for the following tasks (in seconds)
+CONTROL_PERSIST = 300
+# short socket path, long host names would exceed the limit of unix socket paths
+CONTROL_PATH = '%(directory)s/%%h-%%r'
+
+
+def get_forks(num_hosts):
+    return max(1, min(num_hosts, multiprocessing.cpu_count() * FORKS_PER_CPU, MAX_FORKS))
+
+
+def has_control_persist():
+    """
+    Checks if the local ssh client supports ControlPersist (OpenSSH 5.6 and later)
+    """
+    try:
+        proc = subprocess.Popen(['ssh', '-o', 'ControlPersist=yes', '-V'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+    except OSError:
+        return False
+    return 'Bad configuration option' not in err and 'Usage:' not in err
+
+
+def write_ansible_config(num_hosts, pipelining=True, path=ANSIBLE_CONFIG_FILE):
+    """
+    Writes the ansible configuration for a cluster of num_hosts hosts. Pipelining needs sudo without requiretty,
+    which the bootstrap playbook takes care of, so it is turned off for bootstrapping with get_ansible_env().
+    """
+    config = ConfigParser.RawConfigParser()
+    config.read([x for x in BASE_CONFIG_FILES if os.path.isfile(x)][:1])
+    for section in 'defaults', 'ssh_connection':
+        if not config.has_section(section):
+            config.add_section(section)
+
+    config.set('defaults', 'forks', get_forks(num_hosts))
+    config.set('defaults', 'timeout', SSH_TIMEOUT)
+    config.set('defaults', 'fact_caching', 'jsonfile')
+    config.set('defaults', 'fact_caching_connection', os.path.abspath(fact_cache.FACT_CACHE_DIR))
+    config.set('defaults', 'fact_caching_timeout', fact_cache.FACT_CACHE_TIMEOUT)
+
+    ssh_args = []
+    if config.has_option('ssh_connection', 'ssh_args'):
+        ssh_args.append(config.get('ssh_connection', 'ssh_args'))
+    ssh_args.append('-o ServerAliveInterval=%d -o ServerAliveCountMax=%d' % (SSH_ALIVE_INTERVAL, SSH_ALIVE_COUNT_MAX))
+    if has_control_persist():
+        ssh_args.append('-o ControlMaster=auto -o ControlPersist=%ds' % CONTROL_PERSIST)
+        config.set('ssh_connection', 'control_path', CONTROL_PATH)
+    config.set('ssh_connection', 'ssh_args', ' '.join(x for x in ssh_args if x.strip()))
+    config.set('ssh_connection', 'pipelining', pipelining)
+
+    with open(path, 'w') as f:
+        f.write('# WARNING: this file will be overwritten whenever poutacluster is run\n')
+        config.write(f)
+
+
+def get_ansible_env(pipelining=True):
+    """
+    Returns the environment for running ansible with the generated configuration
+    """
+    env = dict(os.environ)
+    env['ANSIBLE_CONFIG'] = os.path.abspath(ANSIBLE_CONFIG_FILE)
+    if not pipelining:
+        env['ANSIBLE_SSH_PIPELINING'] = 'False'
+    return env
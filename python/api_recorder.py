@@ -0,0 +1,450 @@
+"""
+Recording of the OpenStack API calls made through openstack_api_wrapper to a trace file, and replaying a recorded
+session without a cloud.
+
+The trace file has one JSON object per line: a header describing the session (client layout, cluster
+configuration, command) followed by one entry per call attempt with its start offset, duration, arguments and
+response or error.
+
+In replay, calls that change something (create, delete, update, ...) get the recorded responses in the recorded
+order, preferring a response recorded with the same arguments. Calls that only read state (list, get, find) get
+every resource in the state it was recorded in at the current point of the session for that resource. The point
+advances with the (scaled) time since the last replayed change of the resource, but never past the next recorded
+change of the resource that has not been replayed yet. This way resources change state at the recorded pace even if
+the calls are made in a different order or at a different rate, and the replayed client never sees the effects of
+calls it has not made. Every call takes its recorded time, multiplied by the latency scale.
+
+A recorded read only tells that a resource changed state at some point after the previous read of it. The new state
+is shown from the update time of the resource, or halfway between the reads if the resource has none, instead of
+from the read that first saw it. Otherwise a replayed poll made just before that read would miss the change and back
+off, and the replay would fall behind the recording.
+"""
+
+import json
+import time
+import calendar
+import bisect
+import threading
+
+READ_METHODS = ['list', 'get', 'find']
+
+_session = None
+
+
+def get_session():
+    return _session
+
+
+def set_session(session):
+    global _session
+    _session = session
+
+
+def _normalize(value):
+    if hasattr(value, '_info'):
+        return getattr(value, 'id', None) or value._info.get('id')
+    if isinstance(value, dict):
+        return dict((k, _normalize(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_normalize(x) for x in value]
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    return getattr(value, 'id', repr(value))
+
+
+def args_key(args, kwargs):
+    return json.dumps([_normalize(list(args)), _normalize(kwargs)], sort_keys=True)
+
+
+def serialize(value):
+    if hasattr(value, '_info'):
+        return {'__resource__': type(value).__name__, 'info': value._info}
+    if isinstance(value, (list, tuple)):
+        return [serialize(x) for x in value]
+    if isinstance(value, dict):
+        return dict((k, serialize(v)) for k, v in value.items())
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    return repr(value)
+
+
+def get_resources(value):
+    """
+    Returns the serialized resources in a serialized response by id, or None if the response is not a resource or a
+    list of resources
+    """
+    if isinstance(value, dict) and '__resource__' in value:
+        value = [value]
+    if not isinstance(value, list) or not all(isinstance(x, dict) and '__resource__' in x for x in value):
+        return None
+    return dict((x['info'].get('id'), x) for x in value)
+
+
+def parse_timestamp(value):
+    """
+    Returns an API timestamp such as '2015-06-01T12:00:00Z' or '2015-06-01T12:00:00.000000' as seconds since the
+    epoch, or None
+    """
+    try:
+        seconds = calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+    fraction = value[19:].rstrip('Z')
+    if fraction.startswith('.') and fraction[1:].isdigit():
+        seconds += float(fraction)
+    return seconds
+
+
+def get_timelines(entries, changes, started):
+    """
+    Returns the states of the resources in the recorded reads in entries as resource id -> (times, states), where
+    the time is the recorded point of the session from which the state is shown. A resource missing from a listing
+    is in the state None.
+
+    A state first seen in a read is shown from the update time of the resource, or halfway from the previous read of
+    the resource if there is no update time, but not before the previous read or the end of a recorded change of the
+    resource made in between.
+    """
+    timelines = {}
+    last_read = {}
+    for entry in entries:
+        resources = entry['resources']
+        if resources is None:
+            continue
+        t = entry['t']
+        resource_ids = set(resources)
+        if isinstance(entry['result'], list):
+            resource_ids.update(timelines)
+        for resource_id in resource_ids:
+            state = resources.get(resource_id)
+            times, states = timelines.setdefault(resource_id, ([], []))
+            if not states or states[-1] != state:
+                shown = t
+                if states:
+                    earliest = max([last_read[resource_id]] + [min(x['t'] + x['duration'], t)
+                                                                for x in changes.get(resource_id, []) if x['t'] < t])
+                    info = state['info'] if state else {}
+                    updated = parse_timestamp(info.get('updated') or info.get('updated_at'))
+                    shown = updated - started if updated is not None else (earliest + t) / 2
+                    shown = min(max(shown, earliest), t)
+                times.append(shown)
+                states.append(state)
+            last_read[resource_id] = t
+    return timelines
+
+
+def _strings(value):
+    if isinstance(value, basestring):
+        yield value
+    elif isinstance(value, dict):
+        for v in value.values():
+            for x in _strings(v):
+                yield x
+    elif isinstance(value, list):
+        for v in value:
+            for x in _strings(v):
+                yield x
+
+
+def get_client_layout(client):
+    """
+    Returns the class names of the managers of a client by attribute, for recreating the same call names in replay
+    """
+    layout = {}
+    for attr in dir(client):
+        if attr.startswith('_'):
+            continue
+        value = getattr(client, attr, None)
+        if hasattr(value, 'resource_class'):
+            layout[attr] = type(value).__name__
+    return layout
+
+
+class Recorder(object):
+    """
+    Writes every API call made through openstack_api_wrapper to a trace file
+    """
+
+    def __init__(self, path, nova_client, cinder_client, info=None):
+        self.path = path
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.file = open(path, 'w')
+        header = {
+            'trace': 'poutacluster-api',
+            'started': self.start,
+            'clients': {'nova': get_client_layout(nova_client), 'cinder': get_client_layout(cinder_client)},
+        }
+        header.update(info or {})
+        self._write(header)
+
+    def _write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, default=repr))
+            self.file.write('\n')
+            self.file.flush()
+
+    def call(self, service, name, func, args, kwargs):
+        entry = {'service': service, 'name': name, 'args': args_key(args, kwargs), 't': time.time() - self.start}
+        try:
+            res = func(*args, **kwargs)
+            entry['result'] = serialize(res)
+            return res
+        except Exception as e:
+            entry['error'] = {'type': type(e).__name__, 'message': str(e),
+                              'code': getattr(e, 'code', None) or getattr(e, 'http_status', None),
+                              'retry_after': getattr(e, 'retry_after', None)}
+            raise
+        finally:
+            entry['duration'] = time.time() - self.start - entry['t']
+            self._write(entry)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class ReplayApiError(Exception):
+    def __init__(self, message, code=None, retry_after=None):
+        super(ReplayApiError, self).__init__(message)
+        self.code = code
+        self.http_status = code
+        self.retry_after = retry_after
+
+
+class ReplayMethod(object):
+    """
+    Stand-in for a client or resource method. Calling it directly does nothing, the response comes from the
+    Replayer through the api_call path.
+    """
+
+    def __init__(self, owner, name):
+        self.__self__ = owner
+        self.__name__ = name
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+
+class ReplayResource(object):
+    def __init__(self, manager, info, loaded=True):
+        self.manager = manager
+        self._info = info
+        for key, value in info.items():
+            setattr(self, key, value)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return ReplayMethod(self, name)
+
+
+class ReplayManager(object):
+    resource_class = ReplayResource
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return ReplayMethod(self, name)
+
+
+class ReplayClient(object):
+    def __init__(self, service, layout):
+        self.api_service = service
+        for attr, class_name in layout.items():
+            setattr(self, attr, type(str(class_name), (ReplayManager,), {})())
+
+
+class Replayer(object):
+    """
+    Answers API calls from a recorded trace
+    """
+
+    def __init__(self, path, latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.writes = {}
+        self.reads = {}
+        self.calls = {}
+        # (replay time, recorded time) at the last replayed change, overall and by resource id
+        self.anchor = None
+        self.anchors = {}
+        # recorded start times of the changes not replayed yet by resource id
+        self.pending = {}
+        # the states of the resources in the recorded reads as (times, states) by resource id, by call and arguments
+        self.timelines = {}
+        self._classes = {}
+
+        with open(path, 'r') as f:
+            self.header = json.loads(f.readline())
+            if self.header.get('trace') != 'poutacluster-api':
+                raise RuntimeError('%s is not an API trace file' % path)
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = (entry['service'], entry['name'])
+                if entry['name'].split('.')[-1] in READ_METHODS:
+                    self.reads.setdefault(key, {}).setdefault(entry['args'], []).append(entry)
+                else:
+                    self.writes.setdefault(key, []).append(entry)
+
+        # entries are written when the calls complete, order them by start time
+        ids = set()
+        for by_args in self.reads.values():
+            for entries in by_args.values():
+                entries.sort(key=lambda x: x['t'])
+                for entry in entries:
+                    entry['resources'] = get_resources(entry.get('result'))
+                    ids.update((entry['resources'] or {}).keys())
+            # reads by any arguments are the fallback for arguments that were never recorded (e.g. timestamps)
+            by_args[None] = sorted([x for entries in by_args.values() for x in entries], key=lambda x: x['t'])
+
+        # a change refers to the resources it returns and the resources in its arguments
+        changes = {}
+        for queue in self.writes.values():
+            queue.sort(key=lambda x: x['t'])
+            for entry in queue:
+                refs = set((get_resources(entry.get('result')) or {}).keys())
+                refs.update(x for x in _strings(json.loads(entry['args'])) if x in ids)
+                entry['refs'] = refs
+                for ref in refs:
+                    self.pending.setdefault(ref, []).append(entry['t'])
+                    changes.setdefault(ref, []).append(entry)
+        for times in self.pending.values():
+            times.sort()
+
+        for key, by_args in self.reads.items():
+            for arg_key, entries in by_args.items():
+                self.timelines[(key, arg_key)] = get_timelines(entries, changes, self.header['started'])
+
+    def get_clients(self):
+        clients = self.header['clients']
+        return ReplayClient('nova', clients['nova']), ReplayClient('cinder', clients['cinder'])
+
+    def get_call_counts(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def _recorded_time(self, now, resource_id=None):
+        """
+        Returns the point of the recorded session that corresponds to the replay time now, for the given resource
+        or overall
+        """
+        anchor_now, anchor_t = self.anchors.get(resource_id, self.anchor)
+        t = anchor_t + (now - anchor_now) / self.latency_scale if self.latency_scale else float('inf')
+        pending = self.pending.get(resource_id)
+        if pending:
+            t = min(t, pending[0])
+        return t
+
+    def _find_read(self, key, arg_key, now):
+        by_args = self.reads.get(key)
+        if not by_args:
+            return None
+        if arg_key not in by_args:
+            arg_key = None
+        entries = by_args[arg_key]
+        timelines = self.timelines[(key, arg_key)]
+        times = [x['t'] for x in entries]
+        # the last response recorded at or before the current point of the session, or the first one
+        index = max(1, bisect.bisect_right(times, self._recorded_time(now)))
+        entry = entries[index - 1]
+        if entry['resources'] is None:
+            return entry
+
+        # rebuild the response from the state of each resource at its own point of the session
+        result = []
+        seen = set()
+        for candidate in reversed(entries[:index]):
+            for resource_id in (candidate['resources'] or {}):
+                if resource_id in seen:
+                    continue
+                seen.add(resource_id)
+                times, states = timelines[resource_id]
+                # the states shown from before the current point, a state shown from the previous read of the
+                # resource is not visible at that read itself
+                at = bisect.bisect_left(times, self._recorded_time(now, resource_id))
+                resource = states[max(0, at - 1)]
+                if resource:
+                    result.append(resource)
+            if isinstance(entry['result'], dict):
+                break
+        result.sort(key=lambda x: x['info'].get('id'))
+        if isinstance(entry['result'], dict):
+            result = result[0] if result else entry['result']
+        return {'duration': entry['duration'], 'result': result}
+
+    def _find_write(self, key, arg_key, now):
+        queue = self.writes.get(key)
+        if not queue:
+            return None
+        entry = queue[0]
+        for i, candidate in enumerate(queue):
+            if candidate['args'] == arg_key:
+                entry = queue.pop(i)
+                break
+        else:
+            queue.pop(0)
+        recorded_end = entry['t'] + entry['duration']
+        self.anchor = (now, max(self._recorded_time(now), recorded_end))
+        for ref in entry['refs']:
+            anchor_t = max(self._recorded_time(now, ref), recorded_end) if ref in self.anchors else recorded_end
+            self.pending[ref].remove(entry['t'])
+            self.anchors[ref] = (now, anchor_t)
+        return entry
+
+    def _to_object(self, value):
+        if isinstance(value, list):
+            return [self._to_object(x) for x in value]
+        if isinstance(value, dict):
+            if '__resource__' in value:
+                class_name = str(value['__resource__'])
+                if class_name not in self._classes:
+                    self._classes[class_name] = type(class_name, (ReplayResource,), {})
+                return self._classes[class_name](None, dict(value['info']))
+            return dict((k, self._to_object(v)) for k, v in value.items())
+        return value
+
+    def call(self, service, name, func, args, kwargs):
+        key = (service, name)
+        arg_key = args_key(args, kwargs)
+        with self.lock:
+            now = time.time()
+            if self.anchor is None:
+                # the session starts with the first call
+                self.anchor = (now, 0.0)
+            self.calls['%s %s' % key] = self.calls.get('%s %s' % key, 0) + 1
+            if name.split('.')[-1] in READ_METHODS:
+                entry = self._find_read(key, arg_key, now)
+            else:
+                entry = self._find_write(key, arg_key, now)
+        if entry is None:
+            raise RuntimeError('No recorded response left for %s %s' % key)
+
+        time.sleep(entry['duration'] * self.latency_scale)
+        if 'error' in entry:
+            error = entry['error']
+            error_class = type(str(error['type']), (ReplayApiError,), {})
+            raise error_class(error['message'], error.get('code'), error.get('retry_after'))
+        return self._to_object(entry['result'])
+
+
+def start_recording(path, nova_client, cinder_client, info=None):
+    set_session(Recorder(path, nova_client, cinder_client, info))
+
+
+def start_replay(path, latency_scale=1.0):
+    """
+    Starts replaying the trace in path and returns the replay nova and cinder clients
+    """
+    replayer = Replayer(path, latency_scale)
+    set_session(replayer)
+    return replayer.get_clients()
+
+
+def stop():
+    session = get_session()
+    set_session(None)
+    if isinstance(session, Recorder):
+        session.close()
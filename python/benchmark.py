@@ -0,0 +1,275 @@
+"""
+Benchmarks the provisioning commands against the in-process fake cloud (see fake_openstack) and reports the wall
+clock time and the number of nova and cinder API calls of each command for each cluster size.
+
+Example:
+
+    python benchmark.py --sizes 10,100,500 --parallel 16 --fake-cloud 'latency=0.02,boot_time=5'
+
+Results can be saved with '--save results.json' and compared against earlier results with
+'--compare results.json', which exits with an error if any command got slower or makes more API calls.
+
+A session recorded with 'poutacluster --record trace.jsonl ...' can be replayed instead of using the fake cloud,
+with the original or scaled latency and optionally a different number of parallel workers:
+
+    python benchmark.py --replay trace.jsonl --latency-scale 0.1 --parallel 16
+
+The replay itself is checked with '--check-replay', which records 'up' against the fake cloud, replays the trace
+with the recorded latency and workers and exits with an error if the replay does not take the recorded time.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import openstack_api_wrapper as oaw
+import fake_openstack
+import api_recorder
+from poutacluster import Cluster
+
+# the fake cloud runs in real time, so poll much more often than against a real cloud
+BENCH_POLL_INTERVAL = 0.1
+
+# allowed slowdown of the wall clock time against a baseline before it is reported as a regression
+TIME_TOLERANCE = 0.25
+
+
+def make_config(name, network, volumes=True):
+    config = {
+        'cluster': {
+            'name': name,
+            'description': 'provisioning benchmark',
+            'network': network,
+            'ext-secgroup-rules': ['tcp 22 22 0.0.0.0/0'],
+        },
+        'frontend': {
+            'sec-key': 'cluster-key',
+            'image': 'CentOS-6.6',
+            'admin-user': 'cloud-user',
+            'flavor': 'mini',
+            'public-ip': 'auto',
+            'groups': ['common', 'cluster_master', 'ge_master'],
+        },
+        'node': {
+            'sec-key': 'cluster-key',
+            'image': 'CentOS-6.6',
+            'admin-user': 'cloud-user',
+            'flavor': 'mini',
+            'groups': ['common', 'cluster_slave', 'ge_slave'],
+        },
+    }
+    if volumes:
+        config['frontend']['volumes'] = [{'name': 'local_data', 'size': 10}, {'name': 'shared_data', 'size': 10}]
+        config['node']['volumes'] = [{'name': 'local_data', 'size': 10}]
+    return config
+
+
+def use_fast_polling(nova_client, cinder_client, interval, max_interval=None):
+    for client in nova_client, cinder_client:
+        oaw.set_state_watcher(client, oaw.StateWatcher(client, poll_interval=interval,
+                                                       max_poll_interval=max_interval or interval * 4))
+    oaw.WAKEUP_DELAY = interval / 4
+    oaw.POLL_INTERVAL = interval
+
+
+def count_calls(counts, service):
+    return sum(v for k, v in counts.items() if k.startswith(service + ' '))
+
+
+def measure(results, size, command, cloud, verbose, func, *args, **kwargs):
+    before = cloud.get_call_counts()
+    orig_stdout = sys.stdout
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        func(*args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        if not verbose:
+            sys.stdout.close()
+            sys.stdout = orig_stdout
+    after = cloud.get_call_counts()
+    calls = dict((k, after[k] - before.get(k, 0)) for k in after if after[k] != before.get(k, 0))
+    res = {'size': size, 'command': command, 'seconds': elapsed,
+           'nova': count_calls(calls, 'nova'), 'cinder': count_calls(calls, 'cinder')}
+    results.append(res)
+    print '%-24s %6d %9.2f %7d %7d' % (command, size, elapsed, res['nova'], res['cinder'])
+    sys.stdout.flush()
+
+
+def run_benchmark(size, parallel, batch_size, fake_cloud, volumes, verbose):
+    nova_client, cinder_client = fake_openstack.get_clients(fake_cloud)
+    cloud = nova_client.cloud
+    use_fast_polling(nova_client, cinder_client, BENCH_POLL_INTERVAL)
+    oaw.configure_catalog()
+
+    config = make_config('bench%d' % size, cloud.networks[0]['label'], volumes)
+    cluster = Cluster(config, nova_client, cinder_client)
+    results = []
+    measure(results, size, 'load (empty)', cloud, verbose, cluster.load_provisioned_state)
+    measure(results, size, 'up', cloud, verbose, cluster.up, size, parallel=parallel, batch_size=batch_size)
+    measure(results, size, 'load', cloud, verbose, cluster.load_provisioned_state)
+    measure(results, size, 'inventory', cloud, verbose, cluster.generate_ansible_inventory)
+    measure(results, size, 'down', cloud, verbose, cluster.down, clean_shutdown=False, parallel=parallel)
+    measure(results, size, 'load (volumes only)', cloud, verbose, cluster.load_provisioned_state)
+    if volumes:
+        measure(results, size, 'destroy_volumes', cloud, verbose, cluster.destroy_volumes, grace_time=0)
+    measure(results, size, 'cleanup', cloud, verbose, cluster.cleanup)
+    return results
+
+
+def run_replay(path, parallel, batch_size, latency_scale, verbose):
+    """
+    Replays the command of a recorded session, optionally with a different number of workers and batch size
+    """
+    nova_client, cinder_client = api_recorder.start_replay(path, latency_scale)
+    replayer = api_recorder.get_session()
+    header = replayer.header
+    command = header.get('command', {})
+    if header.get('tenant'):
+        os.environ.setdefault('OS_TENANT_NAME', header['tenant'])
+
+    # the state of the resources advances at the scaled pace of the recording, so poll at the scaled recorded pace
+    poll_interval, max_poll_interval = header.get('polling', [oaw.POLL_INTERVAL, oaw.MAX_POLL_INTERVAL])
+    use_fast_polling(nova_client, cinder_client, poll_interval * latency_scale, max_poll_interval * latency_scale)
+    oaw.configure_catalog()
+
+    cluster = Cluster(header['config'], nova_client, cinder_client)
+    name = command.get('command', 'load')
+    if parallel is None:
+        parallel = command.get('parallel') or 1
+    results = []
+    try:
+        measure(results, 0, 'load', replayer, verbose, cluster.load_provisioned_state)
+        if name == 'up':
+            measure(results, command['num_nodes'], 'up', replayer, verbose, cluster.up, command['num_nodes'],
+                    parallel=parallel, batch_size=batch_size or command.get('batch_size') or 1)
+        elif name in ('down', 'wipe'):
+            measure(results, len(cluster.nodes), 'down', replayer, verbose, cluster.down,
+                    clean_shutdown=(name == 'down' and not command.get('unclean')), parallel=parallel)
+        elif name == 'destroy_volumes':
+            measure(results, len(cluster.volumes), 'destroy_volumes', replayer, verbose, cluster.destroy_volumes,
+                    grace_time=0)
+    finally:
+        api_recorder.stop()
+    return results
+
+
+def check_replay(size, parallel, fake_cloud, verbose):
+    """
+    Records 'up' against the fake cloud and replays it with the recorded latency and workers. Returns the results
+    of both and lines describing the difference if the replay is not within TIME_TOLERANCE of the recorded time.
+    """
+    nova_client, cinder_client = fake_openstack.get_clients(fake_cloud)
+    cloud = nova_client.cloud
+    use_fast_polling(nova_client, cinder_client, BENCH_POLL_INTERVAL)
+    watcher = oaw.get_state_watcher(nova_client)
+    config = make_config('replay%d' % size, cloud.networks[0]['label'])
+
+    fd, path = tempfile.mkstemp(prefix='benchmark-', suffix='.jsonl')
+    os.close(fd)
+    results = []
+    try:
+        api_recorder.start_recording(path, nova_client, cinder_client, {
+            'command': {'command': 'up', 'num_nodes': size, 'parallel': parallel}, 'config': config,
+            'polling': [watcher.poll_interval, watcher.max_poll_interval]})
+        try:
+            # the catalog listings have to be in the trace
+            oaw.configure_catalog()
+            cluster = Cluster(config, nova_client, cinder_client)
+            measure(results, size, 'load (recorded)', cloud, verbose, cluster.load_provisioned_state)
+            measure(results, size, 'up (recorded)', cloud, verbose, cluster.up, size, parallel=parallel)
+        finally:
+            api_recorder.stop()
+        results.extend(run_replay(path, parallel, None, 1.0, verbose))
+    finally:
+        os.remove(path)
+
+    recorded, replayed = results[1]['seconds'], results[-1]['seconds']
+    if abs(replayed - recorded) > recorded * TIME_TOLERANCE and abs(replayed - recorded) > 0.5:
+        return results, ['up %d: recorded in %.2f s, replayed in %.2f s' % (size, recorded, replayed)]
+    return results, []
+
+
+def compare(results, baseline):
+    """
+    Returns lines describing the regressions of results against baseline
+    """
+    base = dict(((x['size'], x['command']), x) for x in baseline)
+    regressions = []
+    for res in results:
+        old = base.get((res['size'], res['command']))
+        if not old:
+            continue
+        for service in 'nova', 'cinder':
+            if res[service] > old[service]:
+                regressions.append('%s %d: %s API calls %d -> %d' % (
+                    res['command'], res['size'], service, old[service], res[service]))
+        if res['seconds'] > old['seconds'] * (1 + TIME_TOLERANCE) and res['seconds'] - old['seconds'] > 0.5:
+            regressions.append('%s %d: wall clock %.2f s -> %.2f s' % (
+                res['command'], res['size'], old['seconds'], res['seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark provisioning against an in-process fake cloud')
+    parser.add_argument('--sizes', default='10,50', help='comma separated list of cluster sizes (nodes)')
+    parser.add_argument('--parallel', metavar='N', type=int, default=None,
+                        help='number of parallel workers (default: 8, or as recorded with --replay)')
+    parser.add_argument('--batch-size', metavar='N', type=int, default=None,
+                        help='nodes booted per API request (default: 1, or as recorded with --replay)')
+    parser.add_argument('--fake-cloud', metavar='SETTINGS', default='',
+                        help='fake cloud settings, e.g. "latency=0.05,boot_time=5" (see fake_openstack.DEFAULTS)')
+    parser.add_argument('--no-volumes', action='store_true', help='provision the clusters without volumes')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the commands')
+    parser.add_argument('--save', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results against earlier saved results')
+    parser.add_argument('--replay', metavar='FILE', help='replay a session recorded with poutacluster --record')
+    parser.add_argument('--latency-scale', metavar='X', type=float, default=1.0,
+                        help='multiplier for the recorded call latencies and state changes in replay')
+    parser.add_argument('--check-replay', action='store_true',
+                        help='check that replaying a recording of "up" with the first size takes the recorded time')
+    args = parser.parse_args()
+
+    print '%-24s %6s %9s %7s %7s' % ('command', 'nodes', 'seconds', 'nova', 'cinder')
+    results = []
+    if args.check_replay:
+        check_results, differences = check_replay(int(args.sizes.split(',')[0]), args.parallel or 8,
+                                                  args.fake_cloud, args.verbose)
+        results.extend(check_results)
+        if differences:
+            print
+            print 'Replay does not take the recorded time:'
+            for line in differences:
+                print '    %s' % line
+            sys.exit(1)
+        print 'Replay takes the recorded time'
+    elif args.replay:
+        results.extend(run_replay(args.replay, args.parallel, args.batch_size, args.latency_scale, args.verbose))
+    else:
+        for size in [int(x) for x in args.sizes.split(',')]:
+            results.extend(run_benchmark(size, args.parallel or 8, args.batch_size or 1, args.fake_cloud,
+                                         not args.no_volumes, args.verbose))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print 'Results saved to %s' % args.save
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f))
+        if regressions:
+            print
+            print 'Regressions against %s:' % args.compare
+            for line in regressions:
+                print '    %s' % line
+            sys.exit(1)
+        print 'No regressions against %s' % args.compare
+
+
+if __name__ == '__main__':
+    main()
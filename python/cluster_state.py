@@ -0,0 +1,159 @@
+"""
+Local store of the servers and volumes of a cluster, kept up to date from the provisioning events of the commands
+and from incremental listings, so that commands do not have to list the whole tenant every time
+"""
+
+import os
+import json
+import time
+import datetime
+import threading
+import openstack_api_wrapper as oaw
+
+STATE_FILE = 'cluster-state.json'
+
+# the stored state is reconciled with a full listing when it is older than this (in seconds)
+STATE_TTL = 24 * 3600
+
+# changes-since queries start this much (in seconds) before the last sync to cover clock skew with the API servers
+CLOCK_SKEW_MARGIN = 300
+
+STABLE_VOLUME_STATES = ['available', 'in-use', 'error']
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class ClusterStateStore(object):
+    """
+    Records of the servers and volumes belonging to a cluster, saved as JSON in the cluster directory.
+
+    Servers are refreshed incrementally with changes-since queries. Volumes have no such query in the cinder API, so
+    they are listed again only when a command has created or deleted volumes or some stored volume is still in a
+    transitional state.
+    """
+
+    def __init__(self, cluster_name, path=STATE_FILE, ttl=STATE_TTL):
+        self.cluster_name = cluster_name
+        self.path = path
+        self.ttl = ttl
+        self.servers = {}
+        self.volumes = {}
+        self.synced_at = None
+        self.reconciled_at = None
+        self.volumes_dirty = False
+        self.lock = threading.RLock()
+        self._load()
+
+    @staticmethod
+    def _owner():
+        return {'tenant': os.environ.get('OS_TENANT_NAME'), 'auth_url': os.environ.get('OS_AUTH_URL')}
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            print 'WARN: ignoring unreadable cluster state file %s' % self.path
+            return
+        if data.get('owner') != self._owner() or data.get('cluster') != self.cluster_name:
+            return
+
+        self.servers = data.get('servers', {})
+        self.volumes = data.get('volumes', {})
+        self.synced_at = data.get('synced_at')
+        self.reconciled_at = data.get('reconciled_at')
+        self.volumes_dirty = data.get('volumes_dirty', False)
+
+    def save(self):
+        with self.lock:
+            data = {
+                'owner': self._owner(),
+                'cluster': self.cluster_name,
+                'servers': self.servers,
+                'volumes': self.volumes,
+                'synced_at': self.synced_at,
+                'reconciled_at': self.reconciled_at,
+                'volumes_dirty': self.volumes_dirty,
+            }
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp_path, self.path)
+
+    def is_valid(self):
+        return self.reconciled_at is not None and time.time() - self.reconciled_at < self.ttl
+
+    @staticmethod
+    def timestamp():
+        return datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+
+    def _belongs_to_cluster(self, name):
+        return name and name.startswith('%s-' % self.cluster_name)
+
+    def _set_volumes(self, volumes):
+        self.volumes = dict((vol.id, vol._info) for vol in volumes
+                            if self._belongs_to_cluster(vol.display_name) and '/' in vol.display_name)
+        self.volumes_dirty = False
+
+    def replace(self, servers, volumes, started_at):
+        """
+        Replaces the stored state with full listings of the cluster servers and (tenant) volumes, started at the
+        given UTC timestamp
+        """
+        with self.lock:
+            self.servers = dict((vm.id, vm._info) for vm in servers)
+            self._set_volumes(volumes)
+            self.synced_at = started_at
+            self.reconciled_at = time.time()
+            self.save()
+
+    def record_event(self, action, resource_type, resource_id):
+        """
+        Updates the store from a provisioning event. Deletions are applied directly, created resources are picked up
+        by the next refresh. The store is saved right away so that an interrupted command still leaves a hint
+        for the next one.
+        """
+        with self.lock:
+            if resource_type == 'vm':
+                if action == 'delete':
+                    self.servers.pop(resource_id, None)
+            elif resource_type == 'volume':
+                if action == 'delete':
+                    self.volumes.pop(resource_id, None)
+                self.volumes_dirty = True
+            else:
+                return
+            self.save()
+
+    def refresh(self, nova_client, cinder_client):
+        """
+        Brings the store up to date with a changes-since listing of the cluster servers and, if needed, a listing
+        of the volumes
+        """
+        with self.lock:
+            started_at = self.timestamp()
+            since = datetime.datetime.strptime(self.synced_at, TIMESTAMP_FORMAT) - \
+                datetime.timedelta(seconds=CLOCK_SKEW_MARGIN)
+            changed = oaw.list_servers_changed_since(
+                nova_client, '^%s-' % self.cluster_name, since.strftime(TIMESTAMP_FORMAT))
+            for vm in changed:
+                if vm.status.lower() in ['deleted', 'soft_deleted']:
+                    self.servers.pop(vm.id, None)
+                else:
+                    self.servers[vm.id] = vm._info
+
+            if self.volumes_dirty or \
+                    [v for v in self.volumes.values() if v.get('status') not in STABLE_VOLUME_STATES]:
+                self._set_volumes(oaw.api_call('cinder', cinder_client.volumes.list))
+
+            self.synced_at = started_at
+            self.save()
+
+    def get_servers(self, nova_client):
+        manager = nova_client.servers
+        return [manager.resource_class(manager, info, loaded=True) for info in self.servers.values()]
+
+    def get_volumes(self, cinder_client):
+        manager = cinder_client.volumes
+        return [manager.resource_class(manager, info, loaded=True) for info in self.volumes.values()]
@@ -0,0 +1,209 @@
+"""
+Live view of the VMs, volumes and floating IPs of a cluster. Every refresh makes one server listing and one volume
+listing, floating IPs are taken from the server addresses and flavor names from the catalog, so the view can be
+left running while a large cluster is being provisioned. Only the lines that have changed since the previous
+refresh are written out.
+"""
+
+import re
+import sys
+import time
+import struct
+import openstack_api_wrapper as oaw
+
+# default time between refreshes in seconds
+WATCH_INTERVAL = 5
+
+# number of lines shown when the terminal size is unknown
+DEFAULT_TERMINAL_LINES = 24
+
+VM_STEADY_STATES = ['ACTIVE', 'SHUTOFF']
+VOLUME_STEADY_STATES = ['in-use', 'available']
+
+
+def get_terminal_lines(stream):
+    try:
+        import fcntl
+        import termios
+        lines = struct.unpack('hh', fcntl.ioctl(stream.fileno(), termios.TIOCGWINSZ, '1234'))[0]
+        return lines or DEFAULT_TERMINAL_LINES
+    except Exception:
+        return DEFAULT_TERMINAL_LINES
+
+
+def count_states(states):
+    """
+    Returns 'state count' pairs for a list of states, most common first
+    """
+    counts = {}
+    for state in states:
+        counts[state] = counts.get(state, 0) + 1
+    return ', '.join('%s %d' % x for x in sorted(counts.items(), key=lambda x: (-x[1], x[0]))) or 'none'
+
+
+class ClusterWatch(object):
+    """
+    Periodically lists the resources of the cluster and writes the changes to a table on stream
+    """
+
+    ROW_TEMPLATE = '%-24s %-16s %-15s %-15s %-12s %s'
+
+    def __init__(self, cluster_name, nova_client, cinder_client, stream=sys.stdout):
+        self.cluster_name = cluster_name
+        self.nova_client = nova_client
+        self.cinder_client = cinder_client
+        self.stream = stream
+        self.interactive = hasattr(stream, 'isatty') and stream.isatty()
+        self._flavor_names = {}
+        # the VM names of the cluster, as in Cluster.__set_state(): the frontend, the nodes and the bake node
+        self._name_re = re.compile('%s-(fe|node\d{2,}|bake)$' % re.escape(cluster_name))
+        self._previous_lines = None
+        self._previous_rows = None
+
+    def _flavor_name(self, vm):
+        flavor_id = (vm.flavor or {}).get('id')
+        if flavor_id not in self._flavor_names:
+            self._flavor_names[flavor_id] = oaw.find_flavor_name_by_id(self.nova_client, flavor_id)
+        return self._flavor_names[flavor_id]
+
+    def poll(self):
+        """
+        Lists the servers and volumes of the cluster, returns them as (servers, volumes)
+        """
+        servers = [x for x in oaw.list_servers_by_name(self.nova_client, '^%s-' % self.cluster_name)
+                   if self._name_re.match(x.name) and x.status not in ['DELETED', 'SOFT_DELETED']]
+        # volumes are named <VM name>/<volume name>, also the ones left from deleted nodes are shown
+        volumes = [x for x in oaw.api_call('cinder', self.cinder_client.volumes.list)
+                   if x.display_name and '/' in x.display_name
+                   and self._name_re.match(x.display_name.split('/', 1)[0])]
+        return servers, volumes
+
+    def get_rows(self, servers, volumes):
+        """
+        Returns the rows of the table as a dict of VM name -> (steady, cells), the volumes are shown on the row of
+        the VM they belong to
+        """
+        vols_by_vm_name = {}
+        for vol in volumes:
+            vm_name, vol_name = vol.display_name.split('/', 1)
+            vols_by_vm_name.setdefault(vm_name, []).append((vol_name, vol.status))
+
+        rows = {}
+        for vm in servers:
+            status = vm.status
+            task_state = getattr(vm, 'OS-EXT-STS:task_state', None)
+            if task_state:
+                status = '%s/%s' % (status, task_state)
+            fixed_ips = oaw.get_addresses(vm)
+            floating_ips = oaw.get_addresses(vm, 'floating')
+            vols = sorted(vols_by_vm_name.pop(vm.name, []))
+            steady = not task_state and vm.status in VM_STEADY_STATES and \
+                not [x for x in vols if x[1] not in VOLUME_STEADY_STATES]
+            rows[vm.name] = (steady, (vm.name, status, fixed_ips[0] if fixed_ips else '-',
+                                      floating_ips[0] if floating_ips else '-', self._flavor_name(vm),
+                                      ' '.join('%s:%s' % x for x in vols)))
+
+        # volumes whose VM does not exist (anymore)
+        for vm_name, vols in vols_by_vm_name.items():
+            vols = sorted(vols)
+            steady = not [x for x in vols if x[1] not in VOLUME_STEADY_STATES]
+            rows[vm_name] = (steady, (vm_name, '-', '-', '-', '-', ' '.join('%s:%s' % x for x in vols)))
+
+        return rows
+
+    def get_counters(self, servers, volumes):
+        num_fips = len([x for x in servers if oaw.get_addresses(x, 'floating')])
+        return [
+            'servers:      %s' % count_states(x.status for x in servers),
+            'volumes:      %s' % count_states(x.status for x in volumes),
+            'floating IPs: %d associated' % num_fips,
+        ]
+
+    def get_lines(self, servers, volumes, max_lines=None):
+        """
+        Returns the lines of the whole view. With max_lines, the VMs that are still changing state are shown first
+        and the rest are left out when they do not fit.
+        """
+        rows = self.get_rows(servers, volumes)
+        lines = ['Cluster %s at %s' % (self.cluster_name, time.strftime('%H:%M:%S'))]
+        lines.extend(self.get_counters(servers, volumes))
+        lines.append('')
+        lines.append(self.ROW_TEMPLATE % ('name', 'status', 'internal ip', 'public ip', 'flavor', 'volumes'))
+
+        names = sorted(rows.keys())
+        if max_lines and len(lines) + len(names) > max_lines:
+            names = [x for x in names if not rows[x][0]] + [x for x in names if rows[x][0]]
+            num_shown = max(max_lines - len(lines) - 1, 0)
+            hidden = len(names) - num_shown
+            names = sorted(names[:num_shown])
+            lines.extend(self.ROW_TEMPLATE % rows[x][1] for x in names)
+            lines.append('... %d more in a steady state' % hidden)
+        else:
+            lines.extend(self.ROW_TEMPLATE % rows[x][1] for x in names)
+        return lines
+
+    def _render_terminal(self, lines):
+        """
+        Rewrites only the lines of the screen that differ from the previous refresh
+        """
+        out = []
+        previous = self._previous_lines
+        if previous is None:
+            # home the cursor and clear the screen
+            out.append('\033[H\033[2J')
+            previous = []
+        for i, line in enumerate(lines):
+            if i >= len(previous) or previous[i] != line:
+                out.append('\033[%d;1H%s\033[K' % (i + 1, line))
+        if len(lines) < len(previous):
+            out.append('\033[%d;1H\033[J' % (len(lines) + 1))
+        # park the cursor below the table
+        out.append('\033[%d;1H' % (len(lines) + 1))
+        self.stream.write(''.join(out))
+        self.stream.flush()
+        self._previous_lines = lines
+
+    def _render_changes(self, servers, volumes):
+        """
+        Writes the counters and the rows that have changed since the previous refresh, for output that is not a
+        terminal
+        """
+        rows = dict((name, self.ROW_TEMPLATE % x[1]) for name, x in self.get_rows(servers, volumes).items())
+        previous = self._previous_rows or {}
+        changed = [rows[x] for x in sorted(rows.keys()) if previous.get(x) != rows[x]]
+        gone = [x for x in sorted(previous.keys()) if x not in rows]
+        if self._previous_rows is None or changed or gone:
+            self.stream.write('%s\n' % time.strftime('%H:%M:%S'))
+            for line in self.get_counters(servers, volumes):
+                self.stream.write('    %s\n' % line)
+            for line in changed:
+                self.stream.write('    %s\n' % line)
+            for name in gone:
+                self.stream.write('    %s deleted\n' % name)
+            self.stream.flush()
+        self._previous_rows = rows
+
+    def refresh(self):
+        servers, volumes = self.poll()
+        if self.interactive:
+            lines = self.get_lines(servers, volumes, get_terminal_lines(self.stream) - 1)
+            self._render_terminal(lines)
+        else:
+            self._render_changes(servers, volumes)
+
+    def run(self, interval=WATCH_INTERVAL, once=False):
+        """
+        Refreshes the view every interval seconds until interrupted, or only once
+        """
+        if once:
+            servers, volumes = self.poll()
+            for line in self.get_lines(servers, volumes):
+                self.stream.write('%s\n' % line)
+            return
+        try:
+            while True:
+                start = time.time()
+                self.refresh()
+                time.sleep(max(interval - (time.time() - start), 0))
+        except KeyboardInterrupt:
+            self.stream.write('\n')
@@ -0,0 +1,137 @@
+"""
+Fingerprints of the inputs that determine the ansible configuration of each host, used for skipping the hosts
+that have already been configured with the same inputs
+"""
+
+import os
+import json
+import hashlib
+
+PLAYBOOK_DIR = '../ansible/playbooks'
+FINGERPRINT_FILE = 'ansible-fingerprints.json'
+
+
+def hash_playbooks(playbook_dir=PLAYBOOK_DIR):
+    """
+    Hashes the names and contents of all the files (playbooks, tasks, templates, modules) under playbook_dir
+    """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(playbook_dir):
+        dirs.sort()
+        for fn in sorted(files):
+            if fn.endswith(('.pyc', '.retry', '~')):
+                continue
+            path = os.path.join(root, fn)
+            digest.update(os.path.relpath(path, playbook_dir))
+            digest.update('\0')
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+            digest.update('\0')
+    return digest.hexdigest()
+
+
+def parse_inventory(lines):
+    """
+    Parses ansible inventory lines in INI format and returns a dict of host name ->
+    {'line': host line, 'groups': sorted group names, 'vars': dict of group variables}.
+
+    Groups include the parent groups defined in [group:children] sections, variables are collected from the
+    [group:vars] sections of all the groups of the host.
+    """
+    host_lines = {}
+    members = {}
+    children = {}
+    group_vars = {}
+
+    section = None
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#') or line.startswith(';'):
+            continue
+        if line.startswith('['):
+            section = line.strip('[]')
+            continue
+        if section is None:
+            continue
+        if section.endswith(':vars'):
+            key, _, value = line.partition('=')
+            group_vars.setdefault(section[:-len(':vars')], {})[key.strip()] = value.strip()
+        elif section.endswith(':children'):
+            children.setdefault(section[:-len(':children')], set()).add(line)
+        else:
+            host = line.split()[0]
+            host_lines[host] = line
+            members.setdefault(section, set()).add(host)
+
+    def groups_of(host):
+        groups = set(g for g, hosts in members.items() if host in hosts)
+        # add the parent groups until no new ones are found
+        while True:
+            parents = set(p for p, kids in children.items() if kids & groups) - groups
+            if not parents:
+                return groups
+            groups |= parents
+
+    res = {}
+    for host, line in host_lines.items():
+        groups = groups_of(host)
+        # 'all' is implicitly a parent of every group
+        host_vars = dict(group_vars.get('all', {}))
+        for group in sorted(groups - set(['all'])):
+            host_vars.update(group_vars.get(group, {}))
+        res[host] = dict(line=line, groups=sorted(groups), vars=host_vars)
+    return res
+
+
+def compute_fingerprints(inventory_lines, playbook_hash, host_ids=None):
+    """
+    Computes a fingerprint for each host in the inventory from its own inventory line, groups and variables, the
+    list of all the hosts in the cluster (host files, exports and queue configuration depend on it), the
+    playbook hash and, if given in host_ids, the id of the VM so that a recreated VM is always configured.
+    """
+    hosts = parse_inventory(inventory_lines)
+    membership = sorted(h['line'] for h in hosts.values())
+    host_ids = host_ids or {}
+
+    res = {}
+    for name, host in hosts.items():
+        inputs = dict(host, membership=membership, playbooks=playbook_hash, vm_id=host_ids.get(name))
+        res[name] = hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+    return res
+
+
+def load_fingerprints(path=FINGERPRINT_FILE):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        print 'WARN: ignoring unreadable fingerprint file %s' % path
+        return {}
+
+
+def save_fingerprints(fingerprints, path=FINGERPRINT_FILE):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(fingerprints, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def get_changed_hosts(current, stored):
+    """
+    Returns the sorted names of the hosts whose current fingerprint does not match the stored one
+    """
+    return sorted(h for h, fp in current.items() if stored.get(h) != fp)
+
+
+def record_configured_hosts(current, hosts, path=FINGERPRINT_FILE):
+    """
+    Stores the current fingerprints of the given successfully configured hosts, dropping the hosts that are no
+    longer part of the cluster
+    """
+    stored = load_fingerprints(path)
+    fingerprints = dict((h, fp) for h, fp in stored.items() if h in current)
+    for host in hosts:
+        fingerprints[host] = current[host]
+    save_fingerprints(fingerprints, path)
@@ -0,0 +1,91 @@
+"""
+Ansible fact cache of the cluster, seeded with the facts that are already known from OpenStack (address and network
+of the host, number of CPUs of the flavor). The playbooks gather facts only from hosts that are missing some, and
+the gathered facts are kept in the cache for the following runs until the host is recreated.
+
+The cache is a directory with one JSON file of facts per host, in the format of the ansible jsonfile cache plugin.
+"""
+
+import os
+import json
+import socket
+import struct
+
+FACT_CACHE_DIR = 'ansible-facts'
+
+# cached facts are dropped by poutacluster when a host is recreated, ansible should not expire them on its own
+FACT_CACHE_TIMEOUT = 30 * 24 * 3600
+
+# the id of the VM the facts were collected from, stored with the facts
+VM_ID_FACT = 'poutacluster_vm_id'
+
+
+def get_network(address, cidr):
+    """
+    Returns the network address and the netmask of address in the network cidr (e.g. '192.168.1.0/24')
+    """
+    prefix = int(cidr.split('/')[1])
+    mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+    network = struct.unpack('>I', socket.inet_aton(address))[0] & mask
+    return socket.inet_ntoa(struct.pack('>I', network)), socket.inet_ntoa(struct.pack('>I', mask))
+
+
+def get_provider_facts(address, cidr=None, flavor=None):
+    """
+    Returns the ansible facts that can be derived from the fixed address of a host, the cidr of its network and its
+    flavor. Nova exposes every vCPU as a separate socket, so the processor count equals the vCPUs.
+    """
+    facts = {}
+    if cidr:
+        network, netmask = get_network(address, cidr)
+        facts['ansible_default_ipv4'] = {'address': address, 'network': network, 'netmask': netmask}
+    if flavor and flavor.get('vcpus'):
+        facts['ansible_processor_vcpus'] = flavor['vcpus']
+        facts['ansible_processor_count'] = flavor['vcpus']
+    return facts
+
+
+def load_facts(name, path=FACT_CACHE_DIR):
+    cache_file = os.path.join(path, name)
+    if not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def seed_fact_cache(hosts, path=FACT_CACHE_DIR):
+    """
+    Updates the fact cache from hosts, a dict of host name -> (VM id, facts). Facts of hosts that are not in the
+    cluster anymore or whose VM has been recreated are dropped. Returns the names of the hosts that have only
+    the seeded facts, i.e. from which the playbooks will gather facts.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    for name in os.listdir(path):
+        if not name.startswith('.') and name not in hosts:
+            os.remove(os.path.join(path, name))
+
+    missing = []
+    for name, (vm_id, facts) in sorted(hosts.items()):
+        cached = load_facts(name, path)
+        if cached.get(VM_ID_FACT) != vm_id:
+            cached = {}
+        seeded = dict(cached)
+        seeded.update(facts)
+        seeded[VM_ID_FACT] = vm_id
+        if 'ansible_distribution' not in seeded:
+            missing.append(name)
+        if seeded == cached:
+            continue
+        # ansible skips dot files in the cache directory
+        tmp_file = os.path.join(path, '.%s.tmp' % name)
+        with open(tmp_file, 'w') as f:
+            json.dump(seeded, f, sort_keys=True, indent=4)
+        os.rename(tmp_file, os.path.join(path, name))
+
+    return missing
+
@@ -0,0 +1,587 @@
+"""
+In-process fake of the parts of the nova and cinder client APIs that openstack_api_wrapper uses, for measuring
+provisioning at scale without burning real quota.
+
+get_clients() in openstack_api_wrapper returns fake clients when OS_FAKE_CLOUD is set. The value is a comma
+separated list of FakeCloud settings (see DEFAULTS), e.g.
+
+    OS_FAKE_CLOUD='latency=0.05,boot_time=20,error_rate=0.01,rate_limit=10'
+
+State transitions (BUILD -> ACTIVE, creating -> available, ...) happen after the configured delays in real time.
+"""
+
+import re
+import copy
+import time
+import heapq
+import random
+import datetime
+import itertools
+import threading
+
+DEFAULTS = {
+    # seconds added to every API call
+    'latency': 0.0,
+    # seconds it takes for resources to reach their next state
+    'boot_time': 1.0,
+    'reboot_time': 0.5,
+    'stop_time': 0.5,
+    'snapshot_time': 1.0,
+    'delete_time': 0.5,
+    'volume_create_time': 0.5,
+    'attach_time': 0.5,
+    'volume_delete_time': 0.5,
+    # probability of a call failing with 503 before doing anything
+    'error_rate': 0.0,
+    # calls per second per service before calls are rejected with 413, 0 for no limit
+    'rate_limit': 0.0,
+    'rate_burst': 20,
+    'seed': 0,
+    # catalog contents, names separated by ':'
+    'images': 'CentOS-6.6:Ubuntu-14.04',
+    'flavors': 'mini:small:medium',
+    'networks': 'fake-tenant',
+    'fip_pool': 'public',
+    # number of unassociated floating IPs the project starts with
+    'free_fips': 0,
+}
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class FakeApiError(Exception):
+    code = 500
+
+    def __init__(self, message, retry_after=None):
+        super(FakeApiError, self).__init__('%s (HTTP %d)' % (message, self.code))
+        self.http_status = self.code
+        self.retry_after = retry_after
+
+
+class BadRequest(FakeApiError):
+    code = 400
+
+
+class NotFound(FakeApiError):
+    code = 404
+
+
+class OverLimit(FakeApiError):
+    code = 413
+
+
+class ServiceUnavailable(FakeApiError):
+    code = 503
+
+
+def parse_settings(spec):
+    """
+    Parses 'key=value,key=value' into a dict of FakeCloud settings, converting the values to the types of the
+    defaults
+    """
+    settings = {}
+    for item in [x.strip() for x in (spec or '').split(',') if x.strip()]:
+        key, _, value = item.partition('=')
+        key = key.strip()
+        if key not in DEFAULTS:
+            raise RuntimeError('Unknown fake cloud setting "%s", known settings: %s' % (
+                key, ', '.join(sorted(DEFAULTS.keys()))))
+        settings[key] = type(DEFAULTS[key])(value.strip())
+    return settings
+
+
+def timestamp(t):
+    return datetime.datetime.utcfromtimestamp(t).strftime(TIMESTAMP_FORMAT)
+
+
+class FakeResource(object):
+    """
+    Snapshot of a resource as returned by the API, with the same constructor signature as the client resources
+    """
+
+    def __init__(self, manager, info, loaded=True):
+        self.manager = manager
+        self._info = copy.deepcopy(info)
+        for key, value in self._info.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self._info.get('name', self._info.get('id')))
+
+
+class Server(FakeResource):
+    def delete(self):
+        return self.manager.delete(self)
+
+    def reboot(self, reboot_type='SOFT'):
+        return self.manager.reboot(self, reboot_type)
+
+    def stop(self):
+        return self.manager.stop(self)
+
+    def add_floating_ip(self, address, fixed_address=None):
+        return self.manager.add_floating_ip(self, address, fixed_address)
+
+
+class Volume(FakeResource):
+    def delete(self):
+        return self.manager.delete(self)
+
+
+class FakeCloud(object):
+    """
+    Shared state of the fake nova and cinder services
+    """
+
+    def __init__(self, **settings):
+        self.settings = dict(DEFAULTS)
+        self.settings.update(settings)
+        self.lock = threading.RLock()
+        self.random = random.Random(self.settings['seed'])
+        self._ids = itertools.count(1)
+        self._ips = itertools.count(10)
+        self._scheduled = []
+        self.calls = {}
+        self._buckets = {}
+
+        self.servers = {}
+        self.deleted_servers = {}
+        self.volumes = {}
+        self.floating_ips = {}
+        self.security_groups = {}
+        self.server_groups = {}
+        self.images = [{'id': self.new_id('image'), 'name': x, 'status': 'ACTIVE', 'metadata': {}}
+                       for x in self.settings['images'].split(':')]
+        self.flavors = [{'id': self.new_id('flavor'), 'name': x, 'vcpus': 2 ** i, 'ram': 1024 * 2 ** i}
+                        for i, x in enumerate(self.settings['flavors'].split(':'))]
+        # every network hands out fixed addresses from the same range
+        self.networks = [{'id': self.new_id('net'), 'label': x, 'cidr': '192.168.0.0/16'}
+                         for x in self.settings['networks'].split(':')]
+        for _ in range(self.settings['free_fips']):
+            self.allocate_floating_ip(self.settings['fip_pool'])
+
+    def new_id(self, prefix):
+        return '%s-%08d' % (prefix, next(self._ids))
+
+    def allocate_floating_ip(self, pool):
+        n = next(self._ips)
+        fip = {'id': self.new_id('fip'), 'ip': '86.50.%d.%d' % (n // 250, n % 250 + 1), 'pool': pool,
+               'instance_id': None, 'fixed_ip': None}
+        self.floating_ips[fip['id']] = fip
+        return fip
+
+    def schedule(self, delay, func, *args):
+        heapq.heappush(self._scheduled, (time.time() + delay, next(self._ids), func, args))
+
+    def _run_scheduled(self):
+        now = time.time()
+        while self._scheduled and self._scheduled[0][0] <= now:
+            _, _, func, args = heapq.heappop(self._scheduled)
+            func(*args)
+
+    def _check_rate(self, service):
+        rate = self.settings['rate_limit']
+        if not rate:
+            return
+        now = time.time()
+        tokens, last = self._buckets.get(service, (self.settings['rate_burst'], now))
+        tokens = min(self.settings['rate_burst'], tokens + (now - last) * rate)
+        if tokens < 1:
+            self._buckets[service] = (tokens, now)
+            raise OverLimit('Rate limit exceeded for %s' % service, retry_after=int((1 - tokens) / rate) + 1)
+        self._buckets[service] = (tokens - 1, now)
+
+    def call(self, service, name, func, *args, **kwargs):
+        """
+        Runs an API operation with the configured latency, rate limiting and error injection
+        """
+        with self.lock:
+            key = '%s %s' % (service, name)
+            self.calls[key] = self.calls.get(key, 0) + 1
+            self._check_rate(service)
+            fail = self.random.random() < self.settings['error_rate']
+        if self.settings['latency']:
+            time.sleep(self.settings['latency'])
+        if fail:
+            raise ServiceUnavailable('Injected error in %s' % name)
+        with self.lock:
+            self._run_scheduled()
+            return func(*args, **kwargs)
+
+    def get_call_counts(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def touch(self, info, **changes):
+        info.update(changes)
+        info['updated'] = timestamp(time.time())
+
+
+class FakeManager(object):
+    resource_class = FakeResource
+    kind = None
+
+    def __init__(self, cloud, service):
+        self.cloud = cloud
+        self.service = service
+
+    def _call(self, name, func, *args, **kwargs):
+        return self.cloud.call(self.service, '%s.%s' % (self.kind, name), func, *args, **kwargs)
+
+    def _wrap(self, info):
+        return self.resource_class(self, info, loaded=True)
+
+    @staticmethod
+    def _id_of(resource):
+        return getattr(resource, 'id', resource)
+
+
+class CatalogManager(FakeManager):
+    def list(self, *args, **kwargs):
+        return self._call('list', lambda: [self._wrap(x) for x in getattr(self.cloud, self.kind)])
+
+
+# separate classes like in novaclient, the class name identifies the catalog in API statistics and traces
+class ImageManager(CatalogManager):
+    kind = 'images'
+
+
+class FlavorManager(CatalogManager):
+    kind = 'flavors'
+
+
+class NetworkManager(CatalogManager):
+    kind = 'networks'
+
+
+class ServerManager(FakeManager):
+    resource_class = Server
+    kind = 'servers'
+
+    def create(self, name, image, flavor, **kwargs):
+        return self._call('create', self._create, name, image, flavor, **kwargs)
+
+    def _create(self, name, image, flavor, key_name=None, security_groups=None, nics=None, scheduler_hints=None,
+                min_count=None, max_count=None, **kwargs):
+        cloud = self.cloud
+        if image not in [x['id'] for x in cloud.images]:
+            raise BadRequest('Image %s could not be found' % image)
+        if flavor not in [x['id'] for x in cloud.flavors]:
+            raise BadRequest('Flavor %s could not be found' % flavor)
+        network = cloud.networks[0]
+        if nics:
+            network = [x for x in cloud.networks if x['id'] == nics[0]['net-id']][0]
+
+        count = max_count or 1
+        created = []
+        for i in range(count):
+            n = next(cloud._ips)
+            info = {
+                'id': cloud.new_id('server'),
+                'name': name if count == 1 else '%s-%d' % (name, i + 1),
+                'status': 'BUILD',
+                'addresses': {network['label']: [
+                    {'addr': '192.168.%d.%d' % (n // 250, n % 250 + 1), 'OS-EXT-IPS:type': 'fixed', 'version': 4}]},
+                'flavor': {'id': flavor},
+                'image': {'id': image},
+                'key_name': key_name,
+                'security_groups': [{'name': x} for x in security_groups or []],
+                'scheduler_hints': scheduler_hints or {},
+                'created': timestamp(time.time()),
+            }
+            cloud.touch(info)
+            cloud.servers[info['id']] = info
+            cloud.schedule(cloud.settings['boot_time'], self._set_status, info['id'], 'ACTIVE')
+            created.append(info)
+        return self._wrap(created[0])
+
+    def _set_status(self, server_id, status):
+        if server_id in self.cloud.servers:
+            self.cloud.touch(self.cloud.servers[server_id], status=status)
+
+    def _find(self, server):
+        server_id = self._id_of(server)
+        if server_id not in self.cloud.servers:
+            raise NotFound('Instance %s could not be found' % server_id)
+        return self.cloud.servers[server_id]
+
+    def list(self, detailed=True, search_opts=None):
+        return self._call('list', self._list, search_opts or {})
+
+    def _list(self, search_opts):
+        servers = self.cloud.servers.values()
+        since = search_opts.get('changes-since')
+        if since:
+            servers = [x for x in servers + self.cloud.deleted_servers.values() if x['updated'] >= since]
+        if search_opts.get('name'):
+            name_re = re.compile(search_opts['name'])
+            servers = [x for x in servers if name_re.search(x['name'])]
+        return [self._wrap(x) for x in sorted(servers, key=lambda x: x['id'])]
+
+    def get(self, server):
+        return self._call('get', lambda: self._wrap(self._find(server)))
+
+    def update(self, server, name=None):
+        def update():
+            info = self._find(server)
+            if name is not None:
+                self.cloud.touch(info, name=name)
+            return self._wrap(info)
+        return self._call('update', update)
+
+    def delete(self, server):
+        return self._call('delete', self._delete, server)
+
+    def _delete(self, server):
+        info = self._find(server)
+        self.cloud.touch(info, **{'OS-EXT-STS:task_state': 'deleting'})
+        self.cloud.schedule(self.cloud.settings['delete_time'], self._remove, info['id'])
+
+    def _remove(self, server_id):
+        cloud = self.cloud
+        info = cloud.servers.pop(server_id, None)
+        if not info:
+            return
+        cloud.touch(info, status='DELETED')
+        cloud.deleted_servers[server_id] = info
+        for vol in cloud.volumes.values():
+            if [x for x in vol['attachments'] if x['server_id'] == server_id]:
+                cloud.touch(vol, status='available', attachments=[])
+        for fip in cloud.floating_ips.values():
+            if fip['instance_id'] == server_id:
+                fip.update(instance_id=None, fixed_ip=None)
+
+    def reboot(self, server, reboot_type='SOFT'):
+        def reboot():
+            info = self._find(server)
+            self.cloud.touch(info, status='HARD_REBOOT' if reboot_type == 'HARD' else 'REBOOT')
+            self.cloud.schedule(self.cloud.settings['reboot_time'], self._set_status, info['id'], 'ACTIVE')
+        return self._call('reboot', reboot)
+
+    def stop(self, server):
+        def stop():
+            info = self._find(server)
+            self.cloud.schedule(self.cloud.settings['stop_time'], self._set_status, info['id'], 'SHUTOFF')
+        return self._call('stop', stop)
+
+    def create_image(self, server, image_name, metadata=None):
+        return self._call('create_image', self._create_image, server, image_name, metadata)
+
+    def _create_image(self, server, image_name, metadata):
+        cloud = self.cloud
+        self._find(server)
+        image = {'id': cloud.new_id('image'), 'name': image_name, 'status': 'SAVING', 'metadata': metadata or {}}
+        cloud.images.append(image)
+        cloud.schedule(cloud.settings['snapshot_time'], image.update, {'status': 'ACTIVE'})
+        return image['id']
+
+    def add_floating_ip(self, server, address, fixed_address=None):
+        return self._call('add_floating_ip', self._add_floating_ip, server, address)
+
+    def _add_floating_ip(self, server, address):
+        info = self._find(server)
+        ip = getattr(address, 'ip', address)
+        fips = [x for x in self.cloud.floating_ips.values() if x['ip'] == ip]
+        if not fips:
+            raise NotFound('Floating ip %s not found' % ip)
+        fip = fips[0]
+        if fip['instance_id'] and fip['instance_id'] != info['id']:
+            raise BadRequest('Floating ip %s is already associated' % ip)
+        addresses = info['addresses'].values()[0]
+        fip.update(instance_id=info['id'], fixed_ip=addresses[0]['addr'])
+        addresses.append({'addr': ip, 'OS-EXT-IPS:type': 'floating', 'version': 4})
+        self.cloud.touch(info)
+
+
+class NovaVolumeManager(FakeManager):
+    """
+    The server volume attachment part of the nova API
+    """
+    kind = 'volumes'
+
+    def create_server_volume(self, server_id, volume_id, device):
+        return self._call('create_server_volume', self._attach, server_id, volume_id, device)
+
+    def _attach(self, server_id, volume_id, device):
+        cloud = self.cloud
+        if server_id not in cloud.servers:
+            raise NotFound('Instance %s could not be found' % server_id)
+        vol = cloud.volumes.get(volume_id)
+        if not vol:
+            raise NotFound('Volume %s could not be found' % volume_id)
+        if vol['status'] != 'available':
+            raise BadRequest('Invalid volume: status must be available, not %s' % vol['status'])
+        cloud.touch(vol, status='attaching')
+        cloud.schedule(cloud.settings['attach_time'], self._attached, server_id, volume_id, device)
+        return FakeResource(self, {'id': volume_id, 'serverId': server_id, 'volumeId': volume_id, 'device': device})
+
+    def _attached(self, server_id, volume_id, device):
+        vol = self.cloud.volumes.get(volume_id)
+        if vol and vol['status'] == 'attaching':
+            self.cloud.touch(vol, status='in-use', attachments=[{'server_id': server_id, 'device': device}])
+
+
+class CinderVolumeManager(FakeManager):
+    resource_class = Volume
+    kind = 'volumes'
+
+    def create(self, size, display_name=None, **kwargs):
+        def create():
+            cloud = self.cloud
+            info = {'id': cloud.new_id('volume'), 'size': size, 'display_name': display_name,
+                    'status': 'creating', 'attachments': []}
+            cloud.touch(info)
+            cloud.volumes[info['id']] = info
+            cloud.schedule(cloud.settings['volume_create_time'], self._created, info['id'])
+            return self._wrap(info)
+        return self._call('create', create)
+
+    def _created(self, volume_id):
+        if volume_id in self.cloud.volumes:
+            self.cloud.touch(self.cloud.volumes[volume_id], status='available')
+
+    def _find(self, volume):
+        volume_id = self._id_of(volume)
+        if volume_id not in self.cloud.volumes:
+            raise NotFound('Volume %s could not be found' % volume_id)
+        return self.cloud.volumes[volume_id]
+
+    def list(self, detailed=True, search_opts=None):
+        return self._call('list', lambda: [self._wrap(x) for x in sorted(self.cloud.volumes.values(),
+                                                                         key=lambda x: x['id'])])
+
+    def get(self, volume):
+        return self._call('get', lambda: self._wrap(self._find(volume)))
+
+    def delete(self, volume):
+        def delete():
+            info = self._find(volume)
+            if info['status'] not in ['available', 'error']:
+                raise BadRequest('Invalid volume: status must be available or error, not %s' % info['status'])
+            self.cloud.touch(info, status='deleting')
+            self.cloud.schedule(self.cloud.settings['volume_delete_time'], self.cloud.volumes.pop, info['id'], None)
+        return self._call('delete', delete)
+
+
+class FloatingIpManager(FakeManager):
+    kind = 'floating_ips'
+
+    def list(self):
+        return self._call('list', lambda: [self._wrap(x) for x in sorted(self.cloud.floating_ips.values(),
+                                                                         key=lambda x: x['id'])])
+
+    def create(self, pool=None):
+        return self._call('create', lambda: self._wrap(self.cloud.allocate_floating_ip(pool)))
+
+
+class FloatingIpPoolManager(FakeManager):
+    kind = 'floating_ip_pools'
+
+    def list(self):
+        return self._call('list', lambda: [self._wrap({'name': self.cloud.settings['fip_pool']})])
+
+
+class SecurityGroupManager(FakeManager):
+    kind = 'security_groups'
+
+    def create(self, name, description):
+        def create():
+            info = {'id': self.cloud.new_id('secgroup'), 'name': name, 'description': description, 'rules': []}
+            self.cloud.security_groups[info['id']] = info
+            return self._wrap(info)
+        return self._call('create', create)
+
+    def list(self):
+        return self._call('list', lambda: [self._wrap(x) for x in self.cloud.security_groups.values()])
+
+    def find(self, name=None):
+        def find():
+            matches = [x for x in self.cloud.security_groups.values() if x['name'] == name]
+            if not matches:
+                raise NotFound('No SecurityGroup matching name=%s' % name)
+            return self._wrap(matches[0])
+        return self._call('find', find)
+
+    def delete(self, group):
+        def delete():
+            if self.cloud.security_groups.pop(self._id_of(group), None) is None:
+                raise NotFound('Security group %s not found' % self._id_of(group))
+        return self._call('delete', delete)
+
+
+class SecurityGroupRuleManager(FakeManager):
+    kind = 'security_group_rules'
+
+    def create(self, parent_group_id, ip_protocol=None, from_port=None, to_port=None, cidr=None, group_id=None):
+        def create():
+            parent = self.cloud.security_groups.get(parent_group_id)
+            if not parent:
+                raise NotFound('Security group %s not found' % parent_group_id)
+            rule = {'id': self.cloud.new_id('rule'), 'parent_group_id': parent_group_id,
+                    'ip_protocol': ip_protocol, 'from_port': from_port, 'to_port': to_port,
+                    'ip_range': {'cidr': cidr} if cidr else {}, 'group_id': group_id}
+            parent['rules'].append(rule)
+            return self._wrap(rule)
+        return self._call('create', create)
+
+    def delete(self, rule_id):
+        def delete():
+            for group in self.cloud.security_groups.values():
+                group['rules'] = [x for x in group['rules'] if x['id'] != rule_id]
+        return self._call('delete', delete)
+
+
+class ServerGroupManager(FakeManager):
+    kind = 'server_groups'
+
+    def create(self, name=None, policies=None):
+        def create():
+            info = {'id': self.cloud.new_id('servergroup'), 'name': name, 'policies': policies or [], 'members': []}
+            self.cloud.server_groups[info['id']] = info
+            return self._wrap(info)
+        return self._call('create', create)
+
+    def list(self):
+        return self._call('list', lambda: [self._wrap(x) for x in self.cloud.server_groups.values()])
+
+    def delete(self, group_id):
+        def delete():
+            if self.cloud.server_groups.pop(group_id, None) is None:
+                raise NotFound('Server group %s not found' % group_id)
+        return self._call('delete', delete)
+
+
+class FakeNovaClient(object):
+    api_service = 'nova'
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self.servers = ServerManager(cloud, 'nova')
+        self.volumes = NovaVolumeManager(cloud, 'nova')
+        self.images = ImageManager(cloud, 'nova')
+        self.flavors = FlavorManager(cloud, 'nova')
+        self.networks = NetworkManager(cloud, 'nova')
+        self.floating_ips = FloatingIpManager(cloud, 'nova')
+        self.floating_ip_pools = FloatingIpPoolManager(cloud, 'nova')
+        self.security_groups = SecurityGroupManager(cloud, 'nova')
+        self.security_group_rules = SecurityGroupRuleManager(cloud, 'nova')
+        self.server_groups = ServerGroupManager(cloud, 'nova')
+
+
+class FakeCinderClient(object):
+    api_service = 'cinder'
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self.volumes = CinderVolumeManager(cloud, 'cinder')
+
+
+def get_clients(spec=None, **settings):
+    """
+    Returns a fake nova and cinder client sharing a new FakeCloud, configured from spec (see parse_settings) and
+    the keyword arguments
+    """
+    cloud_settings = parse_settings(spec)
+    cloud_settings.update(settings)
+    cloud = FakeCloud(**cloud_settings)
+    return FakeNovaClient(cloud), FakeCinderClient(cloud)
@@ -0,0 +1,161 @@
+"""
+Timing of provisioning phases and OpenStack API calls, with a summary table and a Chrome trace export
+(load the file in chrome://tracing or https://ui.perfetto.dev)
+"""
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_start_time = time.time()
+_spans = []
+_api_stats = {}
+_sleep_stats = {}
+
+
+def _add_span(name, category, start, end, args=None):
+    with _lock:
+        _spans.append({'name': name, 'cat': category, 'start': start, 'end': end,
+                       'tid': threading.current_thread().name, 'args': args or {}})
+
+
+@contextmanager
+def phase(name):
+    """
+    Context manager that records the duration of a provisioning phase
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        _add_span(name, 'phase', start, time.time())
+
+
+def call_name(func):
+    """
+    Returns a readable name like 'ServerManager.list' for an API function or bound method
+    """
+    owner = getattr(func, '__self__', None) or getattr(func, 'im_self', None)
+    if owner is not None:
+        return '%s.%s' % (type(owner).__name__, func.__name__)
+    return getattr(func, '__name__', repr(func))
+
+
+def record_api_call(service, name, start, end, error=None, retry=False):
+    """
+    Records a single attempt of an API call. retry tells that the attempt was a retry of a failed one.
+    """
+    key = '%s %s' % (service, name)
+    latency = end - start
+    with _lock:
+        stats = _api_stats.setdefault(key, {'count': 0, 'errors': 0, 'retries': 0, 'total': 0.0, 'max': 0.0})
+        stats['count'] += 1
+        stats['total'] += latency
+        stats['max'] = max(stats['max'], latency)
+        if error:
+            stats['errors'] += 1
+        if retry:
+            stats['retries'] += 1
+    args = {'error': str(error)} if error else None
+    _add_span(key, 'api', start, end, args)
+
+
+def sleep(kind, seconds):
+    """
+    time.sleep() that records the time slept under the given kind ('poll', 'retry', 'rate-limit')
+    """
+    start = time.time()
+    time.sleep(seconds)
+    record_sleep(kind, time.time() - start)
+
+
+def record_sleep(kind, seconds):
+    with _lock:
+        _sleep_stats[kind] = _sleep_stats.get(kind, 0.0) + seconds
+
+
+def get_phases():
+    """
+    Returns the recorded phases as (name, start, end)
+    """
+    with _lock:
+        return [(x['name'], x['start'], x['end']) for x in _spans if x['cat'] == 'phase']
+
+
+def get_summary():
+    """
+    Returns the phase durations, API call statistics and sleep times as lines of a table
+    """
+    with _lock:
+        phases = sorted([x for x in _spans if x['cat'] == 'phase'], key=lambda x: x['start'])
+        api_stats = sorted(_api_stats.items())
+        sleep_stats = sorted(_sleep_stats.items())
+
+    lines = []
+    if phases:
+        lines.append('%-40s %10s %10s' % ('phase', 'start', 'duration'))
+        for span in phases:
+            lines.append('%-40s %9.1fs %9.1fs' % (
+                span['name'][:40], span['start'] - _start_time, span['end'] - span['start']))
+        lines.append('')
+
+    if api_stats:
+        lines.append('%-40s %6s %6s %6s %9s %9s %9s' % (
+            'API call', 'count', 'errors', 'retry', 'total', 'avg', 'max'))
+        total_count = 0
+        total_time = 0.0
+        for key, stats in api_stats:
+            lines.append('%-40s %6d %6d %6d %8.2fs %8.3fs %8.3fs' % (
+                key[:40], stats['count'], stats['errors'], stats['retries'], stats['total'],
+                stats['total'] / stats['count'], stats['max']))
+            total_count += stats['count']
+            total_time += stats['total']
+        lines.append('%-40s %6d %6s %6s %8.2fs' % ('all calls', total_count, '', '', total_time))
+        lines.append('')
+
+    if sleep_stats:
+        for kind, seconds in sleep_stats:
+            lines.append('%-40s %8.1fs' % ('sleeping (%s)' % kind, seconds))
+        lines.append('')
+
+    return lines
+
+
+def print_summary():
+    lines = get_summary()
+    if lines:
+        print
+        print 'Timing summary'
+        print
+        for line in lines:
+            print line
+
+
+def write_trace(path):
+    """
+    Writes the recorded phases and API calls as a Chrome trace event file
+    """
+    with _lock:
+        spans = list(_spans)
+
+    thread_ids = {}
+    events = []
+    for span in spans:
+        tid = thread_ids.setdefault(span['tid'], len(thread_ids) + 1)
+        events.append({
+            'name': span['name'],
+            'cat': span['cat'],
+            'ph': 'X',
+            'ts': int((span['start'] - _start_time) * 1e6),
+            'dur': int((span['end'] - span['start']) * 1e6),
+            'pid': 1,
+            'tid': tid,
+            'args': span['args'],
+        })
+    for name, tid in thread_ids.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}})
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,132 @@
+"""
+Streaming configuration of a cluster that is still being provisioned. Every VM moves through the stages on its own:
+it is handed over to the pipeline as soon as it has booted, got its addresses and its volumes attached, its ssh port
+is probed together with the others, and the host stages (bootstrap, ...) run on batches of the hosts that have
+become reachable in the meantime. Only the cluster wide configuration has to wait for all the hosts.
+"""
+
+import time
+import Queue
+import threading
+import ssh_prober
+import provisioning_log
+
+# stages of a VM in the order they are reached, the first three are marked by the provisioning code
+STAGES = ['booted', 'addressed', 'volumes attached', 'ssh ready', 'bootstrapped', 'packages']
+
+
+class StageTimeline(object):
+    """
+    Time each VM reached each stage, relative to the start of the pipeline
+    """
+
+    def __init__(self, stages=STAGES):
+        self.stages = stages
+        self.start_time = time.time()
+        self.times = {}
+        self._lock = threading.Lock()
+
+    def mark(self, name, stage):
+        with self._lock:
+            self.times.setdefault(name, {})[stage] = time.time() - self.start_time
+
+    def get_timeline(self):
+        template = '    %-24s' + ''.join(' %%%ds' % max(10, len(x)) for x in self.stages)
+        lines = [template % tuple(['host'] + self.stages)]
+        with self._lock:
+            for name in sorted(self.times.keys()):
+                times = [('%.1f' % self.times[name][x]) if x in self.times[name] else '-' for x in self.stages]
+                lines.append(template % tuple([name] + times))
+        return lines
+
+
+class NodePipeline(object):
+    """
+    Runs the host stages on the VMs added with add() as they become reachable with ssh.
+
+    host_stages is a list of (stage name, function(host names)) run in order on each batch, a function raises an
+    exception if the stage failed for the batch. prepare(host names) is called before each batch with the hosts that
+    are ready and returns the ones the batch can run on, the rest are offered again for the next batch.
+    """
+
+    def __init__(self, host_stages, prepare, timeline):
+        self.host_stages = host_stages
+        self.prepare = prepare
+        self.timeline = timeline
+        self.done = []
+        self.failed = {}
+        self._new_hosts = Queue.Queue()
+        self._prober = ssh_prober.SshProber()
+        self._ready = []
+        self._finishing = False
+
+    def add(self, name, address):
+        """
+        Adds a provisioned VM to the pipeline, can be called from any thread
+        """
+        self._new_hosts.put((name, address))
+
+    def finish(self):
+        """
+        Tells the pipeline that no more VMs will be added
+        """
+        self._new_hosts.put(None)
+
+    def _take_new_hosts(self, timeout):
+        try:
+            item = self._new_hosts.get(timeout=timeout) if timeout else self._new_hosts.get_nowait()
+            while True:
+                if item is None:
+                    self._finishing = True
+                else:
+                    self._prober.add(*item)
+                item = self._new_hosts.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def _run_batch(self, batch):
+        print
+        print 'Configuring %d hosts that are ready: %s' % (len(batch), ' '.join(batch))
+        print
+        for stage, func in self.host_stages:
+            try:
+                func(batch)
+            except Exception as e:
+                print '    %s failed for %s: %s' % (stage, ' '.join(batch), e)
+                for name in batch:
+                    self.failed[name] = e
+                return
+            for name in batch:
+                self.timeline.mark(name, stage)
+        self.done.extend(batch)
+
+    def run(self):
+        """
+        Runs until finish() has been called and every added host has gone through the host stages or failed.
+        Returns the names of the hosts that completed all the stages.
+        """
+        held = False
+        try:
+            while True:
+                # block on the queue only when there is nothing else to wait for
+                idle = not self._prober.pending and (held or not self._ready)
+                self._take_new_hosts(1 if idle and not self._finishing else 0)
+
+                for name, seconds in self._prober.poll():
+                    print '    %s is ready (%.1f s)' % (name, seconds)
+                    self.timeline.mark(name, 'ssh ready')
+                    now = time.time()
+                    provisioning_log.log_operation('ssh ready', 'vm', name, now - seconds, now, info=name)
+                    self._ready.append(name)
+
+                batch = self.prepare(sorted(self._ready)) if self._ready else []
+                held = bool(self._ready) and not batch
+                if batch:
+                    self._ready = [x for x in self._ready if x not in batch]
+                    self._run_batch(batch)
+                elif self._finishing and not self._prober.pending and self._new_hosts.empty():
+                    for name in self._ready:
+                        self.failed[name] = RuntimeError('%s could not be configured' % name)
+                    return self.done
+        finally:
+            self._prober.close()
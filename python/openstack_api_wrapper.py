@@ -6,122 +6,647 @@ Wrapper against OpenStack nova and cinder APIs
 """
 
 import os
+import re
 import time
+import socket
+import json
 import itertools
+import threading
+import Queue
+import worker_pool
+import instrumentation
+import api_recorder
+import token_cache
 import novaclient
-from novaclient.openstack.common.apiclient.exceptions import NotFound
 import novaclient.v1_1
 import cinderclient.v1
 
 
+# defaults for the API call gateway: calls per second and burst size per service, and retries for failed calls
+API_RATE = 10
+API_BURST = 20
+API_MIN_RATE = 0.5
+API_MAX_RETRIES = 5
+API_RETRY_DELAY = 2
+THROTTLED_CODES = [413, 429]
+TRANSIENT_CODES = [500, 502, 503, 504]
+TRANSIENT_EXCEPTIONS = ['ConnectionError', 'ConnectionRefused', 'Timeout', 'RequestTimeout', 'ServiceUnavailable']
+
+
+class TokenBucket(object):
+    """
+    Limits the rate of calls to a service. The rate is halved whenever the service reports that it is throttling
+    the calls and it grows back gradually with successful calls.
+    """
+
+    def __init__(self, rate=API_RATE, burst=API_BURST, min_rate=API_MIN_RATE):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.tokens = burst
+        self.last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            instrumentation.sleep('rate-limit', wait)
+
+    def throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+    def relax(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100.0)
+
+
+_token_buckets = {}
+_token_buckets_lock = threading.Lock()
+
+
+def get_token_bucket(service):
+    with _token_buckets_lock:
+        if service not in _token_buckets:
+            _token_buckets[service] = TokenBucket()
+        return _token_buckets[service]
+
+
+def service_of(client):
+    if getattr(client, 'api_service', None):
+        return client.api_service
+    if 'cinderclient' in type(client).__module__:
+        return 'cinder'
+    return 'nova'
+
+
+def get_error_code(e):
+    return getattr(e, 'code', None) or getattr(e, 'http_status', None)
+
+
+def is_not_found(e):
+    return get_error_code(e) == 404 or type(e).__name__ == 'NotFound'
+
+
+def classify_error(e):
+    """
+    Classifies an exception from an API call as 'not-found', 'throttled', 'transient' or 'fatal'
+    """
+    code = get_error_code(e)
+    if is_not_found(e):
+        return 'not-found'
+    if code in THROTTLED_CODES:
+        return 'throttled'
+    if code in TRANSIENT_CODES or isinstance(e, socket.error) or type(e).__name__ in TRANSIENT_EXCEPTIONS:
+        return 'transient'
+    return 'fatal'
+
+
+def _api_call(service, func, args, kwargs, retry_transient):
+    bucket = get_token_bucket(service)
+    name = instrumentation.call_name(func)
+    # recording or replay of the session, see api_recorder
+    session = api_recorder.get_session()
+    delay = API_RETRY_DELAY
+    for attempt in range(API_MAX_RETRIES + 1):
+        bucket.acquire()
+        start = time.time()
+        try:
+            if session:
+                res = session.call(service, name, func, args, kwargs)
+            else:
+                res = func(*args, **kwargs)
+            instrumentation.record_api_call(service, name, start, time.time(), retry=(attempt > 0))
+            bucket.relax()
+            return res
+        except Exception as e:
+            instrumentation.record_api_call(service, name, start, time.time(), error=e, retry=(attempt > 0))
+            error_class = classify_error(e)
+            if attempt == API_MAX_RETRIES or not (
+                    error_class == 'throttled' or (error_class == 'transient' and retry_transient)):
+                raise
+
+            wait = delay
+            if error_class == 'throttled':
+                bucket.throttle()
+                wait = max(delay, int(getattr(e, 'retry_after', 0) or 0))
+            print '    %s API call %s, retrying in %d s: %s' % (service, error_class, wait, e)
+            instrumentation.sleep('retry', wait)
+            delay *= 2
+
+
+def api_call(service, func, *args, **kwargs):
+    """
+    Calls func through the rate limiter of the service, retrying calls that were throttled or failed with a
+    transient error. Other errors, including NotFound, are raised to the caller.
+    """
+    return _api_call(service, func, args, kwargs, True)
+
+
+def api_create(service, func, *args, **kwargs):
+    """
+    Like api_call, but for calls that must not be repeated after a transient error, since the first attempt may
+    already have created the resource
+    """
+    return _api_call(service, func, args, kwargs, False)
+
+
 def get_clients():
+    # in-process fake cloud for benchmarking, see fake_openstack
+    if 'OS_FAKE_CLOUD' in os.environ:
+        import fake_openstack
+        return fake_openstack.get_clients(os.environ['OS_FAKE_CLOUD'])
+
     un = os.environ['OS_USERNAME']
     pw = os.environ['OS_PASSWORD']
     tenant = os.environ['OS_TENANT_NAME']
     auth_url = os.environ['OS_AUTH_URL']
+
+    # both clients share a session with cached tokens, fall back to separate authentication with old client libraries
+    # that have no sessions or whose clients do not take one
+    session = token_cache.get_session(auth_url, un, pw, tenant)
+    if session:
+        try:
+            nova_client = novaclient.v1_1.client.Client(un, None, tenant, auth_url, session=session)
+            cinder_client = cinderclient.v1.client.Client(un, None, tenant, auth_url, session=session)
+            return nova_client, cinder_client
+        except TypeError:
+            pass
     nova_client = novaclient.v1_1.client.Client(un, pw, tenant, auth_url)
     cinder_client = cinderclient.v1.client.Client(un, pw, tenant, auth_url)
     return nova_client, cinder_client
 
 
-def wait_for_state(client, type, instance_id, tgt_state):
-    tgt_states = tgt_state.lower().split('|')
-    while True:
-        cur_state = getattr(client, type).get(instance_id).status.lower()
-        if cur_state in tgt_states:
-            print '    state now %s' % cur_state
-            break
+# defaults for StateWatcher polling
+POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 30
+POLL_BACKOFF = 1.5
+STATE_TIMEOUT = 3600
+# delay after new resources have been registered, so that registrations from parallel workers share a poll
+WAKEUP_DELAY = 1
+# number of polls a resource may be missing from the listing before giving up on it
+MAX_NOT_FOUND_POLLS = 3
+# pseudo state for resources that are not present in the listing anymore
+DELETED = 'deleted'
+# short-lived states that a longer poll interval could miss, resources waiting for them are polled without backoff
+TRANSIENT_STATES = ['reboot', 'hard_reboot']
+
+
+class StateFuture(object):
+    """
+    Handle for a single resource tracked by StateWatcher. It is completed when the resource reaches one of the
+    target states, ends up in an error state or runs past its deadline.
+    """
+
+    def __init__(self, object_type, resource_id, tgt_states, deadline, state_func=None):
+        self.object_type = object_type
+        self.resource_id = resource_id
+        self.tgt_states = tgt_states
+        self.deadline = deadline
+        self.state_func = state_func or (lambda x: x.status.lower())
+        self.state = None
+        self.error = None
+        self.not_found_polls = 0
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self):
+        # wait with a timeout so that the waiting thread still receives KeyboardInterrupt
+        while not self._done.wait(1):
+            pass
+        if self.error:
+            raise self.error
+        return self.state
+
+    def complete(self, state, error=None):
+        with self._lock:
+            self.state = state
+            self.error = error
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+
+class StateWatcher(object):
+    """
+    Tracks the state of any number of resources of one client with a single list() call per resource type per poll.
+    Polling runs in a background thread while there are resources to track, with the interval growing by 'backoff'
+    up to 'max_poll_interval' as long as nothing changes. While a resource is waited for to reach a transient state
+    the interval stays at 'poll_interval'.
+    """
+
+    def __init__(self, client, poll_interval=POLL_INTERVAL, max_poll_interval=MAX_POLL_INTERVAL,
+                 backoff=POLL_BACKOFF, timeout=STATE_TIMEOUT):
+        self.client = client
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._poller = None
+
+    def watch(self, object_type, resource_id, tgt_state, timeout=None, callback=None, state_func=None):
+        if timeout is None:
+            timeout = self.timeout
+        future = StateFuture(object_type, resource_id, tgt_state.lower().split('|'), time.time() + timeout,
+                             state_func)
+        if callback:
+            future.add_done_callback(callback)
+
+        with self._lock:
+            self._pending.append(future)
+            if not self._poller:
+                self._poller = threading.Thread(target=self._poll_loop)
+                self._poller.daemon = True
+                self._poller.start()
+        self._wakeup.set()
+
+        return future
+
+    def watch_deletion(self, object_type, resource_id, timeout=None, callback=None):
+        return self.watch(object_type, resource_id, DELETED, timeout, callback)
+
+    def _poll_loop(self):
+        interval = self.poll_interval
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._poller = None
+                    return
+                pending = self._pending[:]
+
+            self._wakeup.clear()
+            changed = self._poll(pending)
+            if changed or [x for x in pending if set(x.tgt_states) & set(TRANSIENT_STATES)]:
+                interval = self.poll_interval
+            else:
+                interval = min(interval * self.backoff, self.max_poll_interval)
+
+            with self._lock:
+                self._pending = [x for x in self._pending if not x.done()]
+                if not self._pending:
+                    continue
+
+            wait_start = time.time()
+            woken = self._wakeup.wait(interval)
+            instrumentation.record_sleep('poll', time.time() - wait_start)
+            if woken:
+                interval = self.poll_interval
+                instrumentation.sleep('poll', WAKEUP_DELAY)
+
+    def _poll(self, pending):
+        changed = False
+        for object_type in set(x.object_type for x in pending):
+            try:
+                listing = api_call(service_of(self.client), getattr(self.client, object_type).list)
+                resources = dict((x.id, x) for x in listing)
+            except Exception as e:
+                print '    listing %s failed, retrying: %s' % (object_type, e)
+                continue
+
+            waiting = {}
+            for future in [x for x in pending if x.object_type == object_type]:
+                cur_state = None
+                if future.resource_id in resources:
+                    cur_state = future.state_func(resources[future.resource_id])
+                if cur_state != future.state:
+                    changed = True
+                future.state = cur_state
+
+                if cur_state is None:
+                    if DELETED in future.tgt_states:
+                        future.complete(DELETED)
+                        continue
+                    future.not_found_polls += 1
+                    if future.not_found_polls >= MAX_NOT_FOUND_POLLS:
+                        future.complete(None, RuntimeError('%s %s not found' % (object_type, future.resource_id)))
+                        continue
+                elif cur_state in future.tgt_states:
+                    future.complete(cur_state)
+                    continue
+                elif cur_state.startswith('error'):
+                    future.complete(cur_state, RuntimeError(
+                        '%s %s in "%s" state, operation failed' % (object_type, future.resource_id, cur_state)))
+                    continue
+
+                if time.time() > future.deadline:
+                    future.complete(cur_state, RuntimeError(
+                        'Timed out waiting for %s %s to reach state %s, current state: %s' % (
+                            object_type, future.resource_id, '|'.join(future.tgt_states), cur_state)))
+                    continue
+
+                key = '%s -> %s' % (cur_state, '|'.join(future.tgt_states))
+                waiting[key] = waiting.get(key, 0) + 1
+
+            if waiting:
+                print '    waiting for %d %s: %s' % (
+                    sum(waiting.values()), object_type, ', '.join('%s: %d' % x for x in sorted(waiting.items())))
+
+        return changed
+
+
+_state_watchers = {}
+_state_watchers_lock = threading.Lock()
+
+
+def get_state_watcher(client):
+    """
+    Returns the StateWatcher shared by all callers using the given client
+    """
+    with _state_watchers_lock:
+        if id(client) not in _state_watchers:
+            _state_watchers[id(client)] = StateWatcher(client)
+        return _state_watchers[id(client)]
 
-        if cur_state == 'error':
-            raise RuntimeError('Instance in "error" state, launch failed')
 
-        print '    current state: %s, waiting for: %s' % (cur_state, tgt_state)
-        time.sleep(5)
+def set_state_watcher(client, watcher):
+    """
+    Replaces the shared StateWatcher of the client, e.g. with one that polls at a different interval
+    """
+    with _state_watchers_lock:
+        _state_watchers[id(client)] = watcher
+
+
+def watch_state(client, object_type, resource_id, tgt_state, timeout=None, callback=None):
+    return get_state_watcher(client).watch(object_type, resource_id, tgt_state, timeout, callback)
+
+
+def watch_deletion(client, object_type, resource_id, timeout=None, callback=None):
+    return get_state_watcher(client).watch_deletion(object_type, resource_id, timeout, callback)
+
+
+def watch_floating_ip(client, server_id, ip, timeout=None, callback=None):
+    """
+    Watches the addresses of a server in the server listing until the given floating ip shows up as 'associated'
+    """
+    def state_func(server):
+        if ip in get_addresses(server, 'floating'):
+            return 'associated'
+        return server.status.lower()
+
+    return get_state_watcher(client).watch('servers', server_id, 'associated', timeout, callback, state_func)
+
+
+def wait_for_state(client, type, instance_id, tgt_state, timeout=None):
+    cur_state = watch_state(client, type, instance_id, tgt_state, timeout).result()
+    print '    state now %s' % cur_state
+    return cur_state
+
+
+# default time in seconds the catalog listings are kept before fetching them again
+CATALOG_TTL = 600
+# catalogs that are stored on disk. Security and server groups are managed by poutacluster itself and can change
+# between invocations, so they are only cached in memory
+PERSISTENT_CATALOGS = ['images', 'flavors', 'networks']
+
+
+class Catalog(object):
+    """
+    Cache for image, flavor, network, security group and server group listings, indexed by both name and id.
+
+    Each listing is fetched on first use and kept for 'ttl' seconds. If 'cache_file' is given, the image, flavor
+    and network listings are also stored on disk and reused by later invocations within the ttl.
+    """
+
+    def __init__(self, ttl=CATALOG_TTL, cache_file=None):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self._catalogs = {}
+        self._fetched = set()
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def _owner():
+        return {'tenant': os.environ.get('OS_TENANT_NAME'), 'auth_url': os.environ.get('OS_AUTH_URL')}
+
+    def _load(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if data.get('owner') != self._owner():
+            return
+        for kind, catalog in data.get('catalogs', {}).items():
+            if kind in PERSISTENT_CATALOGS:
+                self._catalogs[kind] = self._index(catalog['time'], catalog['entries'])
+
+    def _save(self):
+        if not self.cache_file:
+            return
+        catalogs = dict((kind, {'time': c['time'], 'entries': c['entries']})
+                        for kind, c in self._catalogs.items() if kind in PERSISTENT_CATALOGS)
+        with open(self.cache_file, 'w') as f:
+            json.dump({'owner': self._owner(), 'catalogs': catalogs}, f)
+
+    @staticmethod
+    def _index(fetch_time, entries):
+        by_name = {}
+        for entry in entries:
+            by_name.setdefault(entry['name'], entry)
+        return {'time': fetch_time, 'entries': entries, 'by_name': by_name,
+                'by_id': dict((x['id'], x) for x in entries)}
+
+    @staticmethod
+    def _fetch(client, kind):
+        if kind == 'networks':
+            return [{'id': x.id, 'name': x.label, 'cidr': getattr(x, 'cidr', None)}
+                    for x in api_call('nova', client.networks.list)]
+        if kind == 'flavors':
+            return [{'id': x.id, 'name': x.name, 'vcpus': getattr(x, 'vcpus', None), 'ram': getattr(x, 'ram', None)}
+                    for x in api_call('nova', client.flavors.list)]
+        if kind == 'server_groups':
+            return [{'id': x.id, 'name': x.name, 'policies': x.policies}
+                    for x in api_call('nova', client.server_groups.list)]
+        return [{'id': x.id, 'name': x.name} for x in api_call('nova', getattr(client, kind).list)]
+
+    def _get(self, client, kind, refresh=False):
+        with self._lock:
+            catalog = self._catalogs.get(kind)
+            if refresh or not catalog or time.time() - catalog['time'] > self.ttl:
+                catalog = self._index(time.time(), self._fetch(client, kind))
+                self._catalogs[kind] = catalog
+                self._fetched.add(kind)
+                if kind in PERSISTENT_CATALOGS:
+                    self._save()
+            return catalog
+
+    def lookup(self, client, kind, name_or_id, by_name=True):
+        """
+        Returns the entry with the given name or id, or None. A miss on a listing loaded from disk triggers a
+        fetch, in case the resource has been created after the listing was cached.
+        """
+        for refresh in False, True:
+            catalog = self._get(client, kind, refresh)
+            entry = catalog['by_id'].get(name_or_id)
+            if by_name:
+                entry = catalog['by_name'].get(name_or_id) or entry
+            if entry or kind in self._fetched:
+                return entry
+
+    def entries(self, client, kind):
+        return self._get(client, kind)['entries']
+
+    def invalidate(self, kind=None):
+        with self._lock:
+            if kind:
+                self._catalogs.pop(kind, None)
+            else:
+                self._catalogs = {}
+            if not kind or kind in PERSISTENT_CATALOGS:
+                self._save()
+
+
+_catalog = Catalog()
+
+
+def configure_catalog(ttl=CATALOG_TTL, cache_file=None):
+    global _catalog
+    _catalog = Catalog(ttl, cache_file)
+    return _catalog
 
 
 def check_image_exists(client, image):
-    for img in client.images.list():
-        if img.name == image:
-            return img.id
-        elif img.id == image:
-            return img.id
+    img = _catalog.lookup(client, 'images', image)
+    if img:
+        return img['id']
     raise RuntimeError('Requested image "%s" does not exist' % image)
 
 
 def find_image_name_by_id(client, image_id):
-    for img in client.images.list():
-        if img.id == image_id:
-            return img.name
+    img = _catalog.lookup(client, 'images', image_id, by_name=False)
+    if img:
+        return img['name']
+    return image_id
+
+
+def find_image_by_metadata(client, metadata):
+    """
+    Returns the newest active image that has all the given metadata items, or None
+    """
+    images = [x for x in api_call('nova', client.images.list)
+              if x.status.lower() == 'active'
+              and all((getattr(x, 'metadata', None) or {}).get(k) == v for k, v in metadata.items())]
+    if not images:
+        return None
+    return max(images, key=lambda x: getattr(x, 'created', ''))
+
+
+def create_image(client, instance, name, metadata=None):
+    """
+    Snapshots the instance into an image and waits for the image to become active. Returns the image id.
+    """
+    image_id = api_create('nova', client.servers.create_image, instance, name, metadata)
+    print '    image %s created from %s' % (image_id, instance.name)
+    wait_for_state(client, 'images', image_id, 'active')
+    _catalog.invalidate('images')
     return image_id
 
 
 def check_flavor_exists(client, flavor):
-    for fl in client.flavors.list():
-        if fl.name == flavor:
-            return fl.id
-        elif fl.id == flavor:
-            return fl.id
+    fl = _catalog.lookup(client, 'flavors', flavor)
+    if fl:
+        return fl['id']
     raise RuntimeError('Requested flavor "%s" does not exist' % flavor)
 
 
 def find_flavor_name_by_id(client, flavor_id):
-    for fl in client.flavors.list():
-        if fl.id == flavor_id:
-            return fl.name
+    fl = _catalog.lookup(client, 'flavors', flavor_id, by_name=False)
+    if fl:
+        return fl['name']
 
     return flavor_id
 
 
+def find_flavor_by_id(client, flavor_id):
+    return _catalog.lookup(client, 'flavors', flavor_id, by_name=False)
+
+
 def check_secgroup_exists(client, secgroup):
-    for sg in client.security_groups.list():
-        if sg.name == secgroup:
-            return sg.id
-        elif sg.id == secgroup:
-            return sg.id
+    sg = _catalog.lookup(client, 'security_groups', secgroup)
+    if sg:
+        return sg['id']
     raise RuntimeError('Requested secgroup "%s" does not exist' % secgroup)
 
 
 def check_network_exists(client, network):
-    for net in client.networks.list():
-        if net.label == network:
-            return net.id
-        elif net.id == network:
-            return net.id
+    net = _catalog.lookup(client, 'networks', network)
+    if net:
+        return net['id']
     raise RuntimeError('Requested network "%s" does not exist' % network)
 
 
+def find_network_cidr(client, network):
+    net = _catalog.lookup(client, 'networks', network)
+    if net:
+        return net.get('cidr')
+    return None
+
+
 def create_sec_group(client, name, description):
-    return client.security_groups.create(name, description)
+    sg = api_create('nova', client.security_groups.create, name, description)
+    _catalog.invalidate('security_groups')
+    return sg
 
 
 def add_sec_group_rule(client, sec_group_id, ip_protocol, from_port, to_port, cidr):
-    client.security_group_rules.create(parent_group_id=sec_group_id,
-                                       ip_protocol=ip_protocol, from_port=from_port, to_port=to_port, cidr=cidr)
+    api_create('nova', client.security_group_rules.create, parent_group_id=sec_group_id,
+               ip_protocol=ip_protocol, from_port=from_port, to_port=to_port, cidr=cidr)
 
 
 def find_security_group_by_name(nova_client, name):
     try:
-        return nova_client.security_groups.find(name=name)
-    except NotFound:
-        return None
+        return api_call('nova', nova_client.security_groups.find, name=name)
+    except Exception as e:
+        if is_not_found(e):
+            return None
+        raise
 
 
 def create_local_access_rules(client, to_sec_group_name, from_sec_group_name):
     sg_to = find_security_group_by_name(client, to_sec_group_name)
     sg_from = find_security_group_by_name(client, from_sec_group_name)
 
-    client.security_group_rules.create(parent_group_id=sg_to.id, group_id=sg_from.id,
-                                       ip_protocol='tcp', from_port=1, to_port=65535)
-    client.security_group_rules.create(parent_group_id=sg_to.id, group_id=sg_from.id,
-                                       ip_protocol='udp', from_port=1, to_port=65535)
-    client.security_group_rules.create(parent_group_id=sg_to.id, group_id=sg_from.id,
-                                       ip_protocol='icmp', from_port=-1, to_port=-1)
+    api_create('nova', client.security_group_rules.create, parent_group_id=sg_to.id, group_id=sg_from.id,
+               ip_protocol='tcp', from_port=1, to_port=65535)
+    api_create('nova', client.security_group_rules.create, parent_group_id=sg_to.id, group_id=sg_from.id,
+               ip_protocol='udp', from_port=1, to_port=65535)
+    api_create('nova', client.security_group_rules.create, parent_group_id=sg_to.id, group_id=sg_from.id,
+               ip_protocol='icmp', from_port=-1, to_port=-1)
 
 
 def delete_sec_group(client, name):
     sg = find_security_group_by_name(client, name)
     if sg:
-        client.security_groups.delete(sg.id)
+        api_call('nova', client.security_groups.delete, sg.id)
+        _catalog.invalidate('security_groups')
         return sg.id
 
 
@@ -132,37 +657,39 @@ def delete_sec_group_rules(nova_client, name):
         return
     for rule in sg.rules:
         print "    deleting rule %s " % rule['id']
-        nova_client.security_group_rules.delete(rule['id'])
+        api_call('nova', nova_client.security_group_rules.delete, rule['id'])
 
 
 def check_server_group_exists(client, name, policies):
-    sgs = client.server_groups.list()
+    sgs = _catalog.entries(client, 'server_groups')
 
     for sg in sgs:
-        if sg.name == name and len(sg.policies) == len(policies):
-            for pol in sg.policies:
+        if sg['name'] == name and len(sg['policies']) == len(policies):
+            for pol in sg['policies']:
                 if pol not in policies:
                     continue
             for pol in policies:
-                if pol not in sg.policies:
+                if pol not in sg['policies']:
                     continue
 
-            return sg.id
+            return sg['id']
 
     raise RuntimeError('Requested server group "%s" with given policies (%s) does not exist' % (name, policies))
 
 
 def create_server_group(client, name, policies):
-    sg = client.server_groups.create(name=name, policies=policies)
+    sg = api_create('nova', client.server_groups.create, name=name, policies=policies)
+    _catalog.invalidate('server_groups')
     return sg.id
 
 
 def delete_server_group(client, name):
-    sgs = client.server_groups.list()
+    sgs = api_call('nova', client.server_groups.list)
 
     for sg in sgs:
         if sg.name == name:
-            client.server_groups.delete(sg.id)
+            api_call('nova', client.server_groups.delete, sg.id)
+            _catalog.invalidate('server_groups')
             return sg.id
 
     raise RuntimeError('Requested server group "%s" does not exist' % name)
@@ -177,59 +704,108 @@ def create_vm(client, name, image_id, flavor_id, key_name, sec_groups, network_i
     if server_group_id:
         scheduler_hints['group'] = server_group_id
 
-    instance = client.servers.create(name, image_id, flavor_id, key_name=key_name, security_groups=sec_groups,
-                                     nics=nics, scheduler_hints=scheduler_hints)
+    instance = api_create('nova', client.servers.create, name, image_id, flavor_id, key_name=key_name,
+                          security_groups=sec_groups, nics=nics, scheduler_hints=scheduler_hints)
 
     return instance.id
 
 
+def create_vms(client, names, image_id, flavor_id, key_name, sec_groups, network_id=None, server_group_id=None):
+    """
+    Boots an instance for each of the given names with a single multi-create request. Nova names the instances after
+    a temporary batch name, after which they are renamed. Returns the instance ids in the same order as the names.
+    """
+    nics = None
+    if network_id:
+        nics = [{'net-id': network_id}]
+
+    scheduler_hints = {}
+    if server_group_id:
+        scheduler_hints['group'] = server_group_id
+
+    batch_name = '%s-batch' % names[0]
+    api_create('nova', client.servers.create, batch_name, image_id, flavor_id, key_name=key_name,
+               security_groups=sec_groups, nics=nics, scheduler_hints=scheduler_hints,
+               min_count=len(names), max_count=len(names))
+
+    # depending on the configuration nova either uses the name as is or appends a running number to it
+    batch_re = re.compile('%s(-(\d+))?$' % re.escape(batch_name))
+    instances = [x for x in list_servers_by_name(client, '^%s' % re.escape(batch_name)) if batch_re.match(x.name)]
+    if len(instances) != len(names):
+        for instance in instances:
+            api_call('nova', instance.delete)
+        raise RuntimeError('Multi-create of %s returned %d instances instead of %d' % (
+            batch_name, len(instances), len(names)))
+
+    instances.sort(key=lambda x: (int(batch_re.match(x.name).group(2) or 0), x.id))
+    for name, instance in zip(names, instances):
+        api_call('nova', client.servers.update, instance, name=name)
+
+    return [x.id for x in instances]
+
+
 def delete_vm(instance):
-    instance.delete()
+    api_call('nova', instance.delete)
     print "    deleted instance %s" % instance.id
 
 
-def wait_for_deletion(client, object_type, instance_id):
-    while True:
-        try:
-            getattr(client, object_type).get(instance_id)
-            print '    object %s still exists' % instance_id
-            time.sleep(5)
-        except:
-            # object not found anymore
-            break
+def wait_for_deletion(client, object_type, instance_id, timeout=None):
+    watch_deletion(client, object_type, instance_id, timeout).result()
 
 
 def shutdown_vm(nova_client, node):
     if node.status.lower() == 'active':
-        node.reboot()
+        api_call('nova', node.reboot)
         wait_for_state(nova_client, 'servers', node.id, 'reboot|error')
         wait_for_state(nova_client, 'servers', node.id, 'shutoff|active|error')
-        node.stop()
+        api_call('nova', node.stop)
+
+
+def stop_vm(nova_client, node):
+    api_call('nova', node.stop)
+    wait_for_state(nova_client, 'servers', node.id, 'shutoff')
+
+
+def list_servers_by_name(client, name_regex):
+    # name is matched as a regular expression on the server side, so only matching servers are transferred
+    return api_call('nova', client.servers.list, search_opts={'name': name_regex})
+
+
+def list_servers_changed_since(client, name_regex, since):
+    """
+    Lists the matching servers that have changed after the given ISO 8601 timestamp. Servers deleted in the meantime
+    are included with status DELETED.
+    """
+    return api_call('nova', client.servers.list, search_opts={'name': name_regex, 'changes-since': since})
 
 
 def get_instance(client, instance_id):
     try:
-        return client.servers.get(instance_id)
-    except:
-        raise RuntimeError('Instance %s not found' % instance_id)
+        return api_call('nova', client.servers.get, instance_id)
+    except Exception as e:
+        if is_not_found(e):
+            raise RuntimeError('Instance %s not found' % instance_id)
+        raise
 
 
 def get_volume(client, volume_id):
     try:
-        return client.volumes.get(volume_id)
-    except:
-        raise RuntimeError('Volume %s not found' % volume_id)
+        return api_call('cinder', client.volumes.get, volume_id)
+    except Exception as e:
+        if is_not_found(e):
+            raise RuntimeError('Volume %s not found' % volume_id)
+        raise
 
 
 def create_and_attach_volume(nova_client, cinder_client, prov_state, instance,
                              name, size, dev, async=False):
-    volume = cinder_client.volumes.create(size, display_name=name)
+    volume = api_create('cinder', cinder_client.volumes.create, size, display_name=name)
     prov_state['volume.%s.id' % name] = volume.id
     print '    created volume %s' % volume.id
 
     wait_for_state(cinder_client, 'volumes', volume.id, 'available')
     print '    attaching volume %s to %s' % (volume.id, instance.id)
-    nova_client.volumes.create_server_volume(instance.id, volume.id, dev)
+    api_call('nova', nova_client.volumes.create_server_volume, instance.id, volume.id, dev)
     if not async:
         wait_for_state(cinder_client, 'volumes', volume.id, 'in-use')
 
@@ -239,37 +815,165 @@ def create_and_attach_volume(nova_client, cinder_client, prov_state, instance,
 def attach_volume(nova_client, cinder_client, instance, volume, dev, async=False):
     wait_for_state(cinder_client, 'volumes', volume.id, 'available')
     print '    attaching volume %s to %s' % (volume.id, instance.id)
-    nova_client.volumes.create_server_volume(instance.id, volume.id, dev)
+    api_call('nova', nova_client.volumes.create_server_volume, instance.id, volume.id, dev)
     if not async:
         wait_for_state(cinder_client, 'volumes', volume.id, 'in-use')
 
 
-def delete_volume_by_id(client, vol_id, wait_for_deletion=False):
-    # XXX: Cinder API has a potential race condition where a
-    # call for volume.delete will not actually delete the
-    # volume, which is why persistent polling is required
-    volume = get_volume(client, vol_id)
+# default number of volumes created and attached at the same time by VolumePipeline
+MAX_VOLUME_OPS = 8
+
+
+class VolumePipeline(object):
+    """
+    Creates and attaches a set of volumes. All the creates are issued up front and each volume is queued for
+    attaching as soon as it becomes available. The creates and attaches are run by 'max_in_flight' workers, so at
+    most that many attaches are in progress at a time. The time each volume reached each stage is recorded for the
+    timeline.
+    """
+
+    STAGES = ['created', 'available', 'attaching', 'in-use']
+
+    def __init__(self, nova_client, cinder_client, max_in_flight=MAX_VOLUME_OPS):
+        self.nova_client = nova_client
+        self.cinder_client = cinder_client
+        self.max_in_flight = max_in_flight
+        self.jobs = []
+        self.start_time = None
+        self._work = Queue.Queue()
+        self._num_unfinished = 0
+        self._lock = threading.Lock()
+
+    def add(self, instance, name, size, device, volume=None):
+        """
+        Adds a volume to be created and attached to instance, or an existing volume to be attached
+        """
+        self.jobs.append({'instance': instance, 'name': name, 'size': size, 'device': device, 'volume': volume,
+                          'created': False, 'error': None, 'timeline': {}})
+
+    def _mark(self, job, stage):
+        job['timeline'][stage] = time.time() - self.start_time
+
+    def _finish(self, job, error=None):
+        job['error'] = error
+        with self._lock:
+            self._num_unfinished -= 1
+            if self._num_unfinished:
+                return
+        # all done, stop the workers
+        for _ in range(self.max_in_flight):
+            self._work.put((None, None))
+
+    def _wait_available(self, job):
+        def on_available(future):
+            if future.error:
+                self._finish(job, future.error)
+                return
+            self._mark(job, 'available')
+            self._work.put((self._attach, job))
+        watch_state(self.cinder_client, 'volumes', job['volume'].id, 'available', callback=on_available)
+
+    def _create(self, job):
+        job['requested'] = time.time()
+        job['volume'] = api_create('cinder', self.cinder_client.volumes.create, job['size'],
+                                   display_name=job['name'])
+        job['created'] = True
+        self._mark(job, 'created')
+        print '    created volume %s' % job['volume'].id
+        self._wait_available(job)
+
+    def _attach(self, job):
+        volume = job['volume']
+        print '    attaching volume %s to %s as %s' % (volume.id, job['instance'].id, job['device'])
+        api_call('nova', self.nova_client.volumes.create_server_volume, job['instance'].id, volume.id,
+                 job['device'])
+        self._mark(job, 'attaching')
+        watch_state(self.cinder_client, 'volumes', volume.id, 'in-use').result()
+        self._mark(job, 'in-use')
+        self._finish(job)
+
+    def _worker(self):
+        while True:
+            func, job = self._work.get()
+            if not func:
+                return
+            worker_pool.set_output_prefix(job['name'])
+            try:
+                func(job)
+            except Exception as e:
+                print '    ERROR: %s' % e
+                self._finish(job, e)
+
+    def run(self):
+        if not self.jobs:
+            return self.jobs
+        self.start_time = time.time()
+        self._num_unfinished = len(self.jobs)
+        for job in self.jobs:
+            if job['volume']:
+                self._wait_available(job)
+            else:
+                self._work.put((self._create, job))
+        tasks = [('volumes', self._worker, ()) for _ in range(self.max_in_flight)]
+        worker_pool.run_in_parallel(tasks, self.max_in_flight)
+        return self.jobs
+
+    def get_timeline(self):
+        template = '    %-40s' + ' %10s' * len(self.STAGES)
+        lines = [template % tuple(['volume'] + self.STAGES)]
+        for job in self.jobs:
+            times = [('%.1f' % job['timeline'][x]) if x in job['timeline'] else '-' for x in self.STAGES]
+            lines.append(template % tuple([job['name']] + times))
+        return lines
+
+
+# time to wait for a set of volumes to be deleted
+VOLUME_DELETE_TIMEOUT = 600
+# volume states in which a delete is accepted, deletes are issued again only for volumes in these states
+VOLUME_DELETABLE_STATES = ['available', 'error']
+
+
+def delete_volumes(client, vol_ids, max_in_flight=MAX_VOLUME_OPS, timeout=VOLUME_DELETE_TIMEOUT):
+    """
+    Deletes the given volumes with at most max_in_flight delete calls running at a time and waits until all of them
+    are gone, tracking them with a single volume listing per poll. Returns the ids of the volumes that could not be
+    deleted.
+
+    Cinder has a race where a delete call is accepted but the volume is left intact, so deletes are issued again for
+    volumes that are still 'available' or 'error'. Volumes in other states (attached, detaching) are only waited for.
+    """
+    pending = set(vol_ids)
+    failed = []
+    to_delete = list(vol_ids)
+    deadline = time.time() + timeout
     while True:
-        if volume.status == 'deleting':
-            break
-        volume.delete()
-        time.sleep(5)
-        try:
-            # volumes in 'deleted' state will raise an exception with get_volume()
-            volume = get_volume(client, vol_id)
-        except:
-            break
-
-    if wait_for_deletion:
-        status = 'deleting'
-        while status == 'deleting':
-            print "    waiting for deletion"
-            status = ''
-            for vol in client.volumes.list():
-                if vol.id == vol_id:
-                    status = vol.status.lower()
-                    break
-            time.sleep(10)
+        if to_delete:
+            tasks = [(vol_id, api_call, ('cinder', client.volumes.delete, vol_id)) for vol_id in to_delete]
+            worker_pool.run_in_parallel(tasks, max_in_flight)
+
+        instrumentation.sleep('poll', POLL_INTERVAL)
+        states = dict((x.id, x.status.lower()) for x in api_call('cinder', client.volumes.list))
+        to_delete = []
+        for vol_id in list(pending):
+            status = states.get(vol_id)
+            if status is None:
+                print '    deleted volume %s' % vol_id
+                pending.remove(vol_id)
+            elif status == 'error_deleting':
+                print '    deleting volume %s failed' % vol_id
+                pending.remove(vol_id)
+                failed.append(vol_id)
+            elif status in VOLUME_DELETABLE_STATES:
+                to_delete.append(vol_id)
+
+        if not pending:
+            return failed
+
+        if time.time() > deadline:
+            print '    timed out waiting for deletion of %d volumes' % len(pending)
+            return failed + list(pending)
+
+        print '    waiting for deletion of %d volumes, deleting %d again' % (len(pending), len(to_delete))
 
 
 def get_addresses(instance, ip_type='fixed'):
@@ -278,53 +982,109 @@ def get_addresses(instance, ip_type='fixed'):
             if x['OS-EXT-IPS:type'] == ip_type]
 
 
-def find_free_floating_ip(nova_client):
-    fips = nova_client.floating_ips.list()
-    for fip in fips:
-        if not fip.instance_id:
+# time to wait for an association to show up in the server addresses before trying another address
+FIP_ASSOCIATE_TIMEOUT = 60
+FIP_ASSOCIATE_ATTEMPTS = 5
+# number of floating IPs allocated for the project at the same time
+MAX_FIP_CREATES = 8
+
+
+class FloatingIpAllocator(object):
+    """
+    Hands out free floating IPs of the project so that concurrent associations within this process never pick the
+    same address. Addresses can be reserved up front with prepare(), which allocates any shortfall from the first
+    floating IP pool in one go. An address taken with take() is left out of the free ones until it is given back
+    with release() after the association has been made or has failed, from then on the listing tells if it is free.
+    """
+
+    def __init__(self, nova_client):
+        self.nova_client = nova_client
+        self._reserved = []
+        # addresses being associated
+        self._handed_out = set()
+        self._lock = threading.Lock()
+
+    def _prepare(self, count):
+        reserved_ips = set(x.ip for x in self._reserved) | self._handed_out
+        for fip in api_call('nova', self.nova_client.floating_ips.list):
+            if len(self._reserved) >= count:
+                break
+            if not fip.instance_id and fip.ip not in reserved_ips:
+                self._reserved.append(fip)
+
+        shortfall = count - len(self._reserved)
+        if shortfall > 0:
+            pool = api_call('nova', self.nova_client.floating_ip_pools.list)[0].name
+            print '    not enough free IPs, allocating %d new IPs for the project' % shortfall
+            tasks = [('fip %d' % i, api_create, ('nova', self.nova_client.floating_ips.create, pool))
+                     for i in range(shortfall)]
+            results = worker_pool.run_in_parallel(tasks, MAX_FIP_CREATES)
+            for res in results:
+                if not res.error:
+                    print '    allocated a new IP for the project: %s' % res.result.ip
+                    self._reserved.append(res.result)
+            errors = [res.error for res in results if res.error]
+            if errors:
+                raise RuntimeError('Allocating %d floating IPs failed: %s' % (len(errors), errors[0]))
+
+    def prepare(self, count):
+        with self._lock:
+            self._prepare(count)
+
+    def take(self):
+        with self._lock:
+            if not self._reserved:
+                self._prepare(1)
+            fip = self._reserved.pop(0)
+            self._handed_out.add(fip.ip)
             return fip
 
+    def release(self, fip):
+        with self._lock:
+            self._handed_out.discard(fip.ip)
+
+
+_fip_allocators = {}
+_fip_allocators_lock = threading.Lock()
+
+
+def get_floating_ip_allocator(nova_client):
+    with _fip_allocators_lock:
+        if id(nova_client) not in _fip_allocators:
+            _fip_allocators[id(nova_client)] = FloatingIpAllocator(nova_client)
+        return _fip_allocators[id(nova_client)]
+
 
 def associate_floating_address(nova_client, vm, floating_ip='auto'):
     # statically selected floating ip
     if floating_ip != 'auto':
-        fips = nova_client.floating_ips.list()
+        fips = api_call('nova', nova_client.floating_ips.list)
         for fip in fips:
             if fip.ip == floating_ip:
                 if fip.instance_id:
                     raise RuntimeError('Selected floating IP is already in use: %s' % floating_ip)
                 else:
-                    vm.add_floating_ip(fip)
+                    api_call('nova', vm.add_floating_ip, fip)
                     return fip
 
         raise RuntimeError('Selected floating IP is not allocated to project: %s' % floating_ip)
 
     # automatically assigned
-    if floating_ip == 'auto':
-        while True:
-            # find a free address
-            free_fip = find_free_floating_ip(nova_client)
-
-            # if all are taken, allocate a new one
-            if not free_fip:
-                free_fip = nova_client.floating_ips.create(nova_client.floating_ip_pools.list()[0].name)
-                print '    no free IPs, allocated a new IP for the project: %s' % free_fip.ip
-
-            print '    selected free IP: %s' % free_fip.ip
-
-            # associate the ip with the server
-            # there is a potential race here, so minimize the risk by checking if we actually got the ip
-            # after a short sleep and if not, try again
-            vm.add_floating_ip(free_fip)
-            time.sleep(5)
-            fips = nova_client.floating_ips.list()
-            for fip in fips:
-                if fip.ip == free_fip.ip:
-                    if fip.instance_id == vm.id:
-                        return fip
-                    else:
-                        print '    selected IP was grabbed for another VM: %s %s' % (fip.ip, fip.instance_id)
-                        print '    retrying to auto-associate'
-                        break
-
-    raise RuntimeError('Invalid floating IP specified: %s' % floating_ip)
+    allocator = get_floating_ip_allocator(nova_client)
+    for _ in range(FIP_ASSOCIATE_ATTEMPTS):
+        free_fip = allocator.take()
+        print '    selected free IP: %s' % free_fip.ip
+
+        # another client may still grab the same address, so confirm the association from the server addresses
+        # and move on to the next address if it does not show up
+        try:
+            api_call('nova', vm.add_floating_ip, free_fip)
+            watch_floating_ip(nova_client, vm.id, free_fip.ip, FIP_ASSOCIATE_TIMEOUT).result()
+            return free_fip
+        except Exception as e:
+            print '    associating %s failed: %s' % (free_fip.ip, e)
+            print '    retrying to auto-associate'
+        finally:
+            allocator.release(free_fip)
+
+    raise RuntimeError('Unable to associate a floating IP after %d attempts' % FIP_ASSOCIATE_ATTEMPTS)
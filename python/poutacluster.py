@@ -11,12 +11,40 @@ import shlex
 import subprocess
 import sys
 import re
+import json
 import yaml
 import time
 import datetime
+import threading
 import openstack_api_wrapper as oaw
-
-NUM_PARALLEL_ANSIBLE_TASKS = 32
+import worker_pool
+import config_fingerprint
+import cluster_state
+import ssh_prober
+import node_pipeline
+import fact_cache
+import ansible_config
+import instrumentation
+import provisioning_log
+import cluster_watch
+import api_recorder
+
+CATALOG_CACHE_FILE = 'catalog-cache.json'
+INVENTORY_FILE = 'ansible-hosts'
+# executable that gives the inventory to ansible with 'poutacluster inventory', when enabled in the configuration
+INVENTORY_SCRIPT = 'ansible-inventory'
+NUM_PARALLEL_TEARDOWN = 16
+
+# metadata of the node images created with 'bake': the playbooks, the base image and the node groups (which decide
+# the installed packages) the image was configured with
+BAKED_PLAYBOOKS_KEY = 'poutacluster_playbooks'
+BAKED_BASE_IMAGE_KEY = 'poutacluster_base_image'
+BAKED_GROUPS_KEY = 'poutacluster_groups'
+# tasks that are not run on nodes booted from a baked image, the image already has their results
+BAKED_SKIP_TAGS = 'packages'
+
+# commands that can work on the cluster state from the local state store, the rest reload it from OpenStack
+STATE_STORE_COMMANDS = ['info', 'add_key', 'configure', 'update_firewall', 'reset_nodes', 'inventory']
 
 """
 Class to represent a cluster instance with one frontend and multiple nodes
@@ -32,11 +60,15 @@ class Cluster(object):
     nova_client = None
     cinder_client = None
     server_group_policy = None
+    baked_image_id = None
+    # temporary VM the node image is baked from
+    bake_node = None
 
-    def __init__(self, config, nova_client, cinder_client):
+    def __init__(self, config, nova_client, cinder_client, state_store=None):
         self.config = config
         self.nova_client = nova_client
         self.cinder_client = cinder_client
+        self.state_store = state_store
         if re.match('[a-zA-Z\d-]{1,57}$', config['cluster']['name']):
             self.name = config['cluster']['name']
         else:
@@ -52,14 +84,25 @@ class Cluster(object):
             self.server_group_policy = 'anti-affinity'
 
         self.__provisioning_log = []
+        # start times of the boots and volume attaches of this run, for logging their durations
+        self.__boot_started = {}
+        self.__attach_started = {}
+        # held when changing the frontend or the nodes while they are being provisioned in the background
+        self.state_lock = threading.Lock()
 
     def __prov_log(self, action, resource_type, resource_id, info=''):
         entry = {'time': datetime.datetime.now().isoformat(),
                  'action': action, 'resource_type': resource_type, 'resource_id': '%s' % resource_id, 'info': info}
         self.__provisioning_log.append(entry)
+        provisioning_log.log(action, resource_type, resource_id, info)
+        if self.state_store:
+            self.state_store.record_event(action, resource_type, '%s' % resource_id)
 
-    def __provision_vm(self, name, sec_groups, spec, network, server_group_name=None):
-        image_id = oaw.check_image_exists(self.nova_client, spec['image'])
+    def __resolve_vm_spec(self, spec, network, server_group_name):
+        if spec is self.config['node'] and self.baked_image_id:
+            image_id = self.baked_image_id
+        else:
+            image_id = oaw.check_image_exists(self.nova_client, spec['image'])
         flavor_id = oaw.check_flavor_exists(self.nova_client, spec['flavor'])
         server_group_id = None
         if self.server_group_policy and server_group_name:
@@ -72,28 +115,86 @@ class Cluster(object):
             network = os.environ['OS_TENANT_NAME']
         network_id = oaw.check_network_exists(self.nova_client, network)
 
+        return image_id, flavor_id, network, network_id, server_group_id
+
+    def __provision_vm(self, name, sec_groups, spec, network, server_group_name=None):
+        image_id, flavor_id, network, network_id, server_group_id = self.__resolve_vm_spec(
+            spec, network, server_group_name)
+
         print '    creating %s: %s  - %s' % (name, spec['image'], spec['flavor'])
         print "    using network '%s'" % network
+        boot_started = time.time()
         instance_id = oaw.create_vm(self.nova_client, name, image_id, flavor_id, spec['sec-key'], sec_groups,
                                     network_id, server_group_id)
 
         print '    instance %s created' % instance_id
         self.__prov_log('create', 'vm', instance_id, name)
+        self.__boot_started[instance_id] = boot_started
 
         instance = oaw.get_instance(self.nova_client, instance_id)
 
         return instance
 
+    def __provision_vm_batch(self, names, sec_groups, spec, network, server_group_name=None):
+        image_id, flavor_id, network, network_id, server_group_id = self.__resolve_vm_spec(
+            spec, network, server_group_name)
+
+        print '    creating %s - %s: %s  - %s' % (names[0], names[-1], spec['image'], spec['flavor'])
+        print "    using network '%s'" % network
+        boot_started = time.time()
+        instance_ids = oaw.create_vms(self.nova_client, names, image_id, flavor_id, spec['sec-key'], sec_groups,
+                                      network_id, server_group_id)
+
+        instances = []
+        for name, instance_id in zip(names, instance_ids):
+            print '    instance %s created as %s' % (instance_id, name)
+            self.__prov_log('create', 'vm', instance_id, name)
+            self.__boot_started[instance_id] = boot_started
+            instances.append(oaw.get_instance(self.nova_client, instance_id))
+
+        return instances
+
+    def __get_vm_log_fields(self, vm):
+        return {'flavor': oaw.find_flavor_name_by_id(self.nova_client, vm.flavor['id']),
+                'image': oaw.find_image_name_by_id(self.nova_client, (vm.image or {}).get('id'))}
+
+    def __wait_until_active(self, vm):
+        """
+        Waits for the VM to become active and returns it reloaded. The boot time of VMs created by this run is logged.
+        """
+        oaw.wait_for_state(self.nova_client, 'servers', vm.id, 'ACTIVE')
+        # reload information after instance has reached active state
+        vm = oaw.get_instance(self.nova_client, vm.id)
+        boot_started = self.__boot_started.pop(vm.id, None)
+        if boot_started:
+            provisioning_log.log_operation('boot', 'vm', vm.id, boot_started, info=vm.name,
+                                           **self.__get_vm_log_fields(vm))
+        return vm
+
+    def __attached(self, volume):
+        """
+        Logs the attach time of a volume attached by this run, after it has reached the in-use state
+        """
+        attach_started, fields = self.__attach_started.pop(volume.id, (None, None))
+        if attach_started:
+            provisioning_log.log_operation('volume attach', 'volume', volume.id, attach_started,
+                                           info=volume.display_name, **fields)
+
     def __provision_vm_addresses(self, instance, spec):
 
         print '    instance internal IP: %s' % oaw.get_addresses(instance)[0]
         if 'public-ip' in spec.keys():
             ip = spec['public-ip']
             print "    associating public IP %s" % ip
-            fip = oaw.associate_floating_address(self.nova_client, instance, ip)
+            with provisioning_log.timed('fip associate', 'fip', instance.id, info=instance.name):
+                fip = oaw.associate_floating_address(self.nova_client, instance, ip)
             print "    associated public IP %s" % fip.ip
 
-    def __provision_volumes(self, instance, volspec):
+    def __plan_volumes(self, instance, volspec):
+        """
+        Returns (name, size, device, existing volume or None) for each volume in volspec of the instance
+        """
+        plan = []
         vd = chr(ord('c'))
         for volconf in volspec:
             vol_name = '%s/%s' % (instance.name, volconf['name'])
@@ -110,6 +211,12 @@ class Cluster(object):
                 if vol.display_name == vol_name:
                     ex_vol = vol
                     break
+            plan.append((vol_name, vol_size, device, ex_vol))
+
+        return plan
+
+    def __provision_volumes(self, instance, volspec):
+        for vol_name, vol_size, device, ex_vol in self.__plan_volumes(instance, volspec):
             if ex_vol:
                 # we have an existing volume, let's check if we need to attach it
                 if instance.id in [x['server_id'] for x in ex_vol.attachments]:
@@ -118,14 +225,62 @@ class Cluster(object):
                     print "    attaching existing volume %s with size %s as device %s" % (
                         ex_vol.display_name, ex_vol.size, device)
                     oaw.attach_volume(self.nova_client, self.cinder_client, instance, ex_vol, device, async=True)
+                    self.__attach_started[ex_vol.id] = (time.time(), self.__get_vm_log_fields(instance))
 
             else:
                 print "    creating and attaching volume %s with size %s as device %s" % (vol_name, vol_size, device)
+                create_started = time.time()
                 vol = oaw.create_and_attach_volume(self.nova_client, self.cinder_client, {}, instance,
                                                    vol_name, vol_size, dev=device, async=True)
+                # the attach request is made right after the volume becomes available
+                fields = self.__get_vm_log_fields(instance)
+                provisioning_log.log_operation('volume create', 'volume', vol.id, create_started, info=vol_name,
+                                               **fields)
+                self.__attach_started[vol.id] = (time.time(), fields)
                 self.__prov_log('create', 'volume', vol.id, vol_name)
                 self.volumes.append(vol)
 
+    def __provision_volumes_pipelined(self, vms, max_in_flight):
+        # plan the devices for all the given VMs up front and push all the volumes through the pipeline
+        pipeline = oaw.VolumePipeline(self.nova_client, self.cinder_client, max_in_flight)
+        for instance, volspec in vms:
+            for vol_name, vol_size, device, ex_vol in self.__plan_volumes(instance, volspec):
+                if ex_vol and instance.id in [x['server_id'] for x in ex_vol.attachments]:
+                    print "    volume %s already attached" % vol_name
+                    continue
+                pipeline.add(instance, vol_name, vol_size, device, ex_vol)
+
+        print '    creating and attaching %d volumes, attaching %d at a time' % (len(pipeline.jobs), max_in_flight)
+        jobs = pipeline.run()
+        for job in jobs:
+            if job['created']:
+                self.__prov_log('create', 'volume', job['volume'].id, job['name'])
+                self.volumes.append(job['volume'])
+            self.__log_volume_job(pipeline, job)
+
+        print
+        for line in pipeline.get_timeline():
+            print line
+
+        failed = [job for job in jobs if job['error']]
+        if failed:
+            print
+            for job in failed:
+                print '    %s failed: %s' % (job['name'], job['error'])
+            raise RuntimeError('Provisioning failed for %d volumes: %s' % (len(failed), ', '.join(
+                job['name'] for job in failed)))
+
+    def __log_volume_job(self, pipeline, job):
+        timeline = job['timeline']
+        fields = self.__get_vm_log_fields(job['instance'])
+        if job['created'] and 'available' in timeline:
+            provisioning_log.log_operation('volume create', 'volume', job['volume'].id, job['requested'],
+                                           pipeline.start_time + timeline['available'], info=job['name'], **fields)
+        if 'attaching' in timeline and 'in-use' in timeline:
+            provisioning_log.log_operation('volume attach', 'volume', job['volume'].id,
+                                           pipeline.start_time + timeline['attaching'],
+                                           pipeline.start_time + timeline['in-use'], info=job['name'], **fields)
+
     def _provision_ext_sec_group(self, custom_ext_rules=None):
         sg_name_ext = self.name + '-ext'
         try:
@@ -195,7 +350,7 @@ class Cluster(object):
             sg_id = oaw.create_server_group(self.nova_client, self.name, [self.server_group_policy])
             self.__prov_log('create', 'server-group', sg_id, self.name)
 
-    def __provision_frontend(self):
+    def __provision_frontend(self, provision_volumes=True):
         fe_name = self.name + '-fe'
 
         if self.frontend:
@@ -206,11 +361,9 @@ class Cluster(object):
                                                 self.config['cluster']['network'],
                                                 server_group_name=self.name)
 
-        oaw.wait_for_state(self.nova_client, 'servers', self.frontend.id, 'ACTIVE')
-        # reload information after instance has reached active state
-        self.frontend = oaw.get_instance(self.nova_client, self.frontend.id)
+        self.frontend = self.__wait_until_active(self.frontend)
         self.__provision_vm_addresses(self.frontend, self.config['frontend'])
-        if 'volumes' in self.config['frontend']:
+        if provision_volumes and 'volumes' in self.config['frontend']:
             self.__provision_volumes(self.frontend, self.config['frontend']['volumes'])
 
     def __provision_nodes(self, num_nodes):
@@ -239,15 +392,113 @@ class Cluster(object):
         for i in range(0, len(self.nodes)):
             node = self.nodes[i]
             print '    setup network and volumes for %s' % node.name
-            oaw.wait_for_state(self.nova_client, 'servers', node.id, 'ACTIVE')
-            # reload information after instance has reached active state
-            node = oaw.get_instance(self.nova_client, node.id)
+            node = self.__wait_until_active(node)
             self.nodes[i] = node
             self.__provision_vm_addresses(node, self.config['node'])
             if 'volumes' in self.config['node']:
                 self.__provision_volumes(node, self.config['node']['volumes'])
             print
 
+    def __boot_nodes_in_batches(self, num_nodes, batch_size):
+        node_base = self.name + '-node'
+        existing = set(n.name for n in self.nodes)
+        missing = [x for x in ['%s%02d' % (node_base, i) for i in range(1, num_nodes + 1)] if x not in existing]
+
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            if len(batch) > 1:
+                try:
+                    self.nodes.extend(self.__provision_vm_batch(batch, [self.name + '-int'],
+                                                                self.config['node'],
+                                                                self.config['cluster']['network'],
+                                                                server_group_name=self.name))
+                    print
+                    continue
+                except Exception as e:
+                    print '    multi-create failed, falling back to single creates: %s' % e
+
+            for node_name in batch:
+                self.nodes.append(self.__provision_vm(node_name, [self.name + '-int'],
+                                                      self.config['node'],
+                                                      self.config['cluster']['network'],
+                                                      server_group_name=self.name))
+            print
+
+        self.nodes.sort(key=lambda x: x.name)
+
+    def __provision_node(self, node_name, node):
+        if node:
+            print '    %s already provisioned' % node_name
+        else:
+            node = self.__provision_vm(node_name, [self.name + '-int'],
+                                       self.config['node'],
+                                       self.config['cluster']['network'],
+                                       server_group_name=self.name)
+
+        node = self.__wait_until_active(node)
+        print '    setup network for %s' % node.name
+        self.__provision_vm_addresses(node, self.config['node'])
+
+        return node
+
+    def __provision_named_nodes_parallel(self, node_names, num_workers):
+        existing = dict((n.name, n) for n in self.nodes)
+        tasks = [(name, self.__provision_node, (name, existing.get(name))) for name in node_names]
+        print '    provisioning %d nodes with %d parallel workers' % (len(tasks), num_workers)
+        results = worker_pool.run_in_parallel(tasks, num_workers)
+
+        return [res.result for res in results if not res.error], [res for res in results if res.error]
+
+    @staticmethod
+    def __raise_for_failed_nodes(failed):
+        if failed:
+            print
+            for res in failed:
+                print '    %s failed: %s' % (res.name, res.error)
+            raise RuntimeError('Provisioning failed for %d nodes: %s' % (len(failed), ', '.join(
+                res.name for res in failed)))
+
+    def __provision_nodes_parallel(self, num_nodes, num_workers):
+        node_base = self.name + '-node'
+
+        # nodes that already exist beyond num_nodes are set up as well, like in the sequential version
+        node_names = set(n.name for n in self.nodes)
+        node_names.update('%s%02d' % (node_base, i) for i in range(1, num_nodes + 1))
+
+        self.nodes, failed = self.__provision_named_nodes_parallel(sorted(node_names), num_workers)
+        self.__raise_for_failed_nodes(failed)
+
+    def __provision_vm_stages(self, name, kind, vm, timeline):
+        """
+        Takes a VM of the given kind ('frontend' or 'node') through booting, addresses and volumes, marking each
+        stage in timeline. Returns the updated VM.
+        """
+        spec = self.config[kind]
+        if vm:
+            print '    %s already provisioned' % name
+        else:
+            sec_groups = [self.name + '-int']
+            if kind == 'frontend':
+                sec_groups.insert(0, self.name + '-ext')
+            vm = self.__provision_vm(name, sec_groups, spec, self.config['cluster']['network'],
+                                     server_group_name=self.name)
+
+        vm = self.__wait_until_active(vm)
+        timeline.mark(name, 'booted')
+        self.__provision_vm_addresses(vm, spec)
+        timeline.mark(name, 'addressed')
+
+        if 'volumes' in spec:
+            self.__provision_volumes(vm, spec['volumes'])
+            attach_states = [(vol, oaw.watch_state(self.cinder_client, 'volumes', vol.id, 'in-use'))
+                             for vol in list(self.volumes) if vol.display_name.startswith(name + '/')]
+            for vol, attach_state in attach_states:
+                attach_state.result()
+                self.__attached(vol)
+        timeline.mark(name, 'volumes attached')
+
+        return vm
+
     @staticmethod
     def __filter_volumes_for_node(volumes, vm_name):
         return [x for x in volumes
@@ -268,16 +519,51 @@ class Cluster(object):
     def load_provisioned_state(self):
         print "Loading cluster state from OpenStack"
 
+        started_at = cluster_state.ClusterStateStore.timestamp()
+        vms = oaw.list_servers_by_name(self.nova_client, '^%s-' % self.name)
+        all_vols = oaw.api_call('cinder', self.cinder_client.volumes.list)
+        if self.state_store:
+            self.state_store.replace(vms, all_vols, started_at)
+
+        self.__set_state(vms, all_vols)
+
+    def load_stored_state(self):
+        """
+        Loads the cluster state from the local state store after an incremental refresh. Falls back to
+        load_provisioned_state() if there is no store or its state is too old.
+        """
+        if not self.state_store or not self.state_store.is_valid():
+            return self.load_provisioned_state()
+
+        print "Loading cluster state from %s" % self.state_store.path
+        self.state_store.refresh(self.nova_client, self.cinder_client)
+        self.__set_state(self.state_store.get_servers(self.nova_client),
+                         self.state_store.get_volumes(self.cinder_client))
+
+    def save_state(self):
+        """
+        Brings the local state store up to date after the command has made changes
+        """
+        if self.state_store and self.state_store.is_valid():
+            self.state_store.refresh(self.nova_client, self.cinder_client)
+
+    def __set_state(self, vms, all_vols):
         # reset the state
         self.frontend = None
         self.nodes = []
         self.volumes = []
 
-        vms = self.nova_client.servers.list()
-        all_vols = self.cinder_client.volumes.list()
+        # index servers by name and volumes by the name of the VM they belong to
+        vms_by_name = {}
+        for vm in vms:
+            vms_by_name.setdefault(vm.name, []).append(vm)
+        vols_by_vm_name = {}
+        for vol in all_vols:
+            if vol.display_name and '/' in vol.display_name and vol.status in ['in-use', 'available']:
+                vols_by_vm_name.setdefault(vol.display_name.split('/', 1)[0], []).append(vol)
 
         fe_name = '%s-fe' % self.name
-        existing_nodes = filter(lambda lx: lx.name == fe_name, vms)
+        existing_nodes = vms_by_name.get(fe_name, [])
         if len(existing_nodes) > 1:
             raise RuntimeError('More than one frontend VM with the name %s found, unable to continue' % fe_name)
         if len(existing_nodes) == 1:
@@ -285,16 +571,16 @@ class Cluster(object):
             print '    found frontend %s' % self.frontend.name
 
         # find volumes created for the frontend
-        fe_vols = self.__filter_volumes_for_node(all_vols, fe_name)
+        fe_vols = vols_by_vm_name.get(fe_name, [])
         for vol in fe_vols:
             print "    found volume %s" % vol.display_name
         self.volumes.extend(fe_vols)
 
-        # find cluster nodes
-        node_base = '%s-node' % self.name
-        for i in range(1, 100):
-            node_name = '%s%02d' % (node_base, i)
-            existing_nodes = filter(lambda lx: lx.name == node_name, vms)
+        # find cluster nodes, either running or with volumes left from earlier runs
+        node_re = re.compile('%s-node(\d{2,})$' % self.name)
+        node_names = [x for x in set(vms_by_name.keys()) | set(vols_by_vm_name.keys()) if node_re.match(x)]
+        for node_name in sorted(node_names, key=lambda x: int(node_re.match(x).group(1))):
+            existing_nodes = vms_by_name.get(node_name, [])
             if len(existing_nodes) == 1:
                 node = existing_nodes[0]
                 print '    found node %s' % node.name
@@ -303,75 +589,323 @@ class Cluster(object):
                 raise RuntimeError('More than one VM with the name %s found, unable to continue' % node_name)
 
             # find volumes created for the node
-            node_vols = self.__filter_volumes_for_node(all_vols, node_name)
+            node_vols = vols_by_vm_name.get(node_name, [])
             for vol in node_vols:
                 print "    found volume %s" % vol.display_name
 
             self.volumes.extend(node_vols)
 
+        # a bake node left over from an interrupted 'bake'
+        existing_nodes = vms_by_name.get(self.get_bake_node_name(), [])
+        if existing_nodes:
+            self.bake_node = existing_nodes[0]
+            print '    found bake node %s' % self.bake_node.name
+
         if not self.frontend and len(self.nodes) == 0 and len(self.volumes) == 0:
             print "    no existing resources found"
 
-    def up(self, num_nodes):
+    def get_bake_metadata(self, playbook_hash):
+        """
+        Returns the metadata of a node image baked from the configured node image with the given playbooks
+        """
+        return {
+            BAKED_PLAYBOOKS_KEY: playbook_hash,
+            BAKED_BASE_IMAGE_KEY: oaw.check_image_exists(self.nova_client, self.config['node']['image']),
+            BAKED_GROUPS_KEY: ','.join(sorted(self.config['node'].get('groups', []))),
+        }
+
+    def use_baked_image(self, playbook_hash):
+        """
+        Boots the new nodes from the image baked with the given playbooks, if there is one. Returns the image or None.
+        """
+        image = oaw.find_image_by_metadata(self.nova_client, self.get_bake_metadata(playbook_hash))
+        if image:
+            print "    nodes will boot from the baked image %s" % image.name
+            self.baked_image_id = image.id
+        return image
+
+    def get_baked_nodes(self):
+        """
+        Returns the names of the nodes booted from the baked image in use
+        """
+        if not self.baked_image_id:
+            return []
+        return [node.name for node in self.nodes if (node.image or {}).get('id') == self.baked_image_id]
+
+    def get_bake_node_name(self):
+        return '%s-bake' % self.name
+
+    def provision_bake_node(self):
+        """
+        Boots a temporary node from the configured node image for baking, without volumes or a public IP. A bake
+        node left over from an earlier run is deleted first.
+        """
+        self.delete_bake_node()
+        self.bake_node = self.__provision_vm(self.get_bake_node_name(), [self.name + '-ext', self.name + '-int'],
+                                             self.config['node'], self.config['cluster']['network'])
+        self.bake_node = self.__wait_until_active(self.bake_node)
+        print '    instance internal IP: %s' % oaw.get_addresses(self.bake_node)[0]
+
+    def delete_bake_node(self):
+        if not self.bake_node:
+            return
+        self.__delete_vm(self.bake_node, clean_shutdown=False)
+        oaw.wait_for_deletion(self.nova_client, 'servers', self.bake_node.id)
+        self.bake_node = None
+
+    def bake_node_image(self, node, metadata):
+        """
+        Snapshots a node into an image with the given metadata. The node is stopped for the snapshot. Returns the
+        image id.
+        """
+        image_name = '%s-node-%s' % (self.name, metadata[BAKED_PLAYBOOKS_KEY][:12])
+        print "    stopping %s" % node.name
+        oaw.stop_vm(self.nova_client, node)
+        print "    creating image %s" % image_name
+        image_id = oaw.create_image(self.nova_client, node, image_name, metadata)
+        self.__prov_log('create', 'image', image_id, image_name)
+        return image_id
+
+    def __prepare_up(self, num_nodes):
         print
         print "Provisioning security groups"
-        self.__provision_sec_groups()
+        with instrumentation.phase('security groups'):
+            self.__provision_sec_groups()
 
         print
         print "Provisioning server group"
-        self.__provision_server_group()
+        with instrumentation.phase('server group'):
+            self.__provision_server_group()
+
+        # reserve the floating IPs for all VMs that need one, allocating more for the project in one go if needed
+        num_fips = 0
+        if self.config['frontend'].get('public-ip') == 'auto' and not self.get_public_ip(self.frontend):
+            num_fips += 1
+        if self.config['node'].get('public-ip') == 'auto':
+            num_fips += num_nodes - len([x for x in self.nodes if self.get_public_ip(x)])
+        if num_fips > 0:
+            print
+            print "Reserving %d floating IPs" % num_fips
+            with instrumentation.phase('floating IPs'):
+                oaw.get_floating_ip_allocator(self.nova_client).prepare(num_fips)
+
+    def up(self, num_nodes, parallel=1, batch_size=1):
+        self.__prepare_up(num_nodes)
 
         print
         print "Provisioning cluster frontend"
-        self.__provision_frontend()
+        # in parallel mode the volumes for the whole cluster are provisioned in one go after the VMs
+        with instrumentation.phase('frontend'):
+            self.__provision_frontend(provision_volumes=(parallel <= 1))
 
         print
         print "Provisioning %d cluster nodes" % num_nodes
-        self.__provision_nodes(num_nodes)
+        if batch_size > 1:
+            print "    booting missing nodes in batches of %d" % batch_size
+            with instrumentation.phase('boot node batches'):
+                self.__boot_nodes_in_batches(num_nodes, batch_size)
+        if parallel > 1:
+            with instrumentation.phase('nodes'):
+                self.__provision_nodes_parallel(num_nodes, parallel)
+
+            vms = []
+            if 'volumes' in self.config['frontend']:
+                vms.append((self.frontend, self.config['frontend']['volumes']))
+            if 'volumes' in self.config['node']:
+                vms.extend((node, self.config['node']['volumes']) for node in self.nodes)
+
+            print
+            print "Provisioning volumes"
+            with instrumentation.phase('volumes'):
+                self.__provision_volumes_pipelined(vms, parallel)
+        else:
+            with instrumentation.phase('nodes and volumes'):
+                self.__provision_nodes(num_nodes)
 
         # only wait for attaching if there are volumes to be attached.
         if 'volumes' in self.config['node']:
             print
             print "Checking volume attach state"
-            for node in self.nodes:
-                for vol in self.volumes:
-                    if not vol.display_name.startswith(node.name + '/'):
-                        continue
+            with instrumentation.phase('volume attach'):
+                # register all volumes with the watcher first, so that they are tracked in the same polls
+                attach_states = []
+                for node in self.nodes:
+                    for vol in self.volumes:
+                        if not vol.display_name.startswith(node.name + '/'):
+                            continue
+                        attach_states.append(
+                            (vol, oaw.watch_state(self.cinder_client, 'volumes', vol.id, 'in-use')))
+                for vol, attach_state in attach_states:
                     print "    %s" % vol.display_name
-                    oaw.wait_for_state(self.cinder_client, 'volumes', vol.id, 'in-use')
+                    print '    state now %s' % attach_state.result()
+                    self.__attached(vol)
                     print
 
-    def down(self, clean_shutdown=True):
-        # take nodes down in reverse order
-        for node in self.nodes[::-1]:
-            if clean_shutdown:
-                print "Shutting down and deleting %s" % node.name
-                oaw.shutdown_vm(self.nova_client, node)
-            else:
-                print "Deleting %s" % node.name
-            oaw.delete_vm(node)
-            self.__prov_log('delete', 'vm', node.id, node.name)
-            time.sleep(1)
+    def up_pipelined(self, num_nodes, parallel, on_vm_ready, timeline):
+        """
+        Provisions the cluster like up(), but every VM is booted, gets its addresses and volumes on its own. VMs are
+        added to the cluster as soon as they are complete and on_vm_ready(vm) is called for them, so that they can
+        be configured while the rest are still being provisioned.
+        """
+        self.__prepare_up(num_nodes)
 
-        # check that all the nodes have actually been deleted
-        for node in self.nodes[::-1]:
+        fe_name = self.name + '-fe'
+        existing = dict((n.name, n) for n in self.nodes)
+        # nodes that already exist beyond num_nodes are set up as well, like in up()
+        node_names = set(existing.keys())
+        node_names.update('%s-node%02d' % (self.name, i) for i in range(1, num_nodes + 1))
+        with self.state_lock:
+            self.nodes = []
+
+        def provision(name, kind, vm):
+            vm = self.__provision_vm_stages(name, kind, vm, timeline)
+            with self.state_lock:
+                if kind == 'frontend':
+                    self.frontend = vm
+                else:
+                    self.nodes = sorted(self.nodes + [vm], key=lambda x: self.__node_index(x.name))
+            on_vm_ready(vm)
+            return vm
+
+        print
+        print "Provisioning the frontend and %d cluster nodes with %d parallel workers" % (len(node_names), parallel)
+        tasks = [(fe_name, provision, (fe_name, 'frontend', self.frontend))]
+        tasks.extend((name, provision, (name, 'node', existing.get(name))) for name in sorted(node_names))
+        with instrumentation.phase('frontend and nodes'):
+            results = worker_pool.run_in_parallel(tasks, parallel)
+        self.__raise_for_failed_nodes([res for res in results if res.error])
+
+    def __node_index(self, node_name):
+        m = re.match('%s-node(\d{2,})$' % self.name, node_name)
+        return int(m.group(1))
+
+    def get_surplus_nodes(self, num_nodes):
+        return [node for node in self.nodes if self.__node_index(node.name) > num_nodes]
+
+    def resize(self, num_nodes, parallel=1):
+        """
+        Brings the number of nodes to num_nodes by provisioning the missing nodes or deleting the surplus ones.
+        Returns the names of the added and the removed nodes.
+        """
+        node_base = self.name + '-node'
+        existing = set(n.name for n in self.nodes)
+        missing = [x for x in ['%s%02d' % (node_base, i) for i in range(1, num_nodes + 1)] if x not in existing]
+        surplus = self.get_surplus_nodes(num_nodes)
+
+        if surplus:
+            print
+            print "Removing %d surplus nodes" % len(surplus)
+            self.__remove_nodes(surplus, parallel)
+
+        if missing:
+            if self.config['node'].get('public-ip') == 'auto':
+                oaw.get_floating_ip_allocator(self.nova_client).prepare(len(missing))
+            print
+            print "Provisioning %d new nodes" % len(missing)
+            self.__add_nodes(missing, parallel)
+
+        return missing, [node.name for node in surplus]
+
+    def __add_nodes(self, node_names, parallel):
+        if parallel > 1:
+            new_nodes, failed = self.__provision_named_nodes_parallel(node_names, parallel)
+        else:
+            new_nodes, failed = [], []
+            for node_name in node_names:
+                new_nodes.append(self.__provision_node(node_name, None))
+                print
+        self.nodes = sorted(self.nodes + new_nodes, key=lambda x: self.__node_index(x.name))
+
+        if 'volumes' in self.config['node'] and new_nodes:
+            print
+            print "Provisioning volumes for the new nodes"
+            if parallel > 1:
+                self.__provision_volumes_pipelined([(x, self.config['node']['volumes']) for x in new_nodes],
+                                                   parallel)
+            else:
+                for node in new_nodes:
+                    self.__provision_volumes(node, self.config['node']['volumes'])
+                attach_states = [(vol, oaw.watch_state(self.cinder_client, 'volumes', vol.id, 'in-use'))
+                                 for node in new_nodes for vol in self.volumes
+                                 if vol.display_name.startswith(node.name + '/')]
+                for vol, attach_state in attach_states:
+                    attach_state.result()
+                    self.__attached(vol)
+
+        self.__raise_for_failed_nodes(failed)
+
+    def __remove_nodes(self, nodes, parallel):
+        tasks = [(node.name, self.__delete_vm, (node, True)) for node in nodes[::-1]]
+        results = worker_pool.run_in_parallel(tasks, parallel)
+        deleted = [node for node, res in zip(nodes[::-1], results) if not res.error]
+
+        deletions = [(node, oaw.watch_deletion(self.nova_client, 'servers', node.id)) for node in deleted]
+        for node, deletion in deletions:
             print "Checking deletion state for %s" % node.name
-            oaw.wait_for_deletion(self.nova_client, 'servers', node.id)
+            deletion.result()
+        self.nodes = [node for node in self.nodes if node not in deleted]
+
+        failed = [res for res in results if res.error]
+        if failed:
+            raise RuntimeError('Deleting failed for %d nodes: %s' % (
+                len(failed), ', '.join(res.name for res in failed)))
+
+    def __delete_vm(self, vm, clean_shutdown):
+        if clean_shutdown:
+            print "Shutting down and deleting %s" % vm.name
+            oaw.shutdown_vm(self.nova_client, vm)
+        else:
+            print "Deleting %s" % vm.name
+        oaw.delete_vm(vm)
+        self.__prov_log('delete', 'vm', vm.id, vm.name)
 
-        self.nodes = []
+    def down(self, clean_shutdown=True, parallel=1):
+        with instrumentation.phase('nodes down'):
+            failed = self.__take_nodes_down(clean_shutdown, parallel)
+
+        self.nodes = failed
+        if failed:
+            raise RuntimeError('Deleting failed for %d nodes, leaving the frontend up: %s' % (
+                len(failed), ', '.join(node.name for node in failed)))
+
+        # a bake node left over from an interrupted 'bake'
+        self.delete_bake_node()
 
         # take the frontend down last
         if self.frontend:
-            if clean_shutdown:
-                print "Shutting down and deleting %s " % self.frontend.name
-                oaw.shutdown_vm(self.nova_client, self.frontend)
-            else:
-                print "Deleting %s " % self.frontend.name
-            oaw.delete_vm(self.frontend)
-            oaw.wait_for_deletion(self.nova_client, 'servers', self.frontend.id)
+            with instrumentation.phase('frontend down'):
+                if clean_shutdown:
+                    print "Shutting down and deleting %s " % self.frontend.name
+                    oaw.shutdown_vm(self.nova_client, self.frontend)
+                else:
+                    print "Deleting %s " % self.frontend.name
+                oaw.delete_vm(self.frontend)
+                oaw.wait_for_deletion(self.nova_client, 'servers', self.frontend.id)
             self.__prov_log('delete', 'vm', self.frontend.id, self.frontend.name)
             self.frontend = None
 
+    def __take_nodes_down(self, clean_shutdown, parallel):
+        if parallel > 1:
+            # the nodes are independent of each other, only the frontend (NFS server) has to wait for all of them
+            tasks = [(node.name, self.__delete_vm, (node, clean_shutdown)) for node in self.nodes[::-1]]
+            print "Taking down %d nodes with %d parallel workers" % (len(tasks), parallel)
+            results = worker_pool.run_in_parallel(tasks, parallel)
+            failed = [node for node, res in zip(self.nodes[::-1], results) if res.error]
+            self.nodes = [node for node in self.nodes if node not in failed]
+        else:
+            failed = []
+            # take nodes down in reverse order
+            for node in self.nodes[::-1]:
+                self.__delete_vm(node, clean_shutdown)
+
+        # check that all the nodes have actually been deleted
+        deletions = [(node, oaw.watch_deletion(self.nova_client, 'servers', node.id)) for node in self.nodes[::-1]]
+        for node, deletion in deletions:
+            print "Checking deletion state for %s" % node.name
+            deletion.result()
+
+        return failed
+
     def destroy_volumes(self, grace_time=10):
         if self.frontend or len(self.nodes) > 0:
             print
@@ -393,11 +927,16 @@ class Cluster(object):
                 time.sleep(1)
             print ""
 
-        # delete volumes in reverse order, frontend last
         for vol in self.volumes[::-1]:
             print "Deleting volume %s %s" % (vol.id, vol.display_name)
-            oaw.delete_volume_by_id(self.cinder_client, vol.id, True)
-            self.__prov_log('delete', 'volume', vol.id, vol.display_name)
+        with instrumentation.phase('volume deletion'):
+            failed = oaw.delete_volumes(self.cinder_client, [vol.id for vol in self.volumes[::-1]])
+        for vol in self.volumes[::-1]:
+            if vol.id not in failed:
+                self.__prov_log('delete', 'volume', vol.id, vol.display_name)
+
+        if failed:
+            raise RuntimeError('Deleting failed for %d volumes: %s' % (len(failed), ', '.join(failed)))
 
     def cleanup(self):
         print "Cleaning server and security groups"
@@ -427,9 +966,8 @@ class Cluster(object):
     def reset_nodes(self):
         for node in self.nodes:
             print "Hard resetting %s" % node.name
-            node.reboot(reboot_type='HARD')
-            # rate limit on resets, otherwise API will give an error
-            time.sleep(3)
+            # resets are rate limited by the API call gateway, otherwise API will give an error
+            oaw.api_call('nova', node.reboot, reboot_type='HARD')
 
     @staticmethod
     def get_public_ip(vm):
@@ -483,81 +1021,107 @@ class Cluster(object):
 
         return res
 
-    def generate_ansible_inventory(self):
-
-        # noinspection PyListCreation
-        lines = []
-        lines.append('# WARNING: this file will be overwritten whenever cluster provisioning is run')
+    def get_ansible_inventory(self):
+        """
+        Returns the ansible inventory of the cluster in the JSON dynamic inventory format. Every host is listed only
+        in the 'frontend' or the 'node' group, the role groups from the configuration have these as children.
+        """
+        inventory = {'_meta': {'hostvars': {}}}
         if not self.frontend:
-            return lines
+            return inventory
 
-        def get_line_for_host(config, vm):
-            name = vm.name
-            ip = oaw.get_addresses(vm)[0]
-            admin_user = config['admin-user']
-            return '%s ansible_ssh_host=%s ansible_ssh_user=%s' % (name, ip, admin_user)
+        def get_host_vars(config, vm):
+            return {'ansible_ssh_host': oaw.get_addresses(vm)[0], 'ansible_ssh_user': config['admin-user']}
 
         def get_volume_vars(conf):
-            vol_vars = []
+            vol_vars = {}
             if 'volumes' in conf:
                 for vol_spec in conf['volumes']:
                     if vol_spec['name'] == 'local_data':
-                        if 'device' in vol_spec:
-                            vol_vars.append('local_data_device=%s' % vol_spec['device'])
-                        else:
-                            vol_vars.append('local_data_device=/dev/vdc')
+                        vol_vars['local_data_device'] = vol_spec.get('device', '/dev/vdc')
                     elif vol_spec['name'] == 'shared_data':
-                        if 'device' in vol_spec:
-                            vol_vars.append('shared_data_device=%s' % vol_spec['device'])
-                        else:
-                            vol_vars.append('shared_data_device=/dev/vdd')
+                        vol_vars['shared_data_device'] = vol_spec.get('device', '/dev/vdd')
                     else:
                         print 'WARN: unknown magic volume name %s ' % vol_spec['name']
             return vol_vars
 
-        # generate frontend groups
-        if 'groups' in self.config['frontend']:
-            for group in self.config['frontend']['groups']:
-                lines.append('[%s]' % group)
-                lines.append(get_line_for_host(self.config['frontend'], self.frontend))
-                lines.append('')
-
-        lines.append('[frontend]')
-        lines.append(get_line_for_host(self.config['frontend'], self.frontend))
-        lines.append('')
-
-        # generate node groups
-        if 'groups' in self.config['node']:
-            for group in self.config['node']['groups']:
-                lines.append('[%s]' % group)
-                for node in self.nodes:
-                    lines.append(get_line_for_host(self.config['node'], node))
-                lines.append('')
+        hostvars = inventory['_meta']['hostvars']
+        # the bake node is configured like the nodes
+        nodes = self.nodes + ([self.bake_node] if self.bake_node else [])
+        hostvars[self.frontend.name] = get_host_vars(self.config['frontend'], self.frontend)
+        for node in nodes:
+            hostvars[node.name] = get_host_vars(self.config['node'], node)
+
+        inventory['frontend'] = {'hosts': [self.frontend.name], 'vars': get_volume_vars(self.config['frontend'])}
+        inventory['node'] = {'hosts': [node.name for node in nodes], 'vars': get_volume_vars(self.config['node'])}
+        for kind in 'frontend', 'node':
+            for group in self.config[kind].get('groups', []):
+                inventory.setdefault(group, {'children': []})['children'].append(kind)
+
+        inventory['all'] = {
+            'children': ['frontend', 'node'],
+            'vars': {'local_data_dir': '/mnt/local_data', 'shared_data_dir': '/mnt/shared_data'},
+        }
+
+        return inventory
+
+    def get_provider_facts(self):
+        """
+        Returns the ansible facts of the hosts that are known from OpenStack, as host name -> (VM id, facts)
+        """
+        res = {}
+        if not self.frontend:
+            return res
+        for vm in [self.frontend] + self.nodes + ([self.bake_node] if self.bake_node else []):
+            address = oaw.get_addresses(vm)[0]
+            network = [label for label, addrs in vm.addresses.items() if address in [x['addr'] for x in addrs]][0]
+            flavor = oaw.find_flavor_by_id(self.nova_client, vm.flavor['id'])
+            res[vm.name] = (vm.id, fact_cache.get_provider_facts(
+                address, oaw.find_network_cidr(self.nova_client, network), flavor))
+        return res
 
-        lines.append('[node]')
-        for node in self.nodes:
-            lines.append(get_line_for_host(self.config['node'], node))
-        lines.append('')
+    def generate_ansible_inventory(self):
 
-        # generate frontend variables
-        lines.append('[frontend:vars]')
-        lines.extend(get_volume_vars(self.config['frontend']))
-        lines.append('')
+        # noinspection PyListCreation
+        lines = []
+        lines.append('# WARNING: this file will be overwritten whenever cluster provisioning is run')
+        if not self.frontend:
+            return lines
 
-        # generate node variables
-        lines.append('[node:vars]')
-        lines.extend(get_volume_vars(self.config['node']))
-        lines.append('')
+        inventory = self.get_ansible_inventory()
+        hostvars = inventory['_meta']['hostvars']
+
+        def get_vars(variables):
+            return ['%s=%s' % (k, variables[k]) for k in sorted(variables.keys())]
+
+        # hosts are defined once, in the frontend and node groups
+        for kind in 'frontend', 'node':
+            lines.append('[%s]' % kind)
+            for host in inventory[kind]['hosts']:
+                lines.append(' '.join([host] + get_vars(hostvars[host])))
+            lines.append('')
+
+        for kind in 'frontend', 'node':
+            lines.append('[%s:vars]' % kind)
+            lines.extend(get_vars(inventory[kind]['vars']))
+            lines.append('')
+
+        # the role groups consist of the frontend and node groups
+        for kind in 'frontend', 'node':
+            for group in self.config[kind].get('groups', []):
+                if kind == 'node' and group in self.config['frontend'].get('groups', []):
+                    continue
+                lines.append('[%s:children]' % group)
+                lines.extend(inventory[group]['children'])
+                lines.append('')
 
         # generate all groups meta group and define global variables
         lines.append('[all:children]')
-        lines.append('frontend')
-        lines.append('node')
+        lines.extend(inventory['all']['children'])
         lines.append('')
 
         lines.append('[all:vars]')
-        lines.append('local_data_dir=/mnt/local_data')
-        lines.append('shared_data_dir=/mnt/shared_data')
+        lines.extend(get_vars(inventory['all']['vars']))
 
         return lines
 
@@ -584,82 +1148,138 @@ class Cluster(object):
 
 
 def update_ansible_inventory(cluster):
-    # update ansible inventory
-    with open('ansible-hosts', 'w') as f:
-        for line in cluster.generate_ansible_inventory():
-            f.write(line)
-            f.write('\n')
-    print
-    print "Updated ansible inventory file 'ansible-hosts'"
-    print
-
-
-def check_connectivity():
-#    cmd = "ansible -o --sudo -i ansible-hosts '*' -a 'uname -a' -f %d" % NUM_PARALLEL_ANSIBLE_TASKS
-    cmd = \
-        "ansible -o -i ansible-hosts '*' -c local -m wait_for " \
-        " -a '" \
-        " port=22" \
-        " host=\"{{ ansible_ssh_host | default(inventory_hostname) }}\"" \
-        " search_regex=OpenSSH " \
-        " timeout=120" \
-        "'"
-    cmd += ' -f %d' % NUM_PARALLEL_ANSIBLE_TASKS
-
-    if os.path.isfile('key.priv'):
-        cmd += ' --private-key key.priv'
-    print cmd
-    while subprocess.call(shlex.split(cmd)) != 0:
-        print "    no full connectivity yet, waiting a bit and retrying"
-        time.sleep(2)
-
+    # update ansible inventory, the file is left untouched if nothing has changed
+    content = ''.join(line + '\n' for line in cluster.generate_ansible_inventory())
+    old_content = None
+    if os.path.isfile(INVENTORY_FILE):
+        with open(INVENTORY_FILE, 'r') as f:
+            old_content = f.read()
+    if content != old_content:
+        with open(INVENTORY_FILE, 'w') as f:
+            f.write(content)
+        print
+        print "Updated ansible inventory file '%s'" % INVENTORY_FILE
+        print
 
-def run_main_playbook():
-    cmd = "ansible-playbook ../ansible/playbooks/site.yml -i ansible-hosts -f %d" % NUM_PARALLEL_ANSIBLE_TASKS
+    # with a dynamic inventory ansible reads the hosts and variables from 'poutacluster inventory --list'
+    if cluster.config['cluster'].get('ansible-inventory') == 'dynamic':
+        if not os.path.isfile(INVENTORY_SCRIPT):
+            with open(INVENTORY_SCRIPT, 'w') as f:
+                f.write('#!/bin/sh\n')
+                f.write('# ansible dynamic inventory of the cluster in this directory, generated by poutacluster\n')
+                f.write('cd "$(dirname "$0")" && exec %s %s inventory "$@"\n' % (
+                    sys.executable, os.path.abspath(sys.argv[0])))
+            os.chmod(INVENTORY_SCRIPT, 0755)
+    elif os.path.isfile(INVENTORY_SCRIPT):
+        os.remove(INVENTORY_SCRIPT)
+
+    update_ansible_config(cluster)
+
+    # seed the fact cache, facts are gathered only from the hosts that have not reported them yet
+    missing = fact_cache.seed_fact_cache(cluster.get_provider_facts())
+    if missing:
+        print "Facts will be gathered from %d new hosts" % len(missing)
+
+
+def update_ansible_config(cluster):
+    # forks are sized for the cluster, pipelining can be turned off for images that require a tty for sudo
+    num_hosts = len(cluster.nodes) + (1 if cluster.frontend else 0)
+    ansible_config.write_ansible_config(num_hosts, cluster.config['cluster'].get('ansible-pipelining', True))
+
+
+def get_inventory_source():
+    if os.path.isfile(INVENTORY_SCRIPT):
+        return INVENTORY_SCRIPT
+    return INVENTORY_FILE
+
+
+def check_connectivity(limit='*'):
+    hosts = ssh_prober.get_inventory_hosts(INVENTORY_FILE, limit)
+    print "Waiting for ssh on %d hosts" % len(hosts)
+    start = time.time()
+    with instrumentation.phase('connectivity'):
+        ready = ssh_prober.wait_for_ssh(hosts)
+    for name, seconds in ready.items():
+        provisioning_log.log_operation('ssh ready', 'vm', name, start, start + seconds, info=name)
+
+
+def run_playbook(playbook, args='', env=None):
+    """
+    Runs an ansible playbook from ../ansible/playbooks on the cluster inventory and logs its duration
+    """
+    cmd = "ansible-playbook ../ansible/playbooks/%s -i %s" % (playbook, get_inventory_source())
+    cmd += args
     if os.path.isfile('key.priv'):
         cmd += ' --private-key key.priv'
     print cmd
-    res = subprocess.call(shlex.split(cmd))
+    start = time.time()
+    res = subprocess.call(shlex.split(cmd), env=env or ansible_config.get_ansible_env())
+    fields = {'exit_code': res}
+    if res:
+        fields['error'] = 'exit code %d' % res
+    provisioning_log.log_operation('playbook', 'playbook', playbook, start, info=args.strip(), **fields)
     if res:
         raise RuntimeError('Ansible exited with error code: %d' % res)
 
 
-def run_bootstrap():
-    cmd = "ansible-playbook ../ansible/playbooks/bootstrap.yml -i ansible-hosts -f %d" % NUM_PARALLEL_ANSIBLE_TASKS
-    if os.path.isfile('key.priv'):
-        cmd += ' --private-key key.priv'
-    print cmd
-    res = subprocess.call(shlex.split(cmd))
-    if res:
-        raise RuntimeError('Ansible exited with error code: %d' % res)
+def run_main_playbook(limit=None, tags=None, skip_tags=None):
+    args = ''
+    if limit:
+        args += " --limit '%s'" % limit
+    if tags:
+        args += " --tags '%s'" % tags
+    if skip_tags:
+        args += " --skip-tags '%s'" % skip_tags
+    with instrumentation.phase('main playbook'):
+        run_playbook('site.yml', args)
+
+
+def run_bootstrap(limit=None):
+    args = " --limit '%s'" % limit if limit else ''
+    with instrumentation.phase('bootstrap'):
+        run_playbook('bootstrap.yml', args, env=ansible_config.get_ansible_env(pipelining=False))
+
+
+def run_bake_cleanup(host):
+    with instrumentation.phase('bake cleanup'):
+        run_playbook('bake_clean.yml', " --limit '%s'" % host)
 
 
 def run_add_key(key, user):
     print
     print 'Adding %s to authorized_keys for user %s' % (key, user)
     print
-    cmd = "ansible-playbook ../ansible/playbooks/add_ssh_key.yml -i ansible-hosts -f %d" % NUM_PARALLEL_ANSIBLE_TASKS
-    cmd += ' --extra-vars "key_user=%s key_file=%s" ' % (user, key)
-    if os.path.isfile('key.priv'):
-        cmd += ' --private-key key.priv'
-    print cmd
-    res = subprocess.call(shlex.split(cmd))
-    if res:
-        raise RuntimeError('Ansible exited with error code: %d' % res)
+    run_playbook('add_ssh_key.yml', ' --extra-vars "key_user=%s key_file=%s"' % (user, key))
+
+
+def run_drain(hosts):
+    with instrumentation.phase('drain'):
+        run_playbook('drain_nodes.yml',
+                     """ --extra-vars '{"drain_hosts": [%s]}'""" % ', '.join('"%s"' % x for x in hosts))
 
 
-def run_configuration():
+def get_host_fingerprints(cluster):
+    host_ids = dict((vm.name, vm.id) for vm in [cluster.frontend] + cluster.nodes if vm)
+    return config_fingerprint.compute_fingerprints(
+        cluster.generate_ansible_inventory(), config_fingerprint.hash_playbooks(), host_ids)
+
+
+def run_configuration(hosts=None):
+    # the node plays refer to the facts of the frontend, so it is always part of a limited run
+    limit = None
+    if hosts:
+        limit = ':'.join(['frontend'] + hosts)
     print
     print "Checking the connectivity to the cluster"
     print
-    check_connectivity()
+    check_connectivity(limit or '*')
     print
     print "Run the main playbook to configure the cluster"
     print
-    run_main_playbook()
+    run_main_playbook(limit)
 
 
-def run_first_time_setup():
+def run_first_time_setup(baked_hosts=None):
     print
     print "First we'll check the connectivity to the cluster"
     print
@@ -676,7 +1296,140 @@ def run_first_time_setup():
     print
     print "Run the main playbook to configure the cluster"
     print
-    run_main_playbook()
+    if baked_hosts:
+        # the nodes booted from the baked image only need the host specific tasks, the frontend is part of both
+        # runs for its facts and for the cluster membership
+        run_main_playbook(':'.join(['all'] + ['!%s' % x for x in baked_hosts]))
+        print
+        print "Run the host specific part of the main playbook on the nodes booted from the baked image"
+        print
+        run_main_playbook(':'.join(['frontend'] + baked_hosts), skip_tags=BAKED_SKIP_TAGS)
+    else:
+        run_main_playbook()
+
+
+def run_resize_configuration(added_hosts, baked_hosts=None):
+    # the existing hosts, frontend included, are updated with the new cluster membership (hosts, exports, firewall)
+    # before the new nodes are configured, so that the frontend accepts their NFS mounts
+    existing_hosts = ':'.join(['all'] + ['!%s' % x for x in added_hosts])
+    if added_hosts:
+        limit = ':'.join(added_hosts)
+        print
+        print "Checking the connectivity to the new nodes"
+        print
+        check_connectivity(limit)
+        print
+        print "Bootstrapping the new nodes"
+        print
+        run_bootstrap(limit)
+
+        print "Sleeping for a while before starting polling the hosts after the bootstrap"
+        time.sleep(3)
+        check_connectivity(limit)
+
+    print
+    print "Update the cluster membership on the existing hosts"
+    print
+    run_main_playbook(existing_hosts, 'membership')
+
+    if not added_hosts:
+        return
+
+    # the node plays refer to the facts of the frontend, so it is part of the limited runs
+    print
+    print "Run the main playbook on the new nodes"
+    print
+    baked_hosts = [x for x in added_hosts if x in (baked_hosts or [])]
+    other_hosts = [x for x in added_hosts if x not in baked_hosts]
+    if other_hosts:
+        run_main_playbook(':'.join(['frontend'] + other_hosts))
+    if baked_hosts:
+        run_main_playbook(':'.join(['frontend'] + baked_hosts), skip_tags=BAKED_SKIP_TAGS)
+
+    # the ssh host keys of the new nodes are known only after their facts have been gathered above
+    print
+    print "Add the host keys of the new nodes on the existing nodes"
+    print
+    run_main_playbook(':'.join([existing_hosts, '!frontend']), 'membership')
+
+
+def forget_host_keys(hosts):
+    """
+    Removes the keys of the given host names and addresses from the local known_hosts, the addresses of deleted
+    nodes are given to new VMs
+    """
+    known_hosts = os.path.expanduser('~/.ssh/known_hosts')
+    if not os.path.isfile(known_hosts):
+        return
+    with open(os.devnull, 'w') as devnull:
+        for host in hosts:
+            subprocess.call(['ssh-keygen', '-R', host, '-f', known_hosts], stdout=devnull, stderr=devnull)
+
+
+def run_pipelined_up(cluster, num_nodes, parallel):
+    """
+    Provisions and configures the cluster as a pipeline. The VMs are provisioned in the background, and each one
+    is bootstrapped and gets its packages installed as soon as it is reachable, in batches of the hosts that are
+    ready at the time. Only the rest of the main playbook, the cluster wide configuration (host lists, NFS exports,
+    GridEngine, Hadoop slaves), waits for all the hosts.
+    """
+    timeline = node_pipeline.StageTimeline()
+    baked_hosts = []
+
+    def prepare(hosts):
+        # the inventory is written only when it has the frontend
+        with cluster.state_lock:
+            if not cluster.frontend:
+                return []
+            update_ansible_inventory(cluster)
+            baked_hosts[:] = cluster.get_baked_nodes()
+        return hosts
+
+    def bootstrap(hosts):
+        run_bootstrap(':'.join(hosts))
+
+    def install_packages(hosts):
+        hosts = [x for x in hosts if x not in baked_hosts]
+        if hosts:
+            # the bootstrap may have rebooted the hosts
+            check_connectivity(':'.join(hosts))
+            run_main_playbook(':'.join(hosts), BAKED_SKIP_TAGS)
+
+    pipeline = node_pipeline.NodePipeline([('bootstrapped', bootstrap), ('packages', install_packages)], prepare,
+                                          timeline)
+    errors = []
+
+    def provision():
+        try:
+            cluster.up_pipelined(num_nodes, parallel, lambda vm: pipeline.add(vm.name, oaw.get_addresses(vm)[0]),
+                                 timeline)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            pipeline.finish()
+
+    thread = threading.Thread(target=provision, name='provisioning')
+    thread.daemon = True
+    thread.start()
+    with instrumentation.phase('pipeline'):
+        pipeline.run()
+    thread.join()
+
+    print
+    for line in timeline.get_timeline():
+        print line
+    if errors:
+        raise errors[0]
+    if pipeline.failed:
+        raise RuntimeError('Configuration failed for %d hosts: %s' % (
+            len(pipeline.failed), ', '.join(sorted(pipeline.failed.keys()))))
+
+    print
+    print "All hosts are ready, run the cluster wide part of the main playbook"
+    print
+    update_ansible_inventory(cluster)
+    check_connectivity()
+    run_main_playbook(skip_tags=BAKED_SKIP_TAGS)
 
 
 def get_endpoint_instructions(cluster, service_ip):
@@ -718,10 +1471,39 @@ def main():
     import argparse
 
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--refresh-catalog', action='store_true', help='discard cached image, flavor and network listings')
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help='reload the cluster state from OpenStack instead of the local state in %s' % cluster_state.STATE_FILE)
+    parser.add_argument(
+        '--trace', metavar='FILE', help='write the timeline of phases and API calls as a Chrome trace')
+    parser.add_argument(
+        '--profile', metavar='FILE', help='run the command under cProfile and save the statistics')
+    parser.add_argument(
+        '--record', metavar='FILE', help='record all OpenStack API calls to a trace file for replaying them later')
     subparsers = parser.add_subparsers(dest='command')
 
-    subparsers.add_parser('up').add_argument(
+    up_parser = subparsers.add_parser('up')
+    up_parser.add_argument(
         'num_nodes', metavar='num_nodes', type=int, help='number of nodes')
+    up_parser.add_argument(
+        '--parallel', metavar='N', type=int, default=1, help='number of nodes to provision concurrently')
+    up_parser.add_argument(
+        '--batch-size', metavar='N', type=int, default=1, help='number of nodes to boot with a single API request')
+    up_parser.add_argument(
+        '--pipeline', action='store_true',
+        help='configure each node as soon as it is reachable instead of waiting for the whole cluster')
+    up_parser.add_argument(
+        '--base-image', action='store_true', help='boot the nodes from the configured image even if a baked one exists')
+
+    resize_parser = subparsers.add_parser('resize')
+    resize_parser.add_argument(
+        'num_nodes', metavar='num_nodes', type=int, help='new number of nodes')
+    resize_parser.add_argument(
+        '--parallel', metavar='N', type=int, default=1, help='number of nodes to add or remove concurrently')
+    resize_parser.add_argument(
+        '--base-image', action='store_true', help='boot the nodes from the configured image even if a baked one exists')
 
     subparsers.add_parser('add_key').add_argument(
         'key_file', metavar='key_file', type=str, help='public key to upload')
@@ -732,16 +1514,76 @@ def main():
     subparsers.add_parser('wipe').add_argument(
         '--yes_i_know_what_im_doing', action='store_true', help='confirmation option')
 
-    subparsers.add_parser('down').add_argument(
+    down_parser = subparsers.add_parser('down')
+    down_parser.add_argument(
         '--unclean', action='store_true', help='immediate power off')
+    down_parser.add_argument(
+        '--parallel', metavar='N', type=int, default=None,
+        help='number of nodes to take down concurrently (default: 1, %d with --unclean)' % NUM_PARALLEL_TEARDOWN)
+
+    subparsers.add_parser('configure').add_argument(
+        '--force', action='store_true', help='configure all hosts, also the ones with unchanged inputs')
+
+    inventory_parser = subparsers.add_parser('inventory', help='print the ansible inventory as JSON')
+    inventory_parser.add_argument(
+        '--list', action='store_true', help='print all groups and host variables (default)')
+    inventory_parser.add_argument(
+        '--host', metavar='HOST', help='print the variables of a single host')
 
     # bulk add all the commands without arguments
-    for cmd in 'info', 'reset_nodes', 'destroy_volumes', 'configure', 'cleanup':
+    for cmd in 'info', 'reset_nodes', 'destroy_volumes', 'cleanup', 'bake':
         subparsers.add_parser(cmd)
 
+    watch_parser = subparsers.add_parser('watch', help='show the state of the cluster resources until interrupted')
+    watch_parser.add_argument(
+        '--interval', metavar='SECONDS', type=int, default=cluster_watch.WATCH_INTERVAL,
+        help='time between refreshes (default: %d)' % cluster_watch.WATCH_INTERVAL)
+    watch_parser.add_argument(
+        '--once', action='store_true', help='show the state once and exit')
+
+    subparsers.add_parser(
+        'stats', help='print the latency statistics of the operations in %s' % provisioning_log.PROVISIONING_LOG_FILE)
+
     args = parser.parse_args()
+    provisioning_log.start_run(args.command)
+
+    # the inventory is read by ansible from stdout, so everything else goes to stderr
+    if args.command == 'inventory':
+        sys.stdout = sys.stderr
+
+    try:
+        if args.profile:
+            import cProfile
+            import pstats
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run_command, args)
+            finally:
+                profiler.dump_stats(args.profile)
+                print
+                pstats.Stats(args.profile).sort_stats('cumulative').print_stats(20)
+                print "Profile saved to %s" % args.profile
+        else:
+            run_command(args)
+    finally:
+        api_recorder.stop()
+        provisioning_log.log_phases(instrumentation.get_phases())
+        provisioning_log.save()
+        instrumentation.print_summary()
+        if args.trace:
+            instrumentation.write_trace(args.trace)
+            print "Trace saved to %s" % args.trace
+
+
+def run_command(args):
     command = args.command
 
+    if command == 'stats':
+        print
+        for line in provisioning_log.format_stats(provisioning_log.get_stats(provisioning_log.load())):
+            print line
+        return
+
     # get references to nova and cinder API
     nova_client, cinder_client = oaw.get_clients()
 
@@ -754,9 +1596,41 @@ def main():
     print "    %12s: %s" % ('description', conf['cluster']['description'])
     print
 
-    # create Cluster instance and load state from OpenStack
-    cluster = Cluster(conf, nova_client, cinder_client)
-    cluster.load_provisioned_state()
+    if args.record:
+        watcher = oaw.get_state_watcher(nova_client)
+        api_recorder.start_recording(args.record, nova_client, cinder_client, {
+            'command': vars(args), 'config': conf, 'tenant': os.environ.get('OS_TENANT_NAME'),
+            'polling': [watcher.poll_interval, watcher.max_poll_interval]})
+
+    # set up caching of image, flavor, network and security group listings
+    catalog_cache_file = None
+    # a recorded session has to contain the catalog listings for replaying it
+    if conf['cluster'].get('catalog-cache', False) and not args.record:
+        catalog_cache_file = CATALOG_CACHE_FILE
+    catalog = oaw.configure_catalog(conf['cluster'].get('catalog-cache-ttl', oaw.CATALOG_TTL), catalog_cache_file)
+    if args.refresh_catalog:
+        catalog.invalidate()
+
+    # the watch lists the cluster resources on its own, the state is not needed
+    if command == 'watch':
+        if args.interval < 1:
+            print
+            print "ERROR: '--interval' requires a positive number of seconds"
+            print
+            sys.exit(1)
+        if not args.once:
+            print "Refreshing every %d seconds, press Ctrl-C to stop" % args.interval
+        cluster_watch.ClusterWatch(conf['cluster']['name'], nova_client, cinder_client).run(args.interval, args.once)
+        return
+
+    # create Cluster instance and load state either from the local state store or from OpenStack
+    state_store = cluster_state.ClusterStateStore(conf['cluster']['name'])
+    cluster = Cluster(conf, nova_client, cinder_client, state_store)
+    with instrumentation.phase('load state'):
+        if command in STATE_STORE_COMMANDS and not args.refresh:
+            cluster.load_stored_state()
+        else:
+            cluster.load_provisioned_state()
 
     # Execute the given command
 
@@ -772,15 +1646,34 @@ def main():
             print
             sys.exit(1)
 
-        cluster.up(args.num_nodes)
-        update_ansible_inventory(cluster)
-        print "Cluster has been started and resources provisioned."
-        print "Next we'll use 'ansible' to install and configure software"
+        if args.parallel < 1:
+            print
+            print "ERROR: '--parallel' requires a positive number of workers"
+            print
+            sys.exit(1)
+
+        if args.pipeline and args.batch_size > 1:
+            print
+            print "ERROR: '--pipeline' boots the nodes one by one, it cannot be used with '--batch-size'"
+            print
+            sys.exit(1)
 
-        # wait for a while for the last nodes to boot
-        time.sleep(5)
+        if not args.base_image:
+            cluster.use_baked_image(config_fingerprint.hash_playbooks())
+        if args.pipeline:
+            run_pipelined_up(cluster, args.num_nodes, args.parallel)
+        else:
+            cluster.up(args.num_nodes, parallel=args.parallel, batch_size=args.batch_size)
+            update_ansible_inventory(cluster)
+            print "Cluster has been started and resources provisioned."
+            print "Next we'll use 'ansible' to install and configure software"
+
+            # wait for a while for the last nodes to boot
+            time.sleep(5)
 
-        run_first_time_setup()
+            run_first_time_setup(cluster.get_baked_nodes())
+        fingerprints = get_host_fingerprints(cluster)
+        config_fingerprint.record_configured_hosts(fingerprints, fingerprints.keys())
 
         print
         print "Cluster setup done."
@@ -790,27 +1683,130 @@ def main():
         cluster.refresh_state()
         print_usage_instructions(cluster)
 
+    # add or remove nodes on a running cluster
+    elif command == 'resize':
+        if not cluster.frontend:
+            print "Cluster is not running, use 'up' to start it"
+            sys.exit(1)
+
+        if args.num_nodes < 0 or args.parallel < 1:
+            print
+            print "ERROR: 'resize' requires a non-negative number of nodes and a positive number of workers"
+            print
+            sys.exit(1)
+
+        # the hosts that are configured with the current inputs before the resize only need the membership update
+        update_ansible_inventory(cluster)
+        fingerprints = get_host_fingerprints(cluster)
+        changed = config_fingerprint.get_changed_hosts(fingerprints, config_fingerprint.load_fingerprints())
+        up_to_date = [x for x in fingerprints.keys() if x not in changed]
+
+        surplus = cluster.get_surplus_nodes(args.num_nodes)
+        if surplus:
+            print
+            print "Draining the nodes to be removed"
+            run_drain([node.name for node in surplus])
+
+        if not args.base_image:
+            cluster.use_baked_image(config_fingerprint.hash_playbooks())
+        added, removed = cluster.resize(args.num_nodes, parallel=args.parallel)
+        update_ansible_inventory(cluster)
+        if not added and not removed:
+            print "Cluster already has %d nodes, nothing to do" % args.num_nodes
+        else:
+            forget_host_keys(removed + [cluster.get_private_ip(node) for node in surplus])
+            run_resize_configuration(added, cluster.get_baked_nodes())
+            fingerprints = get_host_fingerprints(cluster)
+            config_fingerprint.record_configured_hosts(
+                fingerprints, added + [x for x in up_to_date if x in fingerprints])
+            print
+            print "Cluster resized, added %d and removed %d nodes" % (len(added), len(removed))
+            print
+
     # bring cluster down
     elif command == 'down':
         print
         print "Shutting cluster down, starting with last nodes"
         print
-        cluster.down(clean_shutdown=(not args.unclean))
+        parallel = args.parallel
+        if parallel is None:
+            parallel = NUM_PARALLEL_TEARDOWN if args.unclean else 1
+        cluster.down(clean_shutdown=(not args.unclean), parallel=parallel)
         update_ansible_inventory(cluster)
 
     # run ansible configuration scripts on existing cluster
     elif command == 'configure':
         print "Configuring existing cluster with ansible"
         update_ansible_inventory(cluster)
-        run_configuration()
+        fingerprints = get_host_fingerprints(cluster)
+        if args.force:
+            hosts = sorted(fingerprints.keys())
+        else:
+            hosts = config_fingerprint.get_changed_hosts(fingerprints, config_fingerprint.load_fingerprints())
+
+        if not hosts:
+            print
+            print "Inventory and playbooks have not changed since the last run, nothing to do"
+            print
+        else:
+            if len(hosts) < len(fingerprints):
+                print "    %d of %d hosts have changed: %s" % (len(hosts), len(fingerprints), ' '.join(hosts))
+                run_configuration(hosts)
+            else:
+                run_configuration()
+            config_fingerprint.record_configured_hosts(fingerprints, hosts + [cluster.frontend.name])
         print_usage_instructions(cluster)
 
+    # snapshot a configured node into an image for booting the new nodes
+    elif command == 'bake':
+        if not cluster.frontend:
+            print
+            print "ERROR: 'bake' requires a running cluster"
+            print
+            sys.exit(1)
+
+        metadata = cluster.get_bake_metadata(config_fingerprint.hash_playbooks())
+        image = oaw.find_image_by_metadata(nova_client, metadata)
+        if image:
+            print "Image %s has already been baked with the current playbooks" % image.name
+        else:
+            # the image is baked from a temporary node, so that no running node loses its jobs or scratch data
+            print
+            print "Booting a temporary node for baking"
+            try:
+                cluster.provision_bake_node()
+                update_ansible_inventory(cluster)
+                bake_host = cluster.bake_node.name
+                check_connectivity(bake_host)
+                run_bootstrap(bake_host)
+                print "Sleeping for a while before starting polling the host after the bootstrap"
+                time.sleep(3)
+                check_connectivity(bake_host)
+                print
+                print "Installing the node packages on %s" % bake_host
+                print
+                run_main_playbook(bake_host, tags=BAKED_SKIP_TAGS)
+                print
+                print "Cleaning the host specific state of %s" % bake_host
+                print
+                run_bake_cleanup(bake_host)
+                print
+                print "Baking %s into an image" % bake_host
+                cluster.bake_node_image(cluster.bake_node, metadata)
+            finally:
+                cluster.delete_bake_node()
+                update_ansible_inventory(cluster)
+            print
+            print "Node image baked, new nodes will boot from it"
+            print
+
     # add admin ssh key to frontend
     elif command == 'add_key':
         kf = args.key_file
         if not os.path.isabs(kf):
             kf = os.path.abspath(kf)
 
+        update_ansible_config(cluster)
         run_add_key(kf, cluster.config['frontend']['admin-user'])
 
     # add admin ssh key to frontend
@@ -833,6 +1829,15 @@ def main():
     elif command == 'cleanup':
         cluster.cleanup()
 
+    # ansible dynamic inventory, the rest of the output goes to stderr (see main())
+    elif command == 'inventory':
+        inventory = cluster.get_ansible_inventory()
+        if args.host:
+            json.dump(inventory['_meta']['hostvars'].get(args.host, {}), sys.__stdout__, indent=2)
+        else:
+            json.dump(inventory, sys.__stdout__, indent=2)
+        sys.__stdout__.write('\n')
+
     # print info about provisioned resources
     elif command == 'info':
         print
@@ -848,7 +1853,7 @@ def main():
             sys.exit(1)
 
         print 'Wiping cluster'
-        cluster.down(clean_shutdown=False)
+        cluster.down(clean_shutdown=False, parallel=NUM_PARALLEL_TEARDOWN)
         cluster.destroy_volumes(grace_time=0)
         cluster.cleanup()
         update_ansible_inventory(cluster)
@@ -856,17 +1861,10 @@ def main():
     else:
         raise RuntimeError("Unknown command '%s'" % command)
 
-    # finally save provisioning actions to a log file for later reference
-    prov_log = cluster.get_provisioning_log()
-    if len(prov_log) > 0:
-        # save provisioning log and look for changes
-        with open('provisioning.log', 'a') as logfile:
-            for le in prov_log:
-                sep = ''
-                for field in ['time', 'action', 'resource_type', 'resource_id', 'info']:
-                    logfile.write('%s%s' % (sep, le[field]))
-                    sep = '\t'
-                logfile.write('\n')
+    # the provisioning actions are saved to provisioning.jsonl by main()
+    if len(cluster.get_provisioning_log()) > 0:
+        # pick up the changes made by the command to the local state store
+        cluster.save_state()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+"""
+Structured log of the provisioning runs, one JSON object per line in provisioning.jsonl of the cluster directory.
+
+Every entry has the id of the run it belongs to, the command, the start time and an action. Created and deleted
+resources are logged as 'create' and 'delete' entries. Timed operations also have their duration in seconds:
+
+    boot            VM create request to ACTIVE
+    volume create   volume create request to available
+    volume attach   attach request to in-use
+    fip associate   floating IP association
+    ssh ready       ssh server answering after the VM was added to the wait
+    playbook        an ansible-playbook run
+    phase           a provisioning phase of poutacluster (see instrumentation)
+
+VM and volume operations carry the flavor and image of the VM. get_stats() aggregates the operations over all the
+logged runs.
+"""
+
+import os
+import json
+import math
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+
+PROVISIONING_LOG_FILE = 'provisioning.jsonl'
+
+# operations reported by get_stats() with their latency distribution by flavor and image
+PER_FLAVOR_OPERATIONS = ['boot', 'volume create', 'volume attach']
+# operations reported by get_stats() with their latency distribution by resource type or playbook
+OTHER_OPERATIONS = ['fip associate', 'ssh ready', 'playbook']
+# number of phases listed as the slowest
+NUM_SLOWEST_PHASES = 10
+
+_lock = threading.Lock()
+_run = {'run': None, 'command': None}
+_entries = []
+
+
+def start_run(command):
+    """
+    Starts a new run, the entries logged from now on get a new run id
+    """
+    with _lock:
+        _run['run'] = '%s-%d' % (datetime.datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid())
+        _run['command'] = command
+        del _entries[:]
+
+
+def log(action, resource_type, resource_id, info='', start=None, **fields):
+    """
+    Logs an entry of the current run. start is the start time of the action (default: now).
+    """
+    entry = dict(fields)
+    entry.update(_run)
+    entry.update({'time': datetime.datetime.fromtimestamp(start or time.time()).isoformat(), 'action': action,
+                  'resource_type': resource_type, 'resource_id': '%s' % resource_id, 'info': info})
+    with _lock:
+        _entries.append(entry)
+    return entry
+
+
+def log_operation(action, resource_type, resource_id, start, end=None, info='', **fields):
+    """
+    Logs a timed operation that started at start and ended at end (default: now)
+    """
+    duration = (end or time.time()) - start
+    return log(action, resource_type, resource_id, info, start, duration=round(duration, 3), **fields)
+
+
+@contextmanager
+def timed(action, resource_type, resource_id, info='', **fields):
+    """
+    Context manager that logs the duration of the operation it wraps, with the error if the operation fails
+    """
+    start = time.time()
+    try:
+        yield
+    except Exception as e:
+        log_operation(action, resource_type, resource_id, start, info=info, error=str(e), **fields)
+        raise
+    log_operation(action, resource_type, resource_id, start, info=info, **fields)
+
+
+def log_phases(phases):
+    """
+    Logs the provisioning phases given as (name, start, end)
+    """
+    for name, start, end in phases:
+        log_operation('phase', 'phase', name, start, end)
+
+
+def get_entries():
+    with _lock:
+        return list(_entries)
+
+
+def save(path=PROVISIONING_LOG_FILE):
+    """
+    Appends the entries of the current run to the log file. Runs that only have phases (like 'info') are not
+    logged.
+    """
+    entries = get_entries()
+    if not [x for x in entries if x['action'] != 'phase']:
+        return
+    with open(path, 'a') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, sort_keys=True))
+            f.write('\n')
+
+
+def load(path=PROVISIONING_LOG_FILE):
+    entries = []
+    if not os.path.isfile(path):
+        return entries
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+
+def percentile(values, p):
+    """
+    Returns the p:th percentile (0-100) of values with the nearest rank method
+    """
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def _distribution(durations):
+    return {'count': len(durations), 'p50': percentile(durations, 50), 'p95': percentile(durations, 95),
+            'max': max(durations)}
+
+
+def get_stats(entries):
+    """
+    Returns the latency distributions (count, p50, p95, max) of the successful operations in entries, as a dict
+    with 'runs', 'by_flavor' ((action, flavor, image) -> distribution), 'other' ((action, resource type or
+    playbook) -> distribution) and 'phases' (the slowest phases as (name, distribution), by p95)
+    """
+    by_flavor = {}
+    other = {}
+    phases = {}
+    for entry in entries:
+        if 'duration' not in entry or entry.get('error'):
+            continue
+        action = entry['action']
+        if action in PER_FLAVOR_OPERATIONS:
+            key = (action, entry.get('flavor') or '-', entry.get('image') or '-')
+            by_flavor.setdefault(key, []).append(entry['duration'])
+        elif action in OTHER_OPERATIONS:
+            key = (action, entry['resource_id'] if action == 'playbook' else entry['resource_type'])
+            other.setdefault(key, []).append(entry['duration'])
+        elif action == 'phase':
+            phases.setdefault(entry['resource_id'], []).append(entry['duration'])
+
+    phase_stats = sorted(((name, _distribution(x)) for name, x in phases.items()),
+                         key=lambda x: x[1]['p95'], reverse=True)
+    return {
+        'runs': len(set(x.get('run') for x in entries if x.get('run'))),
+        'by_flavor': dict((k, _distribution(v)) for k, v in by_flavor.items()),
+        'other': dict((k, _distribution(v)) for k, v in other.items()),
+        'phases': phase_stats[:NUM_SLOWEST_PHASES],
+    }
+
+
+def format_stats(stats):
+    """
+    Returns the statistics from get_stats() as lines of tables
+    """
+    def row(template, name, dist):
+        return template % (name, dist['count'], dist['p50'], dist['p95'], dist['max'])
+
+    lines = ['%d runs logged' % stats['runs'], '']
+    template = '%-48s %6s %9s %9s %9s'
+    row_template = '%-48s %6d %8.1fs %8.1fs %8.1fs'
+    if stats['by_flavor']:
+        lines.append(template % ('operation (flavor, image)', 'count', 'p50', 'p95', 'max'))
+        for (action, flavor, image), dist in sorted(stats['by_flavor'].items()):
+            lines.append(row(row_template, ('%s (%s, %s)' % (action, flavor, image))[:48], dist))
+        lines.append('')
+    if stats['other']:
+        lines.append(template % ('operation', 'count', 'p50', 'p95', 'max'))
+        for (action, name), dist in sorted(stats['other'].items()):
+            lines.append(row(row_template, ('%s %s' % (action, name))[:48], dist))
+        lines.append('')
+    if stats['phases']:
+        lines.append(template % ('slowest phases', 'count', 'p50', 'p95', 'max'))
+        for name, dist in stats['phases']:
+            lines.append(row(row_template, name[:48], dist))
+        lines.append('')
+    return lines
@@ -0,0 +1,214 @@
+"""
+Waits for the ssh servers of a set of hosts to come up by probing port 22 of all the hosts concurrently with
+non-blocking sockets, instead of running ansible's wait_for over the whole inventory in a retry loop
+"""
+
+import time
+import errno
+import select
+import socket
+import config_fingerprint
+
+SSH_PORT = 22
+SSH_BANNER = 'OpenSSH'
+
+# timeout for a single connection attempt and the pause before retrying a host that refused or timed out
+CONNECT_TIMEOUT = 10
+RETRY_DELAY = 2
+
+# how often to print the hosts that are not ready yet
+REPORT_INTERVAL = 15
+
+MAX_BANNER_LENGTH = 1024
+
+
+def get_inventory_hosts(inventory_file, limit='*'):
+    """
+    Returns (name, address) of the hosts in the inventory file matching limit, a ':' separated list of host and
+    group names like the --limit option of ansible. '*' and 'all' match all the hosts.
+    """
+    with open(inventory_file, 'r') as f:
+        hosts = config_fingerprint.parse_inventory(f.readlines())
+
+    patterns = set(limit.split(':'))
+    res = []
+    for name in sorted(hosts.keys()):
+        host = hosts[name]
+        if not patterns & set(['*', 'all', name] + host['groups']):
+            continue
+        address = name
+        for field in host['line'].split()[1:]:
+            key, _, value = field.partition('=')
+            if key == 'ansible_ssh_host':
+                address = value
+        res.append((name, address))
+    return res
+
+
+class HostProbe(object):
+    """
+    Probing state of a single host
+    """
+
+    def __init__(self, name, address, port):
+        self.name = name
+        self.address = address
+        self.port = port
+        self.sock = None
+        self.connected = False
+        self.banner = ''
+        self.attempt_started = None
+        self.next_attempt = 0
+        self.attempts = 0
+        self.last_error = None
+
+    def connect(self, now):
+        self.close()
+        self.attempts += 1
+        self.attempt_started = now
+        self.connected = False
+        self.banner = ''
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex((self.address, self.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self.fail(now, errno.errorcode.get(err, err))
+
+    def fail(self, now, reason):
+        self.close()
+        self.last_error = reason
+        self.next_attempt = now + RETRY_DELAY
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_banner(self, now):
+        """
+        Reads available data from the socket, returns True when the OpenSSH banner has been received
+        """
+        try:
+            data = self.sock.recv(MAX_BANNER_LENGTH)
+        except socket.error as e:
+            self.fail(now, str(e))
+            return False
+        if not data:
+            self.fail(now, 'connection closed')
+            return False
+        self.banner += data
+        if SSH_BANNER in self.banner:
+            self.close()
+            return True
+        if len(self.banner) > MAX_BANNER_LENGTH or '\n' in self.banner:
+            self.fail(now, 'unexpected banner %r' % self.banner.strip()[:40])
+        return False
+
+
+class SshProber(object):
+    """
+    Probes the ssh ports of a set of hosts concurrently. Hosts can be added while the others are being probed.
+    """
+
+    def __init__(self, port=SSH_PORT):
+        self.port = port
+        self.pending = {}
+        self.added = {}
+
+    def add(self, name, address):
+        self.pending[name] = HostProbe(name, address, self.port)
+        self.added[name] = time.time()
+
+    def poll(self, timeout=1):
+        """
+        Probes the pending hosts for at most timeout seconds. Returns (name, seconds since the host was added) for
+        each host that answered with an OpenSSH banner.
+        """
+        if not self.pending:
+            return []
+        now = time.time()
+
+        # start new connection attempts and time out the ones that hang
+        for probe in self.pending.values():
+            if probe.sock is None and now >= probe.next_attempt:
+                probe.connect(now)
+            elif probe.sock is not None and now - probe.attempt_started > CONNECT_TIMEOUT:
+                probe.fail(now, 'timed out')
+
+        connecting = [p for p in self.pending.values() if p.sock is not None and not p.connected]
+        active = [p for p in self.pending.values() if p.sock is not None]
+        if active:
+            readable, writable, _ = select.select(active, connecting, [], timeout)
+        else:
+            readable, writable = [], []
+            time.sleep(min(timeout, max(0, min(p.next_attempt for p in self.pending.values()) - now)))
+        now = time.time()
+
+        # a connected socket becomes writable, a failed connection reports the error in SO_ERROR
+        for probe in writable:
+            err = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                probe.fail(now, errno.errorcode.get(err, err))
+            else:
+                probe.connected = True
+
+        ready = []
+        for probe in readable:
+            if probe.sock is None:
+                continue
+            if probe.read_banner(now):
+                del self.pending[probe.name]
+                ready.append((probe.name, now - self.added.pop(probe.name)))
+        return ready
+
+    def describe_pending(self, max_hosts=10):
+        probes = sorted(self.pending.values(), key=lambda x: x.name)
+        return ', '.join('%s (%s)' % (p.name, p.last_error or 'connecting') for p in probes[:max_hosts]) + (
+            ', ...' if len(probes) > max_hosts else '')
+
+    def close(self):
+        for probe in self.pending.values():
+            probe.close()
+
+
+def wait_for_ssh(hosts, timeout=None, on_ready=None, port=SSH_PORT):
+    """
+    Waits until the ssh server of every (name, address) in hosts answers with an OpenSSH banner.
+
+    on_ready(name) is called for each host as soon as it is ready, so that the next stage can start for that host
+    while the others are still booting. Hosts that are not ready are reported periodically with the time spent
+    waiting. Raises RuntimeError if timeout (in seconds) is given and not all hosts are ready in time.
+
+    Returns a dict of host name -> seconds it took for the host to become ready.
+    """
+    start = time.time()
+    prober = SshProber(port)
+    for name, address in hosts:
+        prober.add(name, address)
+    ready = {}
+    last_report = start
+
+    try:
+        while prober.pending:
+            for name, seconds in prober.poll():
+                ready[name] = seconds
+                print '    %s is ready (%.1f s)' % (name, seconds)
+                if on_ready:
+                    on_ready(name)
+
+            now = time.time()
+            if prober.pending and now - last_report >= REPORT_INTERVAL:
+                last_report = now
+                print '    waiting for ssh on %d of %d hosts (%d s): %s' % (
+                    len(prober.pending), len(hosts), now - start, prober.describe_pending())
+
+            if timeout is not None and prober.pending and now - start > timeout:
+                raise RuntimeError('Hosts not reachable with ssh after %d seconds: %s' % (
+                    timeout, ', '.join(sorted(prober.pending.keys()))))
+    finally:
+        prober.close()
+
+    return ready
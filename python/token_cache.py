@@ -0,0 +1,131 @@
+"""
+Keystone authentication shared by the nova and cinder clients: one session with a common connection pool, and
+tokens cached in a file readable only by the user, so that consecutive commands do not authenticate again until the
+token is about to expire
+"""
+
+import os
+import json
+import time
+import calendar
+import hashlib
+import threading
+
+try:
+    import requests
+    from keystoneclient import access
+    from keystoneclient import session as ks_session
+    from keystoneclient.auth.identity import v2
+except ImportError:
+    ks_session = None
+
+TOKEN_CACHE_FILE = os.path.expanduser('~/.poutacluster-tokens.json')
+
+# cached tokens are not used anymore when they expire in less than this (in seconds)
+TOKEN_EXPIRY_MARGIN = 300
+
+# connections kept open per API endpoint, enough for the parallel provisioning workers
+HTTP_POOL_SIZE = 32
+
+
+def get_cache_file():
+    """
+    Returns the token cache file, OS_TOKEN_CACHE overrides the default and an empty value disables caching
+    """
+    return os.environ.get('OS_TOKEN_CACHE', TOKEN_CACHE_FILE)
+
+
+def get_cache_key(auth_url, username, tenant):
+    return hashlib.sha1('\n'.join([auth_url, username, tenant])).hexdigest()
+
+
+def load_tokens(path):
+    """
+    Returns the cached tokens by cache key. A file that other users could read or modify is ignored.
+    """
+    if not path or not os.path.isfile(path):
+        return {}
+    st = os.stat(path)
+    if st.st_uid != os.getuid() or st.st_mode & 077:
+        print 'WARN: ignoring token cache %s, it is accessible to other users' % path
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_token(path, key, auth_ref):
+    """
+    Stores the token of auth_ref in the cache file, dropping expired tokens. The file is created with permissions
+    for the user only and replaced atomically, so that concurrent commands always read a complete file.
+    """
+    if not path:
+        return
+    tokens = load_tokens(path)
+    now = time.time()
+    tokens = dict((k, v) for k, v in tokens.items() if v.get('expires_at', 0) > now)
+    tokens[key] = {'access': dict(auth_ref), 'expires_at': calendar.timegm(auth_ref.expires.utctimetuple())}
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(tokens, f)
+    os.rename(tmp_path, path)
+
+
+def load_token(path, key):
+    """
+    Returns the cached AccessInfo for key, or None if there is none that is valid long enough
+    """
+    entry = load_tokens(path).get(key)
+    if not entry:
+        return None
+    auth_ref = access.AccessInfo.factory(body={'access': entry['access']})
+    if auth_ref.will_expire_soon(stale_duration=TOKEN_EXPIRY_MARGIN):
+        return None
+    return auth_ref
+
+
+if ks_session:
+    class CachedPassword(v2.Password):
+        """
+        Password authentication that starts from a cached token and stores every new token in the cache. Parallel
+        workers share the plugin, so only one of them authenticates when the token has to be renewed.
+        """
+
+        def __init__(self, auth_url, username, password, tenant_name, cache_file):
+            super(CachedPassword, self).__init__(auth_url, username=username, password=password,
+                                                 tenant_name=tenant_name)
+            self.cache_file = cache_file
+            self.cache_key = get_cache_key(auth_url, username, tenant_name)
+            self.lock = threading.RLock()
+            self.auth_ref = load_token(cache_file, self.cache_key)
+
+        def get_access(self, session, **kwargs):
+            with self.lock:
+                return super(CachedPassword, self).get_access(session, **kwargs)
+
+        def invalidate(self):
+            with self.lock:
+                return super(CachedPassword, self).invalidate()
+
+        def get_auth_ref(self, session, **kwargs):
+            auth_ref = super(CachedPassword, self).get_auth_ref(session, **kwargs)
+            save_token(self.cache_file, self.cache_key, auth_ref)
+            return auth_ref
+
+
+def get_session(auth_url, username, password, tenant):
+    """
+    Returns a keystone session for the clients of both services, or None if keystoneclient does not support sessions
+    """
+    if not ks_session:
+        return None
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    auth = CachedPassword(auth_url, username, password, tenant, get_cache_file())
+    return ks_session.Session(auth=auth, session=http)
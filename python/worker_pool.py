@@ -0,0 +1,119 @@
+"""
+Bounded pool of worker threads for running provisioning tasks concurrently
+"""
+
+import sys
+import threading
+import Queue
+
+
+class TaskResult(object):
+    """
+    Outcome of a single task run in the pool
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.result = None
+        self.error = None
+
+
+class PrefixedOutput(object):
+    """
+    Replacement for sys.stdout that tags complete output lines written from worker threads with the name of the
+    task the thread is running, so that the interleaved progress output of parallel tasks stays readable
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.partial_lines = {}
+
+    def write(self, data):
+        prefix = getattr(threading.current_thread(), 'output_prefix', None)
+        if not prefix:
+            with self.lock:
+                self.stream.write(data)
+            return
+
+        key = threading.current_thread().ident
+        lines = (self.partial_lines.get(key, '') + data).split('\n')
+        self.partial_lines[key] = lines[-1]
+        with self.lock:
+            for line in lines[:-1]:
+                self.stream.write('[%s] %s\n' % (prefix, line))
+
+    def end_task(self):
+        """
+        Writes out what is left of the last line of the current thread's task, so that output without a trailing
+        newline is not lost
+        """
+        prefix = getattr(threading.current_thread(), 'output_prefix', None)
+        partial = self.partial_lines.pop(threading.current_thread().ident, '')
+        if prefix and partial:
+            with self.lock:
+                self.stream.write('[%s] %s\n' % (prefix, partial))
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def set_output_prefix(name):
+    """
+    Tags the output of the current worker thread with name from now on, after writing out what is left of the output
+    of its previous task
+    """
+    if isinstance(sys.stdout, PrefixedOutput):
+        sys.stdout.end_task()
+    threading.current_thread().output_prefix = name
+
+
+def run_in_parallel(tasks, num_workers):
+    """
+    Runs tasks given as (name, function, args) tuples in at most num_workers threads.
+
+    An exception in one task does not affect the others, it is stored in the corresponding TaskResult instead.
+    Returns a list of TaskResults in the same order as the tasks.
+    """
+    results = [TaskResult(name) for name, _, _ in tasks]
+    task_queue = Queue.Queue()
+    for i, task in enumerate(tasks):
+        task_queue.put((i, task))
+
+    def worker():
+        while True:
+            try:
+                i, (name, func, args) = task_queue.get_nowait()
+            except Queue.Empty:
+                return
+            set_output_prefix(name)
+            try:
+                results[i].result = func(*args)
+            except Exception as e:
+                results[i].error = e
+                print '    ERROR: %s' % e
+            finally:
+                set_output_prefix(None)
+
+    orig_stdout = sys.stdout
+    if not isinstance(orig_stdout, PrefixedOutput):
+        sys.stdout = PrefixedOutput(orig_stdout)
+    try:
+        threads = []
+        for _ in range(max(1, min(num_workers, len(tasks)))):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        # join with a timeout so that the main thread still receives KeyboardInterrupt
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+    finally:
+        sys.stdout = orig_stdout
+
+    return results